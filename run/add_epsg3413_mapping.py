@@ -3,49 +3,159 @@ try:
     from netCDF3 import Dataset as CDF
 except:
     from netCDF4 import Dataset as CDF
+import glob
+import time
+from collections import OrderedDict
+from multiprocessing import Pool
 from argparse import ArgumentParser
 
+MAPPING_ATTRS = OrderedDict()
+MAPPING_ATTRS['grid_mapping_name'] = "polar_stereographic"
+MAPPING_ATTRS['latitude_of_projection_origin'] = 90.
+MAPPING_ATTRS['straight_vertical_longitude_from_pole'] = -45.0
+MAPPING_ATTRS['standard_parallel'] = 70.0
+MAPPING_ATTRS['false_easting'] = 0.
+MAPPING_ATTRS['false_northing'] = 0.
+MAPPING_ATTRS['units'] = "m"
+PROJ4 = "+init=epsg:3413"
 
-# Set up the Argument parser
-description = '''A script to add EPSG:3413 mapping information to a netCDF file.'''
-parser = ArgumentParser()
-parser.description = description
-parser.add_argument("FILE", nargs='*')
-options = parser.parse_args()
-args = options.FILE
 
-infile = args[0]
+def get_mapping_var(nc):
+    '''
+    Return the name of the mapping variable referenced by grid_mapping
+    attributes, 'mapping' by default
+    '''
 
-nc = CDF(infile, 'a')
+    for var in nc.variables.values():
+        if hasattr(var, 'grid_mapping'):
+            return var.grid_mapping
 
+    return 'mapping'
 
-mapping_var = 'mapping'
-for var in nc.variables.keys():
-    if hasattr(var, 'grid_mapping'):
-        mapping_var = var.grid_mapping
-        pass
 
-if not var in nc.variables.keys():
-    mapping = nc.createVariable(mapping_var, 'b')
+def has_mapping(nc):
+    '''
+    Return True if nc already carries the EPSG:3413 mapping variable
+    and proj4 attribute
+    '''
 
-else:
+    mapping_var = get_mapping_var(nc)
+    if mapping_var not in nc.variables.keys():
+        return False
+    if getattr(nc, 'proj4', None) != PROJ4:
+        return False
     mapping = nc.variables[mapping_var]
-mapping.grid_mapping_name = "polar_stereographic"
-mapping.latitude_of_projection_origin = 90.
-mapping.straight_vertical_longitude_from_pole = -45.0
-mapping.standard_parallel = 70.0
-mapping.false_easting = 0.
-mapping.false_northing = 0.
-mapping.units = "m"
+    for attr, value in MAPPING_ATTRS.items():
+        if not hasattr(mapping, attr) or getattr(mapping, attr) != value:
+            return False
 
+    return True
 
-# Save the projection information:
-nc.proj4 = "+init=epsg:3413"
 
-nc.Conventions = "CF-1.6"
+def add_mapping(nc):
+    '''
+    Add EPSG:3413 mapping information to an open netCDF file
+    '''
 
-script_command = ' '.join([time.ctime(), ':', __file__.split('/')[-1]])
-nc.history = script_command
-print "writing to %s ...\n" % output
-print "run nc2cdo.py to add lat/lon variables" 
-nc.close()
+    mapping_var = get_mapping_var(nc)
+    if mapping_var not in nc.variables.keys():
+        mapping = nc.createVariable(mapping_var, 'b')
+    else:
+        mapping = nc.variables[mapping_var]
+    for attr, value in MAPPING_ATTRS.items():
+        setattr(mapping, attr, value)
+
+    # Save the projection information:
+    nc.proj4 = PROJ4
+
+    nc.Conventions = "CF-1.6"
+
+    return mapping
+
+
+def tag_file(filename, force=False):
+    '''
+    Add EPSG:3413 mapping information to filename unless it is already
+    there. Only metadata is changed. Returns (filename, status, seconds).
+    '''
+
+    t0 = time.time()
+    try:
+        nc = CDF(filename, 'r')
+        done = has_mapping(nc)
+        nc.close()
+        if done and not force:
+            return filename, 'skipped', time.time() - t0
+
+        nc = CDF(filename, 'a')
+        add_mapping(nc)
+        script_command = ' '.join([time.ctime(), ':', __file__.split('/')[-1]])
+        nc.history = script_command
+        nc.close()
+    except (IOError, OSError, RuntimeError) as e:
+        return filename, 'failed ({})'.format(e), time.time() - t0
+
+    return filename, 'tagged', time.time() - t0
+
+
+def _tag_file(args):
+    return tag_file(*args)
+
+
+def expand_files(patterns):
+    '''
+    Expand glob patterns, keeping plain file names and their order
+    '''
+
+    files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if matches:
+            files.extend(matches)
+        else:
+            files.append(pattern)
+
+    return files
+
+
+def tag_files(files, n_procs=1, force=False):
+    '''
+    Tag files with a pool of n_procs workers and yield the result of
+    each file as it finishes
+    '''
+
+    tasks = [(filename, force) for filename in files]
+    if n_procs > 1 and len(tasks) > 1:
+        pool = Pool(n_procs)
+        try:
+            for result in pool.imap_unordered(_tag_file, tasks):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for task in tasks:
+            yield _tag_file(task)
+
+
+if __name__ == "__main__":
+
+    # Set up the Argument parser
+    description = '''A script to add EPSG:3413 mapping information to netCDF files.'''
+    parser = ArgumentParser()
+    parser.description = description
+    parser.add_argument("FILE", nargs='+',
+                        help="files or glob patterns, e.g. 'ex_*.nc'")
+    parser.add_argument("-j", "--n_procs", dest="n_procs", type=int,
+                        help="number of worker processes. default=1", default=1)
+    parser.add_argument("--force", dest="force", action="store_true",
+                        help="tag files that already carry the mapping", default=False)
+    options = parser.parse_args()
+
+    files = expand_files(options.FILE)
+
+    t0 = time.time()
+    for filename, status, elapsed in tag_files(files, n_procs=options.n_procs, force=options.force):
+        print("  {:8.3f}s  {}  {}".format(elapsed, status, filename))
+    print("processed {} files in {:.2f}s".format(len(files), time.time() - t0))
+    print("run nc2cdo.py to add lat/lon variables")
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# Copyright (C) 2015 Andy Aschwanden
+
+'''
+Dependency-graph scheduler for multi-resolution spinup chains.
+
+Each ensemble member is refined through a sequence of grids, e.g.
+9000 -> 4500 -> ... -> 450 m, and every stage regrids from a save file
+of the previous stage. The chain of all members is built at once as a
+DAG of run and post jobs: a run job depends (afterok) on the run job of
+the same member on the previous grid only, and a post job on its run
+job, so members advance through the grids independently.
+
+The DAG can be printed or written as a Graphviz dot file before the
+submit script is run.
+
+Example
+-------
+>>> nodes = generate_chain(space, build_stage, [9000, 4500, 3600], 'submit.sh', header)
+>>> print(format_dag(nodes))
+>>> write_dot(nodes, 'submit.dot')
+'''
+
+import os
+from collections import OrderedDict
+from resources import *
+from ensemble import *
+from manifest import record_members, get_job_ids
+
+
+def get_chain_grids(grid_choices, first, last):
+    '''
+    Return the grids of grid_choices (ordered coarse to fine) from
+    first to last, inclusive
+    '''
+
+    grids = list(grid_choices)
+    start = grids.index(first)
+    end = grids.index(last)
+    if end < start:
+        raise ValueError('grid {} is coarser than {}'.format(last, first))
+
+    return grids[start:end + 1]
+
+
+def get_save_file(outfile, time):
+    '''
+    Return the name of the file written at save time time by a run
+    with output file outfile (-save_split -save_file save_$OUTNAMESANS,
+    see run_main.sh)
+    '''
+
+    return 'save_{}_{}.000.nc'.format(os.path.splitext(os.path.basename(outfile))[0], time)
+
+
+def make_node(name, kind, member, script, parents):
+    '''
+    Return a dict describing one job of the DAG. parents is a list of
+    node names that must finish successfully first.
+    '''
+
+    node = OrderedDict()
+    node['name'] = name
+    node['kind'] = kind
+    node['member'] = member['id']
+    node['grid'] = member['grid']
+    node['experiment'] = member['experiment']
+    node['script'] = script
+    node['parents'] = parents
+
+    return node
+
+
+def generate_chain(space, build_stage, grids, submit, header, post=True, manifest=None, incremental=False,
+                   resume_after=None, timing=False):
+    '''
+    Write run and post scripts of every member of a parameter space on
+    every grid of grids, and a submit script queueing the whole DAG.
+    Returns the list of nodes in submission order.
+
+    build_stage(combination, grid, parent) returns a member (see
+    ensemble.make_member) of one stage; parent is the member of the
+    previous stage or None for the first grid. header is a PBS header
+    or a function of the grid returning one. If manifest is given,
+    all stages are recorded in that manifest database and the submit
+    script stores their job IDs.
+
+    If incremental is True, finished stages are skipped (or only get a
+    post job if their post-processed files are missing) and stages whose
+    job is still queued are not resubmitted; their children depend on
+    the queued job ID (see ensemble.get_member_state).
+
+    If resume_after (seconds, or a function of the grid returning them)
+    is given, stages are split into chunks of that wall-clock length. A resubmitted stage requeues the rest of its
+    chain with get_next_script (see write_run_script and resume.py).
+
+    If timing is True, job and post scripts write stage timing records
+    (see stage_timing.py).
+    '''
+
+    queued = set()
+    job_ids = {}
+    if incremental:
+        queued = get_queued_jobs()
+        if manifest is not None and os.path.isfile(manifest):
+            job_ids = get_job_ids(manifest)
+
+    nodes = []
+    members = []
+    seen = set()
+    for n, combination in enumerate(expand_parameter_space(space)):
+        parent = None
+        parent_node = None
+        for grid in grids:
+            member = build_stage(combination, grid, parent)
+            member['id'] = n
+            member['combination'] = combination
+            if member['script'] in seen:
+                break
+            seen.add(member['script'])
+
+            state = 'missing'
+            if incremental:
+                state = get_member_state(member, queued=queued, job_ids=job_ids)
+            if state in ('done',):
+                parent = member
+                parent_node = None
+                continue
+            elif state in ('post',):
+                if post:
+                    write_post_script(member, timing=timing)
+                    nodes.append(make_node('J{}'.format(len(nodes)), 'post', member, member['post'], []))
+                parent = member
+                parent_node = None
+                continue
+            elif state in ('queued',):
+                queued_node = make_node('J{}'.format(len(nodes)), 'queued', member, job_ids[member['script']], [])
+                nodes.append(queued_node)
+                parent = member
+                parent_node = queued_node
+                continue
+
+            if callable(header):
+                stage_header = header(grid)
+            else:
+                stage_header = header
+            if callable(resume_after):
+                write_run_script(member, stage_header, resume_after=resume_after(grid), then=get_next_script(member['script']),
+                                 timing=timing)
+            elif resume_after is not None:
+                write_run_script(member, stage_header, resume_after=resume_after, then=get_next_script(member['script']),
+                                 timing=timing)
+            else:
+                write_run_script(member, stage_header, timing=timing)
+            parents = [parent_node['name']] if parent_node is not None else []
+            run_node = make_node('J{}'.format(len(nodes)), 'run', member, member['script'], parents)
+            nodes.append(run_node)
+            if post:
+                write_post_script(member, timing=timing)
+                nodes.append(make_node('J{}'.format(len(nodes)), 'post', member, member['post'], [run_node['name']]))
+
+            members.append(member)
+            parent = member
+            parent_node = run_node
+
+    write_chain_submit(submit, nodes, manifest=manifest)
+    if resume_after is not None:
+        for node in nodes:
+            if node['kind'] in ('run',):
+                write_next_script(nodes, node, manifest=manifest)
+    if manifest is not None:
+        record_members(manifest, members)
+
+    return nodes
+
+
+def write_node_lines(f, nodes, manifest=None):
+    '''
+    Append the qsub calls of nodes, with afterok dependencies on their
+    parents, to an open submit script
+    '''
+
+    for node in nodes:
+        if node['kind'] in ('queued',):
+            # already in the queue, 'script' holds the job ID
+            f.write('{name}={script}\n'.format(**node))
+            continue
+        if node['parents']:
+            depend = '-W depend=afterok:' + ':'.join(['${{{}}}'.format(p) for p in node['parents']]) + ' '
+        else:
+            depend = ''
+        f.write('{name}=$(qsub {depend}{script})\n'.format(name=node['name'], depend=depend, script=node['script']))
+        if manifest is not None and node['kind'] in ('run',):
+            write_manifest_line(f, node['script'], manifest, jobid='${{{}}}'.format(node['name']))
+
+
+def write_chain_submit(submit, nodes, manifest=None):
+    '''
+    Write a submit script that queues nodes with afterok dependencies
+    on their parents
+    '''
+
+    with open(submit, 'w') as f:
+        f.write('#!/bin/bash\n')
+        write_node_lines(f, nodes, manifest=manifest)
+
+
+def get_next_script(script):
+    '''
+    Return the name of the script requeueing the rest of the chain after
+    the stage with job script script
+    '''
+
+    return '{}_next.sh'.format(os.path.splitext(script)[0])
+
+
+def get_descendants(nodes, node):
+    '''
+    Return the nodes depending directly or indirectly on node
+    '''
+
+    names = set([node['name']])
+    descendants = []
+    for other in nodes:
+        if any([p in names for p in other['parents']]):
+            names.add(other['name'])
+            descendants.append(other)
+
+    return descendants
+
+
+def write_next_script(nodes, node, manifest=None):
+    '''
+    Write the script requeueing all descendants of node. It is called
+    with the job ID that replaces node, e.g. by resume.py.
+    '''
+
+    with open(get_next_script(node['script']), 'w') as f:
+        f.write('#!/bin/bash\n')
+        f.write('{}=$1\n'.format(node['name']))
+        write_node_lines(f, get_descendants(nodes, node), manifest=manifest)
+
+
+def format_dag(nodes):
+    '''
+    Return a text listing of the DAG, one job per line
+    '''
+
+    lines = []
+    for node in nodes:
+        if node['parents']:
+            after = 'afterok:' + ','.join(node['parents'])
+        else:
+            after = '-'
+        lines.append('{name:>6} {kind:4} member {member:3} g{grid:>5}m  {after:16} {script}'.format(after=after, **node))
+
+    return '\n'.join(lines)
+
+
+def write_dot(nodes, filename):
+    '''
+    Write the DAG as a Graphviz dot file, e.g. for 'dot -Tpdf'
+    '''
+
+    with open(filename, 'w') as f:
+        f.write('digraph chain {\n')
+        f.write('  rankdir=LR;\n')
+        for node in nodes:
+            shape = 'box' if node['kind'] in ('run',) else 'ellipse'
+            f.write('  {name} [shape={shape}, label="{kind} {grid}m\\nmember {member}"];\n'.format(shape=shape, **node))
+        for node in nodes:
+            for parent in node['parents']:
+                f.write('  {} -> {};\n'.format(parent, node['name']))
+        f.write('}\n')
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# Copyright (C) 2015 Andy Aschwanden
+
+# Convert a PISM -extra_file (spatial time series) to compressed,
+# chunked NetCDF4/HDF5. Replaces 'ncks -O --64 ex_OUTFILE' in the post
+# scripts, which writes NetCDF3 without compression.
+#
+# Chunks of (time, y, x) variables are shaped so that reading a whole
+# map and reading the time series at one point touch about the same
+# number of chunks: with C values per chunk, nt records and nx * ny
+# points, ct = sqrt(nt * C / (nx * ny)) records by a square-ish tile of
+# C / ct points. Data are written in slabs of ct records, so every chunk
+# is compressed once.
+#
+# Example
+# -------
+# $ compress_extra.py ex_g1500m_hindcast_1989-2011.nc processed/ex_g1500m_hindcast_1989-2011.nc
+
+import time
+import numpy as np
+from argparse import ArgumentParser
+from netCDF4 import Dataset as CDF
+from postprocess import copy_attributes
+
+# target size of one chunk in bytes
+CHUNK_BYTES = 2 ** 20
+COMPLEVEL = 4
+SPATIAL_DIMS = ('x', 'y')
+
+
+def get_chunk_shape(dims, shape, itemsize, chunk_bytes=CHUNK_BYTES):
+    '''
+    Return the chunk shape of a variable with dimensions dims and shape
+    shape, balanced between map and point time series reads. Dimensions
+    other than time, x and y get chunks of 1.
+    '''
+
+    n = max(chunk_bytes // itemsize, 1)
+    sizes = dict(zip(dims, shape))
+    nt = sizes.get('time', 1)
+    points = 1
+    for dim in SPATIAL_DIMS:
+        points *= sizes.get(dim, 1)
+
+    if 'time' in sizes:
+        ct = int(np.clip(np.round(np.sqrt(float(nt) * n / points)), 1, max(nt, 1)))
+    else:
+        ct = 1
+    # square tiles, clipped to the grid
+    side = int(np.sqrt(float(n) / ct))
+    chunks = []
+    for dim, size in zip(dims, shape):
+        if dim in ('time',):
+            chunks.append(ct)
+        elif dim in SPATIAL_DIMS:
+            chunks.append(max(min(side, size), 1))
+        else:
+            chunks.append(1)
+
+    return tuple(chunks)
+
+
+def compress_file(infile, outfile, complevel=COMPLEVEL, shuffle=True, chunk_bytes=CHUNK_BYTES, format='NETCDF4'):
+    '''
+    Copy infile to outfile with deflate (complevel), shuffle and chunks
+    from get_chunk_shape
+    '''
+
+    nc_in = CDF(infile, 'r')
+    nc_out = CDF(outfile, 'w', format=format)
+
+    copy_attributes(nc_in, nc_out)
+    for name, dim in nc_in.dimensions.items():
+        nc_out.createDimension(name, None if dim.isunlimited() else len(dim))
+
+    chunk_records = {}
+    for name, var_in in nc_in.variables.items():
+        fill = getattr(var_in, '_FillValue', None)
+        if var_in.ndim > 0 and var_in.dtype.kind in ('f', 'i', 'u'):
+            chunks = get_chunk_shape(var_in.dimensions, var_in.shape, var_in.dtype.itemsize,
+                                     chunk_bytes=chunk_bytes)
+            var_out = nc_out.createVariable(name, var_in.dtype, var_in.dimensions, fill_value=fill,
+                                            zlib=complevel > 0, complevel=complevel, shuffle=shuffle,
+                                            chunksizes=chunks)
+            if 'time' in var_in.dimensions:
+                chunk_records[name] = chunks[var_in.dimensions.index('time')]
+        else:
+            var_out = nc_out.createVariable(name, var_in.dtype, var_in.dimensions, fill_value=fill)
+        copy_attributes(var_in, var_out)
+        # keep the raw values, fill values included
+        var_in.set_auto_maskandscale(False)
+        var_out.set_auto_maskandscale(False)
+
+    for name, var_in in nc_in.variables.items():
+        var_out = nc_out.variables[name]
+        if var_in.ndim == 0:
+            var_out.assignValue(var_in.getValue())
+        elif name not in chunk_records or var_in.ndim == 1:
+            var_out[:] = var_in[:]
+        else:
+            # write slabs of whole chunks along time
+            t_axis = var_in.dimensions.index('time')
+            nt = var_in.shape[t_axis]
+            step = chunk_records[name]
+            for start in range(0, nt, step):
+                index = [slice(None)] * var_in.ndim
+                index[t_axis] = slice(start, min(start + step, nt))
+                var_out[tuple(index)] = var_in[tuple(index)]
+
+    script_command = ' '.join([time.ctime(), ':', __file__.split('/')[-1], infile, outfile])
+    if hasattr(nc_in, 'history'):
+        nc_out.history = '\n'.join([script_command, nc_in.history])
+    else:
+        nc_out.history = script_command
+
+    nc_in.close()
+    nc_out.close()
+
+
+if __name__ == "__main__":
+
+    # Set up the option parser
+    parser = ArgumentParser()
+    parser.description = "Convert a PISM extra file to compressed, chunked NetCDF4."
+    parser.add_argument("FILE", nargs=2)
+    parser.add_argument("-L", "--complevel", dest="complevel", type=int,
+                        help="deflate level, 0 to disable. default={}".format(COMPLEVEL), default=COMPLEVEL)
+    parser.add_argument("--no_shuffle", dest="shuffle", action="store_false",
+                        help="do not apply the shuffle filter", default=True)
+    parser.add_argument("--chunk_bytes", dest="chunk_bytes", type=int,
+                        help="target chunk size in bytes. default={}".format(CHUNK_BYTES), default=CHUNK_BYTES)
+    parser.add_argument("-f", "--o_format", dest="oformat",
+                        choices=['NETCDF4', 'NETCDF4_CLASSIC'],
+                        help="output format. default=NETCDF4", default='NETCDF4')
+
+    options = parser.parse_args()
+    infile, outfile = options.FILE
+
+    compress_file(infile, outfile, complevel=options.complevel, shuffle=options.shuffle,
+                  chunk_bytes=options.chunk_bytes, format=options.oformat)
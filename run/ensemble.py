@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+# Copyright (C) 2015 Andy Aschwanden
+
+'''
+Ensemble generation engine.
+
+An ensemble is described by a parameter space, an OrderedDict mapping
+parameter names to the values to be sampled, and by a function that
+turns one parameter combination into a member. Combinations are
+expanded lazily and all run, post and submit scripts are written in a
+single pass.
+
+Example
+-------
+>>> space = OrderedDict()
+>>> space['calving_thk_threshold'] = [300, 400]
+>>> space['calving_k'] = [1e15, 1e18]
+>>> members = generate_ensemble(space, build_member, 'submit.sh', header)
+'''
+
+import os
+import itertools
+import subprocess
+import numpy as np
+from collections import OrderedDict
+from resources import *
+from manifest import record_members, get_job_ids
+
+try:
+    from netCDF3 import Dataset as CDF
+except:
+    from netCDF4 import Dataset as CDF
+
+
+def expand_parameter_space(space):
+    '''
+    Lazily expand a parameter space into OrderedDicts, one per
+    combination. Scalar values are treated as single-valued lists.
+    '''
+
+    names = list(space.keys())
+    values = [v if isinstance(v, (list, tuple)) else [v] for v in space.values()]
+    for combination in itertools.product(*values):
+        yield OrderedDict(zip(names, combination))
+
+
+def get_ensemble_size(space):
+    '''
+    Return the number of members of a parameter space
+    '''
+
+    size = 1
+    for v in space.values():
+        if isinstance(v, (list, tuple)):
+            size *= len(v)
+
+    return size
+
+
+def generate_experiment_name(prefix, name_options):
+    '''
+    Join prefix items and key/value pairs of name_options into an
+    experiment name, e.g. const_ctrl_v2_1985_sia_e_1.25_ppq_0.6
+    '''
+
+    return '_'.join(list(prefix) + ['_'.join([k, str(v)]) for k, v in name_options.items()])
+
+
+def make_run(params_dict, args, outfile, log='job.${PBS_JOBID}', run_script='./run_main.sh', extra_file=False):
+    '''
+    Return a dict describing one call of run_script within a member
+    '''
+
+    run = OrderedDict()
+    run['params'] = params_dict
+    run['args'] = args
+    run['outfile'] = outfile
+    run['log'] = log
+    run['run_script'] = run_script
+    run['extra_file'] = extra_file
+
+    return run
+
+
+def make_member(domain, grid, experiment, runs, out_dir, bed_data_set, prefix='do', fill='-2e9', post_method='python',
+                params=None):
+    '''
+    Return a dict describing an ensemble member, i.e. the runs written
+    to one job script and post-processed by one post script. params,
+    e.g. the name options, are recorded in the manifest.
+    '''
+
+    member = OrderedDict()
+    member['domain'] = domain.lower()
+    member['grid'] = grid
+    member['experiment'] = experiment
+    member['script'] = '{}_{}_g{}m_{}.sh'.format(prefix, domain.lower(), grid, experiment)
+    member['post'] = '{}_{}_g{}m_{}_post.sh'.format(prefix, domain.lower(), grid, experiment)
+    member['runs'] = runs
+    member['out_dir'] = out_dir
+    member['bed_data_set'] = bed_data_set
+    member['fill'] = fill
+    member['post_method'] = post_method
+    member['params'] = params if params is not None else OrderedDict()
+
+    return member
+
+
+def write_run_script(member, header, resume_after=None, then=None, timing=False):
+    '''
+    Write the job script of a member. If timing is True, each run is
+    timed and its output time stamped (see make_timing_functions).
+
+    If resume_after (seconds) is given, PISM is stopped with SIGTERM
+    after resume_after seconds and the script ends by calling resume.py,
+    which resubmits unfinished runs from their latest output, backup or
+    save file together with the member's post job. If then is given,
+    resume.py runs 'bash then JOBID' instead of submitting the post job.
+    '''
+
+    cmds = []
+    for run in member['runs']:
+        params = run['params']
+        if resume_after is not None and params.get('PISM_DO', '') in ('',):
+            params = OrderedDict(params)
+            params['PISM_DO'] = "'timeout -s TERM {}'".format(int(resume_after))
+        cmds.append(generate_run_command(params, run['args'], log=run['log'], run_script=run['run_script'],
+                                         timing=run['outfile'] if timing else None))
+    with open(member['script'], 'w') as f:
+        f.write(header)
+        if timing:
+            f.write(make_timing_functions(member['script']))
+        f.write('\n\n'.join(cmds))
+        f.write('\n')
+        if resume_after is not None:
+            if then is not None:
+                follow = '--then {}'.format(then)
+            else:
+                follow = '--post {}'.format(member['post'])
+            f.write('\npython resume.py --submit {follow} {script}\n'.format(follow=follow, script=member['script']))
+
+
+def write_post_script(member, timing=False):
+    '''
+    Write the post-processing script of a member, optionally timing
+    each post-processing step
+    '''
+
+    out_dir = member['out_dir']
+    with open(member['post'], 'w') as f:
+        f.write(make_post_header())
+        if timing:
+            f.write(make_timing_functions(member['post']))
+        f.write(' if [ ! -d {out_dir} ]; then mkdir -p {out_dir}; fi\n'.format(out_dir=out_dir))
+        f.write('\n')
+        for run in member['runs']:
+            f.write(generate_post_commands(run['outfile'], out_dir, member['grid'], member['bed_data_set'],
+                                           fill=member['fill'], extra_file=run['extra_file'],
+                                           method=member['post_method'], timing=timing))
+            f.write('\n')
+
+
+def write_manifest_line(f, script, manifest, jobid='${JOBID}'):
+    '''
+    Append a call storing the job ID of script in manifest
+    '''
+
+    f.write('python manifest.py -f {manifest} set {script} --job_id {jobid} --status submitted\n'.format(
+        manifest=manifest, script=script, jobid=jobid))
+
+
+def write_submit_lines(f, member, manifest=None):
+    '''
+    Append the qsub calls of a member to an open submit script
+    '''
+
+    f.write('JOBID=$(qsub {script})\n'.format(script=member['script']))
+    if manifest is not None:
+        write_manifest_line(f, member['script'], manifest)
+    f.write('qsub -W depend=afterok:${{JOBID}} {post}\n'.format(post=member['post']))
+
+
+def size_member(member, model, system, queue, cores_choices=None):
+    '''
+    Set the cores and walltime of a member suggested by a sizing model
+    (see job_sizing.suggest_member_size), pass the cores on to its runs
+    and return the PBS header of its job script
+    '''
+
+    from job_sizing import suggest_member_size
+
+    cores, walltime = suggest_member_size(model, member, cores_choices=cores_choices)
+    member['cores'] = cores
+    member['walltime'] = walltime
+    for run in member['runs']:
+        run['args'] = [cores] + list(run['args'][1:])
+
+    return make_pbs_header(system, cores, walltime, queue)
+
+
+def generate_members(space, build_member):
+    '''
+    Lazily generate members from a parameter space. build_member is
+    called with an OrderedDict of parameter values and returns a member
+    as returned by make_member.
+    '''
+
+    for n, combination in enumerate(expand_parameter_space(space)):
+        member = build_member(combination)
+        member['id'] = n
+        member['combination'] = combination
+        yield member
+
+
+def is_valid_output(filename):
+    '''
+    Quick integrity check of a netCDF file: it exists, can be opened
+    and, if it has a time axis, holds at least one finite time record
+    '''
+
+    if not os.path.isfile(filename) or os.path.getsize(filename) == 0:
+        return False
+    try:
+        nc = CDF(filename, 'r')
+    except (IOError, OSError, RuntimeError):
+        return False
+    try:
+        if 'time' in nc.variables:
+            time = nc.variables['time']
+            valid = len(time) > 0 and bool(np.isfinite(time[-1]))
+        else:
+            valid = len(nc.variables) > 0
+    except (IOError, OSError, RuntimeError, IndexError):
+        valid = False
+    nc.close()
+
+    return valid
+
+
+def is_finished_run(run):
+    '''
+    Return True if the output of run is valid and reaches the end time
+    the run asked for. A run killed at walltime or by an error may leave
+    a valid but truncated output (see resume.is_complete).
+    '''
+
+    from resume import is_run_complete
+
+    return is_valid_output(run['outfile']) and is_run_complete(run)
+
+
+def get_queued_jobs():
+    '''
+    Return the set of job IDs (without server name) known to qstat,
+    or an empty set if qstat is not available
+    '''
+
+    try:
+        output = subprocess.check_output(['qstat'], stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return set()
+    jobs = set()
+    for line in output.decode('utf-8', 'replace').splitlines():
+        fields = line.split()
+        if fields and fields[0][0].isdigit():
+            jobs.add(fields[0].split('.')[0])
+
+    return jobs
+
+
+def get_member_state(member, queued=None, job_ids=None):
+    '''
+    Return the state of a member from its outputs and job status:
+    'done' if all runs finished (see is_finished_run) and all
+    post-processed files are valid, 'post' if only the post-processed
+    files are missing, 'queued' if its job (as
+    recorded in job_ids, script -> job ID) is still known to the
+    scheduler, and 'missing' otherwise
+    '''
+
+    outfiles = [run['outfile'] for run in member['runs']]
+    if all([is_finished_run(run) for run in member['runs']]):
+        processed = [os.path.join(member['out_dir'], outfile) for outfile in outfiles]
+        if all([is_valid_output(filename) for filename in processed]):
+            return 'done'
+        return 'post'
+    if queued and job_ids:
+        job_id = job_ids.get(member['script'])
+        if job_id is not None and str(job_id).split('.')[0] in queued:
+            return 'queued'
+
+    return 'missing'
+
+
+def generate_ensemble(space, build_member, submit, header, post=True, backend=None, manifest=None,
+                      incremental=False, resume_after=None, timing=False, post_batch=None, sizing_model=None,
+                      system=None, queue=None):
+    '''
+    Write run, post and submit scripts for all members of a parameter
+    space in one pass and return the list of members.
+
+    Members whose job script name was already written (e.g. because
+    a parameter does not enter the experiment name) are skipped.
+
+    By default the submit script queues one job and one dependent post
+    job per member. backend(submit, members, post=post), e.g. from
+    submit.make_array_backend, writes the submit script instead.
+
+    If manifest is given, members are recorded in that manifest database
+    (see manifest.py) and the serial submit script stores their job IDs.
+
+    If incremental is True, only members that are missing or failed are
+    written and submitted (see get_member_state): finished members are
+    skipped, members whose job is still queued are left alone and
+    members lacking only the post-processed files get a post job.
+
+    If resume_after (seconds) is given, runs are split into chunks of
+    that wall-clock length that resubmit themselves (see
+    write_run_script and resume.py).
+
+    If timing is True, job and post scripts write stage timing records
+    (see stage_timing.py).
+
+    If post and post_batch (number of cores) are given, the serial
+    submit script queues one post job running the post scripts of all members on one
+    node once all runs have ended (see submit.write_batch_post and
+    post_batch.py) instead of one post job per member.
+
+    If sizing_model (a file written by job_sizing.py) is given, the
+    cores and walltime of each member are suggested from its grid,
+    stress balance and model years (see size_member), and its job
+    script gets its own header for system and queue instead of header.
+    resume_after then follows the walltime of each member.
+    '''
+
+    model = None
+    cores_choices = None
+    if sizing_model is not None:
+        from job_sizing import load_model, get_cores_choices
+        model = load_model(sizing_model)
+        cores_choices = get_cores_choices(system, queue)
+
+    queued = set()
+    job_ids = {}
+    if incremental:
+        queued = get_queued_jobs()
+        if manifest is not None and os.path.isfile(manifest):
+            job_ids = get_job_ids(manifest)
+
+    members = []
+    post_members = []
+    done = []
+    states = OrderedDict([('missing', 0), ('post', 0), ('queued', 0), ('done', 0)])
+    seen = set()
+    f = None
+    if backend is None:
+        f = open(submit, 'w')
+        f.write('#!/bin/bash\n')
+    for member in generate_members(space, build_member):
+        if member['script'] in seen:
+            continue
+        seen.add(member['script'])
+        if incremental:
+            state = get_member_state(member, queued=queued, job_ids=job_ids)
+            states[state] += 1
+            if state in ('done',):
+                done.append(member)
+                continue
+            elif state in ('queued',):
+                continue
+            elif state in ('post',) and post:
+                write_post_script(member, timing=timing)
+                post_members.append(member)
+                continue
+        member_header = header
+        member_resume_after = resume_after
+        if model is not None:
+            member_header = size_member(member, model, system, queue, cores_choices=cores_choices)
+            print('{}: {} cores, walltime {}'.format(member['script'], member['cores'], member['walltime']))
+            if resume_after is not None:
+                member_resume_after = get_resume_after(member['walltime'])
+        write_run_script(member, member_header, resume_after=member_resume_after, timing=timing)
+        if post:
+            write_post_script(member, timing=timing)
+        if f is not None:
+            if post and post_batch:
+                f.write('JOBID=$(qsub {script})\n'.format(script=member['script']))
+                f.write('JOBIDS="$JOBIDS:$JOBID"\n')
+                if manifest is not None:
+                    write_manifest_line(f, member['script'], manifest)
+            elif post:
+                write_submit_lines(f, member, manifest=manifest)
+            else:
+                f.write('JOBID=$(qsub {script})\n'.format(script=member['script']))
+                if manifest is not None:
+                    write_manifest_line(f, member['script'], manifest)
+        members.append(member)
+    if f is None:
+        backend(submit, members, post=post)
+        f = open(submit, 'a')
+    if post_batch and backend is None and (members or post_members):
+        from submit import write_batch_post
+        batch = write_batch_post(os.path.splitext(submit)[0], [m['post'] for m in members + post_members],
+                                 cores=post_batch)
+        depend = '-W depend=afterany$JOBIDS ' if members else ''
+        f.write('qsub {depend}{batch}\n'.format(depend=depend, batch=batch))
+    else:
+        for member in post_members:
+            f.write('qsub {post}\n'.format(post=member['post']))
+    f.close()
+
+    if manifest is not None:
+        record_members(manifest, members)
+        record_members(manifest, post_members, status='post')
+        record_members(manifest, done, status='done')
+    if incremental:
+        print(', '.join(['{} {}'.format(n, state) for state, n in states.items()]))
+
+    return members
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# Copyright (C) 2015 Andy Aschwanden
+
+# Node-local shared store of large 2D fields (boot file thk/topg,
+# observed velocity mosaics). A loader writes each field once as a .npy
+# file to STORE_DIR, by default in /dev/shm, i.e. RAM. Analysis workers
+# attach with np.load(mmap_mode='r'): all processes map the same pages,
+# so a field costs its size once per node, not once per worker, and
+# attaching takes no time. Entries are keyed by the quick checksum of
+# the source file (see obs_cache.file_checksum: size, mtime, inode and
+# the first and last MiB) and the variable, so a file that is replaced
+# or rewritten in place gets a new entry.
+#
+# Example
+# -------
+# $ field_store.py load pism_Greenland_150m_mcb_jpl_v2_ctrl.nc:thk,topg surf_vels_150m.nc:velsurf_mag
+# $ makehist_speed.py --field_store /dev/shm/pism_fields --boot_file ... --obs_file ... g150m_*.nc
+# $ field_store.py list
+# $ field_store.py clear
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+from argparse import ArgumentParser
+
+from obs_cache import file_checksum, read_field
+
+if os.path.isdir('/dev/shm'):
+    STORE_DIR = '/dev/shm/pism_fields'
+else:
+    STORE_DIR = os.path.join(tempfile.gettempdir(), 'pism_fields')
+
+
+def get_field_key(filename, variable):
+    '''
+    Return the store key of variable in filename
+    '''
+
+    sha = hashlib.sha1()
+    sha.update(file_checksum(filename).encode('utf-8'))
+    sha.update(variable.encode('utf-8'))
+
+    return sha.hexdigest()
+
+
+def store_field(filename, variable, store_dir=STORE_DIR):
+    '''
+    Read the last time record of variable in filename (see
+    obs_cache.read_field) and write it to store_dir. Returns the key.
+    '''
+
+    key = get_field_key(filename, variable)
+    path = os.path.join(store_dir, key)
+    if os.path.isfile(path + '.npy'):
+        return key
+
+    try:
+        os.makedirs(store_dir)
+    except OSError:
+        pass
+    values, units = read_field(filename, variable)
+    tmp = '{}.tmp{}'.format(path, os.getpid())
+    np.save(tmp + '.npy', values)
+    meta = {'file': os.path.abspath(filename), 'variable': variable, 'units': units,
+            'shape': list(values.shape), 'dtype': str(values.dtype)}
+    with open(tmp + '.json', 'w') as f:
+        json.dump(meta, f)
+    # the .npy is renamed last: its presence marks a complete entry
+    os.rename(tmp + '.json', path + '.json')
+    os.rename(tmp + '.npy', path + '.npy')
+
+    return key
+
+
+def attach_field(filename, variable, store_dir=STORE_DIR, load=True):
+    '''
+    Return variable in filename as a read-only array mapped from
+    store_dir, and its units. If the field is not in the store, it is
+    stored first (load=True) or KeyError is raised.
+    '''
+
+    key = get_field_key(filename, variable)
+    path = os.path.join(store_dir, key)
+    if not os.path.isfile(path + '.npy'):
+        if not load:
+            raise KeyError('{}:{} is not in {}'.format(filename, variable, store_dir))
+        store_field(filename, variable, store_dir=store_dir)
+    with open(path + '.json', 'r') as f:
+        units = json.load(f)['units']
+
+    return np.load(path + '.npy', mmap_mode='r'), units
+
+
+def list_fields(store_dir=STORE_DIR):
+    '''
+    Return the meta data of all fields in store_dir, with their key and
+    size in bytes
+    '''
+
+    fields = []
+    if not os.path.isdir(store_dir):
+        return fields
+    for name in sorted(os.listdir(store_dir)):
+        if not name.endswith('.npy') or '.tmp' in name:
+            continue
+        key = name[:-len('.npy')]
+        with open(os.path.join(store_dir, key + '.json'), 'r') as f:
+            meta = json.load(f)
+        meta['key'] = key
+        meta['size'] = os.path.getsize(os.path.join(store_dir, name))
+        fields.append(meta)
+
+    return fields
+
+
+def parse_sources(sources):
+    '''
+    Return a list of (file, variable) from 'FILE:VAR1,VAR2' strings
+    '''
+
+    fields = []
+    for source in sources:
+        filename, variables = source.rsplit(':', 1)
+        fields.extend([(filename, variable) for variable in variables.split(',')])
+
+    return fields
+
+
+if __name__ == "__main__":
+
+    # set up the option parser
+    parser = ArgumentParser()
+    parser.description = "Load large fields once into node-local shared memory."
+    parser.add_argument("-d", "--store_dir", dest="store_dir",
+                        help="store directory. default={}".format(STORE_DIR), default=STORE_DIR)
+    subparsers = parser.add_subparsers(dest="command")
+
+    load_parser = subparsers.add_parser("load", help="store fields")
+    load_parser.add_argument("SOURCE", nargs='+',
+                             help="FILE:VAR1,VAR2, e.g. pism_Greenland_450m_mcb_jpl_v2_ctrl.nc:thk,topg")
+    subparsers.add_parser("list", help="list stored fields")
+    subparsers.add_parser("clear", help="remove the store")
+
+    options = parser.parse_args()
+
+    if options.command in ('load',):
+        for filename, variable in parse_sources(options.SOURCE):
+            key = store_field(filename, variable, store_dir=options.store_dir)
+            print('{}:{} -> {}'.format(filename, variable, os.path.join(options.store_dir, key + '.npy')))
+    elif options.command in ('list',):
+        fields = list_fields(options.store_dir)
+        for meta in fields:
+            print('{:8.1f} MB  {}:{}  {}'.format(meta['size'] / 1024. ** 2, meta['file'], meta['variable'],
+                                                 tuple(meta['shape'])))
+        print('{} fields, {:.1f} MB in {}'.format(len(fields), sum([m['size'] for m in fields]) / 1024. ** 2,
+                                                   options.store_dir))
+    elif options.command in ('clear',):
+        if os.path.isdir(options.store_dir):
+            shutil.rmtree(options.store_dir)
+    else:
+        parser.print_help()
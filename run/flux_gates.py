@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+# Copyright (C) 2015 Andy Aschwanden
+
+# Ice discharge through flux gates for many runs at once. Each gate line
+# is sampled every SPACING grid cells, and the bilinear interpolation
+# weights of the samples times the gate normal and segment length are
+# folded into one coefficient matrix per flux component, so that
+#
+#     Q[gate, time] = Cu[gate, cell] . uflux[cell, time]
+#                   + Cv[gate, cell] . vflux[cell, time]
+#
+# is a single matrix product over all time records. The matrices are
+# cached in CACHE_DIR, keyed by the grid and the gate file. Only the
+# bounding box of the cells touched by the gates is read from each file.
+# Discharge is positive to the right of a gate's direction of
+# digitization and reported in Gt/yr. uflux/vflux are used if present,
+# else ubar * thk and vbar * thk.
+#
+# Example
+# -------
+# $ flux_gates.py -s greenland-flux-gates-250m.shp -n 8 -o discharge.csv 'processed/ex_g1500m_*.nc'
+# $ flux_gates.py --gate 'jak,-190000,-2285000,-190000,-2265000' g1500m_out.nc
+
+import os
+import sys
+import glob
+import json
+import hashlib
+import numpy as np
+from collections import OrderedDict
+from multiprocessing import Pool
+from argparse import ArgumentParser
+
+try:
+    from netCDF3 import Dataset as CDF
+except:
+    from netCDF4 import Dataset as CDF
+from postprocess import get_permutation
+from site_series import write_table
+
+CACHE_DIR = '.gate_cache'
+# samples per grid cell along a gate
+SPACING = 0.5
+ICE_DENSITY = 910.          # kg m-3
+# m3 -> Gt
+GT_PER_M3 = ICE_DENSITY / 1e12
+
+
+def parse_gate(gate):
+    '''
+    Return (name, vertices) from 'name,x0,y0,x1,y1[,x2,y2...]'
+    '''
+
+    fields = gate.split(',')
+    vertices = np.array([float(v) for v in fields[1:]]).reshape(-1, 2)
+
+    return fields[0], vertices
+
+
+def read_gates(filename, name_field='name'):
+    '''
+    Return an OrderedDict gate name -> (N, 2) array of vertices in
+    EPSG:3413 of the line features of a shapefile
+    '''
+
+    from osgeo import ogr, osr
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(3413)
+    ds = ogr.Open(filename)
+    if ds is None:
+        raise IOError('could not open {}'.format(filename))
+    layer = ds.GetLayer()
+    transform = osr.CoordinateTransformation(layer.GetSpatialRef(), srs)
+    gates = OrderedDict()
+    for feature in layer:
+        geometry = feature.GetGeometryRef().Clone()
+        geometry.Transform(transform)
+        if feature.GetFieldIndex(name_field) >= 0 and feature.GetField(name_field):
+            name = str(feature.GetField(name_field))
+        else:
+            name = 'gate_{}'.format(feature.GetFID())
+        gates[name] = np.array(geometry.GetPoints())[:, 0:2]
+    ds = None
+
+    return gates
+
+
+def sample_gate(vertices, step):
+    '''
+    Return sample points (N, 2), unit normals (N, 2) and segment lengths
+    (N,) of a gate line sampled every step meters. Normals point to the
+    right of the direction of digitization.
+    '''
+
+    points, normals, lengths = [], [], []
+    for p0, p1 in zip(vertices[:-1], vertices[1:]):
+        d = p1 - p0
+        length = np.hypot(d[0], d[1])
+        if length == 0:
+            continue
+        n = max(int(np.ceil(length / step)), 1)
+        # midpoints of n equal pieces
+        s = (np.arange(n) + 0.5) / n
+        points.append(p0 + s[:, np.newaxis] * d)
+        normals.append(np.tile([d[1] / length, -d[0] / length], (n, 1)))
+        lengths.append(np.repeat(length / n, n))
+
+    return np.vstack(points), np.vstack(normals), np.concatenate(lengths)
+
+
+def bilinear_weights(x, y, points):
+    '''
+    Return flat (y, x) cell indices (N, 4) and bilinear weights (N, 4) of
+    points on the grid x, y. Points outside the grid get zero weights.
+    '''
+
+    nx, ny = len(x), len(y)
+    fi = (points[:, 0] - x[0]) / (x[1] - x[0])
+    fj = (points[:, 1] - y[0]) / (y[1] - y[0])
+    inside = (fi >= 0) & (fi <= nx - 1) & (fj >= 0) & (fj <= ny - 1)
+    i0 = np.clip(np.floor(fi).astype(int), 0, nx - 2)
+    j0 = np.clip(np.floor(fj).astype(int), 0, ny - 2)
+    a = np.clip(fi - i0, 0, 1)
+    b = np.clip(fj - j0, 0, 1)
+
+    idx = np.column_stack([j0 * nx + i0, j0 * nx + i0 + 1, (j0 + 1) * nx + i0, (j0 + 1) * nx + i0 + 1])
+    weights = np.column_stack([(1 - a) * (1 - b), a * (1 - b), (1 - a) * b, a * b])
+    weights[~inside] = 0.
+
+    return idx, weights
+
+
+def build_gate_weights(x, y, gates, spacing=SPACING):
+    '''
+    Return a dict with the gate coefficient matrices 'cu', 'cv' (gates x
+    cells), the flat (y, x) indices 'cells' of the cells they touch, the
+    bounding box 'box' (i0, i1, j0, j1) of these cells and the 'gates'
+    names. Gates entirely outside the grid get zero coefficients.
+    '''
+
+    step = spacing * min(abs(x[1] - x[0]), abs(y[1] - y[0]))
+    samples = []
+    for name, vertices in gates.items():
+        points, normals, lengths = sample_gate(vertices, step)
+        idx, weights = bilinear_weights(x, y, points)
+        samples.append((idx, weights, normals, lengths))
+
+    cells = np.unique(np.concatenate([s[0][s[1] > 0] for s in samples] + [np.zeros(0, dtype=int)]))
+    if len(cells) == 0:
+        cells = np.zeros(1, dtype=int)
+    nx = len(x)
+    jj, ii = cells // nx, cells % nx
+    box = np.array([ii.min(), ii.max() + 1, jj.min(), jj.max() + 1])
+    box_nx = box[1] - box[0]
+    box_cells = (jj - box[2]) * box_nx + (ii - box[0])
+
+    cu = np.zeros((len(gates), len(cells)))
+    cv = np.zeros((len(gates), len(cells)))
+    for k, (idx, weights, normals, lengths) in enumerate(samples):
+        columns = np.searchsorted(cells, idx)
+        columns = np.clip(columns, 0, len(cells) - 1)
+        wu = weights * (normals[:, 0] * lengths)[:, np.newaxis]
+        wv = weights * (normals[:, 1] * lengths)[:, np.newaxis]
+        np.add.at(cu[k], columns.ravel(), np.where(weights > 0, wu, 0.).ravel())
+        np.add.at(cv[k], columns.ravel(), np.where(weights > 0, wv, 0.).ravel())
+
+    weights = {}
+    weights['cu'] = cu
+    weights['cv'] = cv
+    weights['cells'] = box_cells
+    weights['box'] = box
+    weights['gates'] = np.array(list(gates.keys()), dtype='U')
+
+    return weights
+
+
+def get_cache_key(x, y, gates, spacing):
+    '''
+    Return the cache key of gate weights on the grid x, y
+    '''
+
+    sha = hashlib.sha1()
+    sha.update(np.asarray(x, dtype='float64').tobytes())
+    sha.update(np.asarray(y, dtype='float64').tobytes())
+    for name, vertices in gates.items():
+        sha.update(name.encode('utf-8'))
+        sha.update(np.asarray(vertices, dtype='float64').tobytes())
+    sha.update(json.dumps(float(spacing)).encode('utf-8'))
+
+    return sha.hexdigest()
+
+
+def load_gate_weights(x, y, gates, spacing=SPACING, cache_dir=CACHE_DIR):
+    '''
+    Return the gate weights (see build_gate_weights) of the grid x, y
+    from cache_dir, building and caching them on a miss
+    '''
+
+    if cache_dir is None:
+        return build_gate_weights(x, y, gates, spacing=spacing)
+
+    filename = os.path.join(cache_dir, get_cache_key(x, y, gates, spacing) + '.npz')
+    if os.path.isfile(filename):
+        data = np.load(filename)
+        return dict([(name, data[name]) for name in data.files])
+
+    weights = build_gate_weights(x, y, gates, spacing=spacing)
+    try:
+        os.makedirs(cache_dir)
+    except OSError:
+        pass
+    tmp = '{}.tmp{}.npz'.format(filename[:-len('.npz')], os.getpid())
+    np.savez(tmp, **weights)
+    os.rename(tmp, filename)
+
+    return weights
+
+
+def read_box(nc, name, box, start=None, end=None):
+    '''
+    Return variable name in box (i0, i1, j0, j1) as a (time, cells)
+    array of floats, with missing values set to 0
+    '''
+
+    var = nc.variables[name]
+    dims = var.dimensions
+    ranges = {'x': slice(box[0], box[1]), 'y': slice(box[2], box[3]), 'time': slice(start, end)}
+    index = [ranges.get(dim, 0) for dim in dims]
+    kept = [dim for dim in dims if dim in ranges]
+    values = np.transpose(var[tuple(index)], get_permutation(kept, [d for d in ('time', 'y', 'x') if d in kept]))
+    values = np.ma.filled(np.ma.masked_invalid(np.ma.asarray(values, dtype='float64')), 0.)
+    if 'time' not in kept:
+        values = values[np.newaxis]
+
+    return values.reshape(values.shape[0], -1)
+
+
+def compute_discharge(filename, gates, spacing=SPACING, cache_dir=CACHE_DIR, chunk=120):
+    '''
+    Return an OrderedDict column -> array (gate, time, discharge in
+    Gt/yr) of all gates and time records of filename
+    '''
+
+    nc = CDF(filename, 'r')
+    weights = load_gate_weights(nc.variables['x'][:], nc.variables['y'][:], gates,
+                                spacing=spacing, cache_dir=cache_dir)
+    box, cells = weights['box'], weights['cells']
+    if 'time' in nc.variables:
+        t = np.asarray(nc.variables['time'][:], dtype='float64')
+    else:
+        t = np.zeros(1)
+    nt = len(t)
+
+    q = np.zeros((len(weights['gates']), nt))
+    for start in range(0, nt, chunk):
+        end = min(start + chunk, nt)
+        if 'uflux' in nc.variables and 'vflux' in nc.variables:
+            uflux = read_box(nc, 'uflux', box, start, end)[:, cells]
+            vflux = read_box(nc, 'vflux', box, start, end)[:, cells]
+        else:
+            thk = read_box(nc, 'thk', box, start, end)[:, cells]
+            uflux = read_box(nc, 'ubar', box, start, end)[:, cells] * thk
+            vflux = read_box(nc, 'vbar', box, start, end)[:, cells] * thk
+        q[:, start:end] = np.dot(weights['cu'], uflux.T) + np.dot(weights['cv'], vflux.T)
+    nc.close()
+
+    columns = OrderedDict()
+    columns['gate'] = np.repeat(weights['gates'], nt)
+    columns['time'] = np.tile(t, len(weights['gates']))
+    columns['discharge'] = q.ravel() * GT_PER_M3
+
+    return columns
+
+
+def _discharge(args):
+    filename, gates, spacing, cache_dir = args
+    try:
+        return filename, compute_discharge(filename, gates, spacing=spacing, cache_dir=cache_dir)
+    except (IOError, RuntimeError, KeyError) as e:
+        print('could not read {}: {}'.format(filename, e))
+        return filename, None
+
+
+def compute_members(filenames, gates, n_procs=1, spacing=SPACING, cache_dir=CACHE_DIR):
+    '''
+    Return the discharge table (member, gate, time, discharge) of all
+    files, computed by n_procs processes
+    '''
+
+    # build the weights of the first file's grid once, before forking
+    if filenames and cache_dir is not None:
+        nc = CDF(filenames[0], 'r')
+        load_gate_weights(nc.variables['x'][:], nc.variables['y'][:], gates, spacing=spacing, cache_dir=cache_dir)
+        nc.close()
+
+    args = [(filename, gates, spacing, cache_dir) for filename in filenames]
+    if n_procs > 1 and len(filenames) > 1:
+        pool = Pool(min(n_procs, len(filenames)))
+        results = pool.map(_discharge, args)
+        pool.close()
+        pool.join()
+    else:
+        results = [_discharge(a) for a in args]
+
+    table = OrderedDict([('member', [])])
+    for filename, columns in results:
+        if columns is None:
+            continue
+        table['member'].append(np.repeat(np.array([filename], dtype='U'), len(columns['time'])))
+        for name, values in columns.items():
+            table.setdefault(name, []).append(values)
+
+    return OrderedDict([(name, np.concatenate(values)) for name, values in table.items() if values])
+
+
+if __name__ == "__main__":
+
+    # set up the option parser
+    parser = ArgumentParser()
+    parser.description = "Compute ice discharge through flux gates for many runs."
+    parser.add_argument("FILE", nargs='+',
+                        help="PISM output or extra files, or globs")
+    parser.add_argument("-s", "--shape_file", dest="shape_file",
+                        help="flux gate lines", default=None)
+    parser.add_argument("--name_field", dest="name_field",
+                        help="attribute holding the gate name. default=name", default='name')
+    parser.add_argument("--gate", dest="gates", action="append",
+                        help="additional gate 'name,x0,y0,x1,y1[,...]' in EPSG:3413 (m), may be repeated",
+                        default=[])
+    parser.add_argument("--spacing", dest="spacing", type=float,
+                        help="gate sample spacing in grid cells. default={}".format(SPACING), default=SPACING)
+    parser.add_argument("--cache_dir", dest="cache_dir",
+                        help="weights cache directory. default={}".format(CACHE_DIR), default=CACHE_DIR)
+    parser.add_argument("-n", '--n_procs', dest="n", type=int,
+                        help='''number of processes. default=1.''', default=1)
+    parser.add_argument("-o", "--output", dest="output",
+                        help="output table (.npz or .csv). default=discharge.csv", default='discharge.csv')
+
+    options = parser.parse_args()
+
+    gates = OrderedDict()
+    if options.shape_file is not None:
+        gates.update(read_gates(options.shape_file, name_field=options.name_field))
+    gates.update([parse_gate(gate) for gate in options.gates])
+    if not gates:
+        print('no gates given, use --shape_file or --gate')
+        sys.exit(1)
+
+    filenames = []
+    for pattern in options.FILE:
+        filenames.extend(sorted(glob.glob(pattern)))
+
+    table = compute_members(filenames, gates, n_procs=options.n, spacing=options.spacing,
+                            cache_dir=options.cache_dir)
+    write_table(table, options.output)
+    print('wrote discharge of {} gates from {} files to {}'.format(len(gates), len(filenames), options.output))
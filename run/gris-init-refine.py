@@ -1,11 +1,14 @@
 #!/usr/bin/env python
 # Copyright (C) 2015 Andy Aschwanden
 
-import itertools
 from collections import OrderedDict
 import os
 from argparse import ArgumentParser
 from resources import *
+from ensemble import *
+from manifest import MANIFEST
+from chain import *
+from job_sizing import load_model, suggest_job_size, get_cores_choices
 
 grid_choices = [9000, 4500, 3600, 1800, 1500, 1200, 900, 600, 450, 300, 150]
 
@@ -32,7 +35,24 @@ parser.add_argument("-f", "--o_format", dest="oformat",
                     help="output format", default='netcdf4_parallel')
 parser.add_argument("-g", "--grid", dest="grid", type=int,
                     choices=grid_choices,
-                    help="horizontal grid resolution", default=9000)
+                    help="horizontal grid resolution of the last stage of the chain", default=9000)
+parser.add_argument("--start_grid", dest="start_grid", type=int,
+                    choices=grid_choices,
+                    help="horizontal grid resolution of the first stage of the chain", default=9000)
+parser.add_argument("--incremental", dest="incremental", action="store_true",
+                    help="only generate and submit members that are missing or failed", default=False)
+parser.add_argument("--resume", dest="resume", action="store_true",
+                    help="stop PISM before the walltime and resubmit unfinished runs from their latest backup (see resume.py)", default=False)
+parser.add_argument("--no_timing", dest="timing", action="store_false",
+                    help="do not add stage timers to job and post scripts (see stage_timing.py)", default=True)
+parser.add_argument("--manifest", dest="manifest",
+                    help="manifest database recording all members. default={}".format(MANIFEST), default=MANIFEST)
+parser.add_argument("--no_manifest", dest="manifest", action="store_const", const=None,
+                    help="do not record members in a manifest")
+parser.add_argument("--sizing_model", dest="sizing_model",
+                    help="sizing model (see job_sizing.py) choosing the number of cores and walltime of each grid instead of -n and -w", default=None)
+parser.add_argument("--dag", dest="dag", action="store_true",
+                    help="print the job DAG", default=False)
 parser.add_argument("--o_size", dest="osize",
                     choices=['small', 'medium', 'big', '2dbig'],
                     help="output size type", default='2dbig')
@@ -54,6 +74,7 @@ parser.add_argument("--dataset_version", dest="version",
 
 
 options = parser.parse_args()
+manifest = options.manifest
 
 nn = options.n
 oformat = options.oformat
@@ -66,6 +87,7 @@ calving = options.calving
 climate = options.climate
 forcing_type = options.forcing_type
 grid = options.grid
+start_grid = options.start_grid
 bed_type = options.bed_type
 stress_balance = options.stress_balance
 version = options.version
@@ -79,8 +101,14 @@ grid_mapping = OrderedDict(zip(grid_choices, grid_nos))
 save_times = [-125000, -25000, -5000, -1500, -1000, -500, -200, -100]
 grid_start_times = OrderedDict(zip(grid_choices, save_times))
 
+grids = get_chain_grids(grid_choices, start_grid, grid)
+for g in grids:
+    if g not in grid_start_times:
+        print('No save time for grid {}, exiting'.format(g))
+        import sys
+        sys.exit(0)
+
 infile = ''
-pism_dataname = 'pism_Greenland_{}m_mcb_jpl_v{}_{}.nc'.format(grid, version, bed_type)
 
 
 # ########################################################
@@ -102,24 +130,52 @@ phi_min_values = [5.0]
 phi_max_values = [40.]
 topg_min_values = [-700]
 topg_max_values = [700]
-combinations = list(itertools.product(calving_thk_threshold_values, calving_k_values, phi_min_values, phi_max_values, topg_min_values, topg_max_values))
+
+space = OrderedDict()
+space['calving_thk_threshold'] = calving_thk_threshold_values
+space['calving_k'] = calving_k_values
+space['phi_min'] = phi_min_values
+space['phi_max'] = phi_max_values
+space['topg_min'] = topg_min_values
+space['topg_max'] = topg_max_values
 
 tsstep = 'yearly'
 exstep = 100
 regridvars = 'age,litho_temp,enthalpy,tillwat,bmelt,Href,thk'
 ftt_starttime = -5000
+end = 0
 
-scripts = []
-posts = []
+vversion = 'v' + str(version)
+bed_data_set = get_bed_data_set(vversion)
 
-start = grid_start_times[grid]
-end = 0
+# cores and walltime of each stage
+job_sizes = OrderedDict()
+for g in grids:
+    if options.sizing_model is not None:
+        job_sizes[g] = suggest_job_size(load_model(options.sizing_model), g, end - grid_start_times[g],
+                                        stress_balance=stress_balance, hydrology=hydro,
+                                        cores_choices=get_cores_choices(system, queue))
+        print('sizing model: g{}m {} cores, walltime {}'.format(g, *job_sizes[g]))
+    else:
+        job_sizes[g] = (nn, walltime)
+
+
+def get_stage_header(grid):
+
+    return make_pbs_header(system, job_sizes[grid][0], job_sizes[grid][1], queue)
+
+
+def get_stage_resume_after(grid):
 
-for n, combination in enumerate(combinations):
+    return get_resume_after(job_sizes[grid][1])
 
-    calving_thk_threshold, calving_k , phi_min, phi_max, topg_min, topg_max = combination
 
-    ttphi = '{},{},{},{}'.format(phi_min, phi_max, topg_min, topg_max)
+def build_stage(combination, grid, parent):
+
+    calving_thk_threshold = combination['calving_thk_threshold']
+    calving_k = combination['calving_k']
+    ttphi = '{},{},{},{}'.format(combination['phi_min'], combination['phi_max'],
+                                 combination['topg_min'], combination['topg_max'])
 
     name_options = OrderedDict()
     name_options['sia_e'] = sia_e
@@ -127,162 +183,104 @@ for n, combination in enumerate(combinations):
     name_options['tefo'] = tefo
     name_options['ssa_n'] = ssa_n
     name_options['ssa_e'] = ssa_e
-    name_options['phi_min'] = phi_min
-    name_options['phi_max'] = phi_max
-    name_options['topg_min'] = topg_min
-    name_options['topg_max'] = topg_max
+    name_options['phi_min'] = combination['phi_min']
+    name_options['phi_max'] = combination['phi_max']
+    name_options['topg_min'] = combination['topg_min']
+    name_options['topg_max'] = combination['topg_max']
     name_options['calving'] = calving
     if calving in ('eigen_calving'):
         name_options['calving_k'] = calving
         name_options['calving_thk_threshold'] = calving
     name_options['forcing_type'] = forcing_type
-    
-    vversion = 'v' + str(version)
-    experiment =  '_'.join([climate, vversion, bed_type, '_'.join(['_'.join([k, str(v)]) for k, v in name_options.items()])])
-
-        
-    script = 'spinup_{}_g{}m_{}.sh'.format(domain.lower(), grid, experiment)
-    scripts.append(script)
-    post = 'spinup_{}_g{}m_{}_post.sh'.format(domain.lower(), grid, experiment)
-    posts.append(post)
-    
-    for filename in (script, post):
-        try:
-            os.remove(filename)
-        except OSError:
-            pass
-
-    pbs_header = make_pbs_header(system, nn, walltime, queue)
-        
-    
-    os.environ['PISM_EXPERIMENT'] = experiment
-    os.environ['PISM_TITLE'] = 'Greenland Paramter Study'
-    
-    with open(script, 'w') as f:
-
-        f.write(pbs_header)
-
-
-        outfile = '{domain}_g{grid}m_spinup_refine_{experiment}_0.nc'.format(domain=domain.lower(),grid=grid, experiment=experiment)
-        
-        dura = 10
-
-        general_params_dict = OrderedDict()
-        general_params_dict['o_format'] = oformat
-        general_params_dict['o_size'] = osize
-        
-        grid_params_dict = generate_grid_description(grid)
-
-        sb_params_dict = OrderedDict()
-        sb_params_dict['sia_e'] = sia_e
-        sb_params_dict['ssa_e'] = ssa_e
-        sb_params_dict['ssa_n'] = ssa_n
-        sb_params_dict['pseudo_plastic_q'] = ppq
-        sb_params_dict['till_effective_fraction_overburden'] = tefo
-        sb_params_dict['topg_to_phi'] = ttphi
-
-        stress_balance_params_dict = generate_stress_balance(stress_balance, sb_params_dict)
-        exvars = "climatic_mass_balance_cumulative,tempsurf,diffusivity,temppabase,bmeltvelsurf_mag,mask,thk,topg,usurf,taud_mag,velsurf,climatic_mass_balance,climatic_mass_balance_original,velbase_mag,tauc,taub_mag"
-        spatial_ts_dict = generate_spatial_ts(outfile, exvars, exstep, start=start, end=end)
-        scalar_ts_dict = generate_scalar_ts(outfile, tsstep, start=start, end=end)
-
-        all_params_dict = merge_dicts(general_params_dict, grid_params_dict, stress_balance_params_dict, spatial_ts_dict, scalar_ts_dict)
-        all_params = ' '.join([' '.join(['-' + k, str(v)]) for k, v in all_params_dict.items()])
-        
-        params_dict = OrderedDict()
-        if system in ('debug'):
-            params_dict['PISM_DO'] = 'echo'
-        else:
-            params_dict['PISM_DO'] = ''
-            
-        params_dict['PISM_EXEC'] = pism_exec
-        params_dict['PISM_PARAMS'] = '\'{}\''.format(all_params)
-        params_dict['PISM_SAVE'] = ','.join(str(e) for e in save_times[grid_mapping[grid]+1::])
-        params_dict['STARTEND'] = '{},{}'.format(start, end)
-
-        params_dict['PISM_DATANAME'] = pism_dataname
-        params_dict['PISM_SURFACE_BC_FILE'] = pism_surface_bcfile
-        params_dict['PISM_CONFIG'] = 'spinup_config.nc'
-        params_dict['TSSTEP'] = tsstep
-        params_dict['EXSTEP'] = exstep
-        if grid_mapping[grid] > 0:
-            previous_grid =  [k for k, v in grid_mapping.iteritems() if v == grid_mapping[grid] -1][0]
-            regridfile = 'save_{domain}_g{grid}m_spinup_{experiment}_{start}.000.nc'.format(domain=domain.lower(),grid=previous_grid, experiment=experiment, start=start)
-            params_dict['REGRIDVARS'] = regridvars
-            params_dict['REGRIDFILE'] = regridfile
-        params_dict['PARAM_NOAGE'] = ''
-        params_dict['PARAM_CALVING'] = calving
-        if calving in ('eigen_calving'):
-            params_dict['PARAM_CALVING_THK'] = calving_thk_threshold
-            params_dict['PARAM_CALVING_K'] = calving_k
-        if forcing_type in ('e_age', 'e_age_ftt'):
-            params_dict['PARAM_E_AGE_COUPLING'] = 'yes'
-        if forcing_type in ('ftt', 'e_age_ftt'):
-            params_dict['PARAM_FTT'] = 'yes'
-            params_dict['PARAM_FTT_STARTTIME'] = ftt_starttime
-            
-        
-        params = ' '.join(['='.join([k, str(v)]) for k, v in params_dict.items()])
-        
-        cmd = ' '.join([params, './run_main.sh', str(nn), climate, str(dura), hydro, outfile, infile, '2>&1 | tee job.${PBS_JOBID}'])
-
-        f.write(cmd)
-        f.write('\n')
-
-        if version in ('v2', 'v2_1985'):
-            mytype = "MO14 2015-04-27"
-        else:
-            import sys
-            print('TYPE {} not recognized, exiting'.format(version))
-            sys.exit(0)
+
+    experiment = generate_experiment_name([climate, vversion, bed_type], name_options)
+
+    start = grid_start_times[grid]
+    outfile = '{domain}_g{grid}m_spinup_refine_{experiment}_0.nc'.format(domain=domain.lower(),grid=grid, experiment=experiment)
+    pism_dataname = 'pism_Greenland_{}m_mcb_jpl_v{}_{}.nc'.format(grid, version, bed_type)
+
+    dura = 10
+
+    general_params_dict = OrderedDict()
+    general_params_dict['o_format'] = oformat
+    general_params_dict['o_size'] = osize
+
+    grid_params_dict = generate_grid_description(grid)
+
+    sb_params_dict = OrderedDict()
+    sb_params_dict['sia_e'] = sia_e
+    sb_params_dict['ssa_e'] = ssa_e
+    sb_params_dict['ssa_n'] = ssa_n
+    sb_params_dict['pseudo_plastic_q'] = ppq
+    sb_params_dict['till_effective_fraction_overburden'] = tefo
+    sb_params_dict['topg_to_phi'] = ttphi
+
+    stress_balance_params_dict = generate_stress_balance(stress_balance, sb_params_dict)
+    exvars = "climatic_mass_balance_cumulative,tempsurf,diffusivity,temppabase,bmeltvelsurf_mag,mask,thk,topg,usurf,taud_mag,velsurf,climatic_mass_balance,climatic_mass_balance_original,velbase_mag,tauc,taub_mag"
+    spatial_ts_dict = generate_spatial_ts(outfile, exvars, exstep, start=start, end=end)
+    scalar_ts_dict = generate_scalar_ts(outfile, tsstep, start=start, end=end)
+
+    all_params_dict = merge_dicts(general_params_dict, grid_params_dict, stress_balance_params_dict, spatial_ts_dict, scalar_ts_dict)
+    all_params = ' '.join([' '.join(['-' + k, str(v)]) for k, v in all_params_dict.items()])
+
+    params_dict = OrderedDict()
+    if system in ('debug'):
+        params_dict['PISM_DO'] = 'echo'
+    else:
+        params_dict['PISM_DO'] = ''
+
+    params_dict['PISM_EXEC'] = pism_exec
+    params_dict['PISM_PARAMS'] = '\'{}\''.format(all_params)
+    params_dict['PISM_SAVE'] = ','.join(str(e) for e in save_times[grid_mapping[grid]+1::])
+    params_dict['STARTEND'] = '{},{}'.format(start, end)
+
+    params_dict['PISM_DATANAME'] = pism_dataname
+    params_dict['PISM_SURFACE_BC_FILE'] = pism_surface_bcfile
+    params_dict['PISM_CONFIG'] = 'spinup_config.nc'
+    params_dict['TSSTEP'] = tsstep
+    params_dict['EXSTEP'] = exstep
+    if parent is not None:
+        # regrid from the save file the previous stage writes at our start time
+        params_dict['REGRIDVARS'] = regridvars
+        params_dict['REGRIDFILE'] = get_save_file(parent['runs'][-1]['outfile'], start)
+    elif grid_mapping[grid] > 0:
+        previous_grid = grid_choices[grid_mapping[grid] - 1]
+        previous_outfile = '{domain}_g{grid}m_spinup_refine_{experiment}_0.nc'.format(domain=domain.lower(), grid=previous_grid, experiment=experiment)
+        params_dict['REGRIDVARS'] = regridvars
+        params_dict['REGRIDFILE'] = get_save_file(previous_outfile, start)
+    params_dict['PARAM_NOAGE'] = ''
+    params_dict['PARAM_CALVING'] = calving
+    if calving in ('eigen_calving'):
+        params_dict['PARAM_CALVING_THK'] = calving_thk_threshold
+        params_dict['PARAM_CALVING_K'] = calving_k
+    if forcing_type in ('e_age', 'e_age_ftt'):
+        params_dict['PARAM_E_AGE_COUPLING'] = 'yes'
+    if forcing_type in ('ftt', 'e_age_ftt'):
+        params_dict['PARAM_FTT'] = 'yes'
+        params_dict['PARAM_FTT_STARTTIME'] = ftt_starttime
+
+    args = [job_sizes[grid][0], climate, dura, hydro, outfile, infile]
+    runs = [make_run(params_dict, args, outfile)]
 
     tl_dir = '{}m_{}_{}'.format(grid, climate, bed_type)
     nc_dir = 'processed'
     rc_dir = domain.lower()
-    fill = '-2e9'
-        
-    with open(post, 'w') as f:
-
-        f.write('#!/bin/bash\n')
-        f.write('#PBS -q transfer\n')
-        f.write('#PBS -l walltime=4:00:00\n')
-        f.write('#PBS -l nodes=1:ppn=1\n')
-        f.write('#PBS -j oe\n')
-        f.write('\n')
-        f.write('source ~/python/bin/activate\n')
-        f.write('\n')
-        f.write('cd $PBS_O_WORKDIR\n')
-        f.write('\n')
-
-        f.write(' if [ ! -d {tl_dir}/{nc_dir}/{rc_dir} ]; then mkdir -p {tl_dir}/{nc_dir}/{rc_dir}; fi\n'.format(tl_dir=tl_dir, nc_dir=nc_dir, rc_dir=rc_dir))
-        f.write('\n')
-        f.write('if [ -f {} ]; then\n'.format(outfile))
-        f.write('  rm -f tmp_{outfile} {tl_dir}/{nc_dir}/{rc_dir}/{outfile}\n'.format(outfile=outfile, tl_dir=tl_dir, nc_dir=nc_dir, rc_dir=rc_dir))
-        f.write('  ncks -v enthalpy,litho_temp -x {outfile} tmp_{outfile}\n'.format(outfile=outfile))
-        f.write('  sh add_epsg3413_mapping.sh tmp_{}\n'.format(outfile))
-        f.write('  ncpdq -o --64 -a time,y,x tmp_{outfile} {tl_dir}/{nc_dir}/{rc_dir}/{outfile}\n'.format(outfile=outfile, tl_dir=tl_dir, nc_dir=nc_dir, rc_dir=rc_dir))
-        f.write(  '''  ncap2 -O -s "uflux=ubar*thk; vflux=vbar*thk; velshear_mag=velsurf_mag-velbase_mag; where(thk<50) {{velshear_mag={fill}; velbase_mag={fill}; velsurf_mag={fill}; flux_mag={fill};}}; sliding_r = velbase_mag/velsurf_mag; tau_r = tauc/(taud_mag+1); tau_rel=(tauc-taud_mag)/(1+taud_mag);" {tl_dir}/{nc_dir}/{rc_dir}/{outfile} {tl_dir}/{nc_dir}/{rc_dir}/{outfile}\n'''.format(outfile=outfile, fill=fill, tl_dir=tl_dir, nc_dir=nc_dir, rc_dir=rc_dir))
-        f.write('  ncatted -a bed_data_set,run_stats,o,c,"{mytype}" -a grid_dx_meters,run_stats,o,f,{grid} -a grid_dy_meters,run_stats,o,f,{grid} -a long_name,uflux,o,c,"Vertically-integrated horizontal flux of ice in the X direction" -a long_name,vflux,o,c,"Vertically-integrated horizontal flux of ice in the Y direction" -a units,uflux,o,c,"m2 year-1" -a units,vflux,o,c,"m2 year-1" -a units,sliding_r,o,c,"1" -a units,tau_r,o,c,"1" -a units,tau_rel,o,c,"1" {tl_dir}/{nc_dir}/{rc_dir}/{outfile}\n'.format(mytype=mytype, grid=grid, tl_dir=tl_dir, nc_dir=nc_dir, rc_dir=rc_dir, outfile=outfile))
-        f.write('fi\n')
-        f.write('\n')
-        
-    
-scripts = uniquify_list(scripts)
-posts = uniquify_list(posts)
-
-submit = 'submit_{domain}_g{grid}m_{climate}_{bed_type}.sh'.format(domain=domain.lower(), grid=grid, climate=climate, bed_type=bed_type)
-try:
-    os.remove(submit)
-except OSError:
-    pass
-
-with open(submit, 'w') as f:
-
-    f.write('#!/bin/bash\n')
-
-    for k in range(len(scripts)):
-        f.write('JOBID=$(qsub {script})\n'.format(script=scripts[k]))
-        f.write('qsub -W depend=afterok:${{JOBID}} {post}\n'.format(post=posts[k]))
+    out_dir = '/'.join([tl_dir, nc_dir, rc_dir])
 
-print("\nRun {} to submit all jobs to the scheduler\n".format(submit))
+    return make_member(domain, grid, experiment, runs, out_dir, bed_data_set, prefix='spinup', params=name_options)
 
+
+os.environ['PISM_TITLE'] = 'Greenland Paramter Study'
+
+submit = 'submit_{domain}_g{start_grid}m-g{grid}m_{climate}_{bed_type}.sh'.format(domain=domain.lower(), start_grid=start_grid, grid=grid, climate=climate, bed_type=bed_type)
+resume_after = get_stage_resume_after if options.resume else None
+nodes = generate_chain(space, build_stage, grids, submit, get_stage_header, manifest=manifest,
+                       incremental=options.incremental, resume_after=resume_after,
+                       timing=options.timing)
+dot = os.path.splitext(submit)[0] + '.dot'
+write_dot(nodes, dot)
+
+if options.dag:
+    print(format_dag(nodes))
+print("\nWrote the job DAG to {}".format(dot))
+print("\nRun {} to submit all jobs to the scheduler\n".format(submit))
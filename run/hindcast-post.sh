@@ -1,22 +1,30 @@
 #!/bin/bash
 
+# Cut all regions (see regional_subset.py) out of the yearly extra files
+# in one job: each file is read once and processed in parallel.
+
+NN=8
+
  MYSHEBANGLINE="#!/bin/bash"
 MYMPIQUEUELINE="#PBS -q transfer"
  MYMPITIMELINE="#PBS -l walltime=8:00:00"
- MYMPISIZELINE="#PBS -l nodes=1:ppn=1"
+ MYMPISIZELINE="#PBS -l nodes=1:ppn=$NN"
   MYMPIOUTLINE="#PBS -j oe"
 
 out_dir=1500m_hindcast/processed/greenland/yearly
 reg_dir=1500m_hindcast/processed/regional/yearly
 
+FILES=""
 start=2000
 while [ $start -lt 2007 ]; do
-    echo $start
     end=$[$start+1]
-    
-    POST=post_${start}-${end}.sh
+    FILES="$FILES ex_g1500m_hydro_null_${start}-${end}.nc"
+    start=$[$start+1]
+done
+
+POST=post_regional.sh
 
-    cat - > $POST <<EOF
+cat - > $POST <<EOF
 
 $MYSHEBANGLINE
 $MYMPIQUEUELINE
@@ -34,15 +42,8 @@ if [ ! -d ${reg_dir} ]; then
     mkdir -p ${reg_dir}
 fi
 
-  sh add_epsg3413_mapping.sh ex_g1500m_hydro_null_${start}-${end}.nc
-  ncpdq -O -4 -L 3 -a time,y,x -d x,-222000.,-60000. -d y,-2330000.,-2230000. ex_g1500m_hydro_null_${start}-${end}.nc ${reg_dir}/Jakobshavn_ex_g1500m_hydro_null_${start}-${end}.nc
-  nc2cdo.py --srs "+init=epsg:3413" ${reg_dir}/Jakobshavn_ex_g1500m_hydro_null_${start}-${end}.nc
+  python regional_subset.py -n $NN -o ${reg_dir} $FILES
 
 EOF
 
-    qsub $POST
-			  
-    start=$[$start+1]
-done
-
-
+qsub $POST
@@ -1,11 +1,10 @@
 #!/usr/bin/env python
 # Copyright (C) 2015 Andy Aschwanden
 
-import itertools
 from collections import OrderedDict
-import os
 from argparse import ArgumentParser
 from resources import *
+from ensemble import *
 
 # set up the option parser
 parser = ArgumentParser()
@@ -47,7 +46,8 @@ parser.add_argument("--stress_balance", dest="stress_balance",
 parser.add_argument("--dataset_version", dest="version",
                     choices=['2_1985'],
                     help="input data set version", default='2_1985')
-
+parser.add_argument("--sizing_model", dest="sizing_model",
+                    help="sizing model (see job_sizing.py) choosing the number of cores and walltime of each member instead of -n and -w", default=None)
 
 options = parser.parse_args()
 args = options.regridfile
@@ -104,19 +104,36 @@ phi_min_values = [5.0]
 phi_max_values = [40.]
 topg_min_values = [-700]
 topg_max_values = [700]
-combinations = list(itertools.product(calving_thk_threshold_values, calving_k_values, phi_min_values, phi_max_values, topg_min_values, topg_max_values))
 
 tsstep = 'daily'
 
 era_start = 1989
 era_end = 2011
 
-scripts = []
-posts = []
-for n, combination in enumerate(combinations):
-
-    calving_thk_threshold, calving_k , phi_min, phi_max, topg_min, topg_max = combination
-
+space = OrderedDict()
+space['calving_thk_threshold'] = calving_thk_threshold_values
+space['calving_k'] = calving_k_values
+space['phi_min'] = phi_min_values
+space['phi_max'] = phi_max_values
+space['topg_min'] = topg_min_values
+space['topg_max'] = topg_max_values
+
+bed_data_set = get_bed_data_set(version)
+tl_dir = '{}m_{}_{}_{}'.format(grid, climate, bed_type, vversion)
+nc_dir = 'processed'
+rc_dir = domain.lower()
+out_dir = '/'.join([tl_dir, nc_dir, rc_dir])
+pbs_header = make_pbs_header(system, nn, walltime, queue)
+
+
+def build_member(combination):
+
+    calving_thk_threshold = combination['calving_thk_threshold']
+    calving_k = combination['calving_k']
+    phi_min = combination['phi_min']
+    phi_max = combination['phi_max']
+    topg_min = combination['topg_min']
+    topg_max = combination['topg_max']
     ttphi = '{},{},{},{}'.format(phi_min, phi_max, topg_min, topg_max)
 
     name_options = OrderedDict()
@@ -138,167 +155,80 @@ for n, combination in enumerate(combinations):
         name_options['calving_thk_threshold'] = calving_thk_threshold
     name_options['ocean'] = ocean
 
-    experiment =  '_'.join([climate, bed_type, vversion, '_'.join(['_'.join([k, str(v)]) for k, v in name_options.items()])])
-
-        
-    script = 'do_{}_g{}m_{}.sh'.format(domain.lower(), grid, experiment)
-    scripts.append(script)
-    post = 'do_{}_g{}m_{}_post.sh'.format(domain.lower(), grid, experiment)
-    posts.append(post)
-    
-    for filename in (script, post):
-        try:
-            os.remove(filename)
-        except OSError:
-            pass
-
-    pbs_header = make_pbs_header(system, nn, walltime, queue)
-        
-    
-    os.environ['PISM_EXPERIMENT'] = experiment
-    os.environ['PISM_TITLE'] = 'Greenland Paramter Study'
-    
-    with open(script, 'w') as f:
-
-        f.write(pbs_header)
-
-        relax_outfile = '{domain}_g{grid}m_{experiment}_{dura}a.nc'.format(domain=domain.lower(), grid=grid, experiment=experiment, dura=dura)
+    experiment = generate_experiment_name([climate, bed_type, vversion], name_options)
+
+    relax_outfile = '{domain}_g{grid}m_{experiment}_{dura}a.nc'.format(domain=domain.lower(), grid=grid, experiment=experiment, dura=dura)
+
+    general_params_dict = OrderedDict()
+    general_params_dict['o_format'] = oformat
+    general_params_dict['o_size'] = osize
+
+    grid_params_dict = generate_grid_description(grid)
+
+    sb_params_dict = OrderedDict()
+    sb_params_dict['sia_e'] = sia_e
+    sb_params_dict['ssa_e'] = ssa_e
+    sb_params_dict['ssa_n'] = ssa_n
+    sb_params_dict['pseudo_plastic_q'] = ppq
+    sb_params_dict['till_effective_fraction_overburden'] = tefo
+    sb_params_dict['topg_to_phi'] = ttphi
+
+    stress_balance_params_dict = generate_stress_balance(stress_balance, sb_params_dict)
+
+    all_params_dict = merge_dicts(general_params_dict, grid_params_dict, stress_balance_params_dict)
+    all_params = ' '.join([' '.join(['-' + k, str(v)]) for k, v in all_params_dict.items()])
+
+    exstep = 'yearly'
+    regridvars = 'litho_temp,enthalpy,tillwat,bmelt,Href'
+
+    params_dict = OrderedDict()
+    params_dict['PISM_DO'] = ''
+    params_dict['PISM_EXEC'] = pism_exec
+    params_dict['PISM_PARAMS'] = '\'{}\''.format(all_params)
+    params_dict['PISM_DATANAME'] = pism_dataname
+    params_dict['PISM_SURFACE_BC_FILE'] = relax_surface_bcfile
+    params_dict['PISM_OCEAN_BCFILE']= 'ocean_forcing_{grid}m_{start}-{end}_v{version}_{bed_type}_{ocean}_1989_baseline.nc'.format(grid=grid, version=version, bed_type=bed_type, ocean=ocean, start=era_start, end=era_end)
+    params_dict['PISM_CONFIG'] = 'hindcast_config.nc'
+    params_dict['REGRIDFILE'] = regridfile
+    params_dict['TSSTEP'] = tsstep
+    params_dict['EXSTEP'] = exstep
+    params_dict['REGRIDVARS'] = regridvars
+    params_dict['PARAM_NOAGE'] = 'foo'
+    params_dict['PARAM_FTT'] = ''
+    params_dict['PARAM_CALVING'] = calving_relax
+    if calving_relax in ('eigen_calving'):
+        params_dict['PARAM_CALVING_K'] = calving_k
+    if calving_relax in ('eigen_calving', 'thickness_calving'):
+        params_dict['PARAM_CALVING_THK'] = calving_thk_threshold
+
+    args = [nn, climate, dura, hydro, relax_outfile, infile]
+    relax_run = make_run(params_dict, args, relax_outfile, log='job_r.${PBS_JOBID}')
+
+    hindcast_outfile = '{domain}_g{grid}m_{experiment}_{start}-{end}.nc'.format(domain=domain.lower(), grid=grid, experiment=experiment, start=era_start, end=era_end)
+
+    exstep = 'monthly'
+    regridvars = 'litho_temp,enthalpy,tillwat,bmelt,Href,thk'
+    params_dict = OrderedDict(params_dict)
+    params_dict['EXSTEP'] = exstep
+    params_dict['REGRIDFILE'] = relax_outfile
+    params_dict['REGRIDVARS'] = regridvars
+    params_dict['PISM_TIMEFILE'] = hindcast_surface_bcfile
+    params_dict['PISM_SURFACE_BCFILE']= hindcast_surface_bcfile
+    params_dict['PISM_OCEAN_BCFILE']= 'ocean_forcing_{grid}m_1989-2011_v{version}_{bed_type}_{ocean}.nc'.format(grid=grid, version=version, bed_type=bed_type, ocean=ocean)
+    params_dict['PARAM_CALVING'] = calving_hindcast
+    if calving_hindcast in ('eigen_calving'):
+        params_dict['PARAM_CALVING_K'] = calving_k
+    if calving_hindcast in ('eigen_calving', 'thickness_calving'):
+        params_dict['PARAM_CALVING_THK'] = calving_thk_threshold
+
+    args = [nn, climate, dura, hydro, hindcast_outfile, infile]
+    hindcast_run = make_run(params_dict, args, hindcast_outfile, log='job_h.${PBS_JOBID}', extra_file=True)
+
+    return make_member(domain, grid, experiment, [relax_run, hindcast_run], out_dir, bed_data_set, params=name_options)
 
-        general_params_dict = OrderedDict()
-        general_params_dict['o_format'] = oformat
-        general_params_dict['o_size'] = osize
-        
-        grid_params_dict = generate_grid_description(grid)
 
-        sb_params_dict = OrderedDict()
-        sb_params_dict['sia_e'] = sia_e
-        sb_params_dict['ssa_e'] = ssa_e
-        sb_params_dict['ssa_n'] = ssa_n
-        sb_params_dict['pseudo_plastic_q'] = ppq
-        sb_params_dict['till_effective_fraction_overburden'] = tefo
-        sb_params_dict['topg_to_phi'] = ttphi
-
-        stress_balance_params_dict = generate_stress_balance(stress_balance, sb_params_dict)
-
-        all_params_dict = merge_dicts(general_params_dict, grid_params_dict, stress_balance_params_dict)
-        all_params = ' '.join([' '.join(['-' + k, str(v)]) for k, v in all_params_dict.items()])
-    
-
-        exstep = 'yearly'
-        regridvars = 'litho_temp,enthalpy,tillwat,bmelt,Href'
-
-        params_dict = OrderedDict()
-        params_dict['PISM_DO'] = ''
-        params_dict['PISM_EXEC'] = pism_exec
-        params_dict['PISM_PARAMS'] = '\'{}\''.format(all_params)
-        params_dict['PISM_DATANAME'] = pism_dataname
-        params_dict['PISM_SURFACE_BC_FILE'] = relax_surface_bcfile
-        params_dict['PISM_OCEAN_BCFILE']= 'ocean_forcing_{grid}m_{start}-{end}_v{version}_{bed_type}_{ocean}_1989_baseline.nc'.format(grid=grid, version=version, bed_type=bed_type, ocean=ocean, start=era_start, end=era_end)
-        params_dict['PISM_CONFIG'] = 'hindcast_config.nc'
-        params_dict['REGRIDFILE'] = regridfile
-        params_dict['TSSTEP'] = tsstep
-        params_dict['EXSTEP'] = exstep
-        params_dict['REGRIDVARS'] = regridvars
-        params_dict['PARAM_NOAGE'] = 'foo'
-        params_dict['PARAM_FTT'] = ''
-        params_dict['PARAM_CALVING'] = calving_relax
-        if calving_relax in ('eigen_calving'):
-            params_dict['PARAM_CALVING_K'] = calving_k
-        if calving_relax in ('eigen_calving', 'thickness_calving'):
-            params_dict['PARAM_CALVING_THK'] = calving_thk_threshold
-
-        params = ' '.join(['='.join([k, str(v)]) for k, v in params_dict.items()])
-        cmd = ' '.join([params, './run_main.sh', str(nn), climate, str(dura), hydro, relax_outfile, infile, '2>&1 | tee job_r.${PBS_JOBID}'])
-
-        f.write(cmd)
-        f.write('\n\n')
-
-        hindcast_outfile = '{domain}_g{grid}m_{experiment}_{start}-{end}.nc'.format(domain=domain.lower(), grid=grid, experiment=experiment, start=era_start, end=era_end)
-
-        exstep = 'monthly'
-        regridvars = 'litho_temp,enthalpy,tillwat,bmelt,Href,thk'
-        params_dict['EXSTEP'] = exstep
-        params_dict['REGRIDFILE'] = relax_outfile
-        params_dict['REGRIDVARS'] = regridvars        
-        params_dict['PISM_TIMEFILE'] = hindcast_surface_bcfile
-        params_dict['PISM_SURFACE_BCFILE']= hindcast_surface_bcfile
-        params_dict['PISM_OCEAN_BCFILE']= 'ocean_forcing_{grid}m_1989-2011_v{version}_{bed_type}_{ocean}.nc'.format(grid=grid, version=version, bed_type=bed_type, ocean=ocean)
-        params_dict['PARAM_CALVING'] = calving_hindcast
-        if calving_hindcast in ('eigen_calving'):
-            params_dict['PARAM_CALVING_K'] = calving_k
-        if calving_hindcast in ('eigen_calving', 'thickness_calving'):
-            params_dict['PARAM_CALVING_THK'] = calving_thk_threshold
-
-        params = ' '.join(['='.join([k, str(v)]) for k, v in params_dict.items()])
-        cmd = ' '.join([params, './run_main.sh', str(nn), climate, str(dura), hydro, hindcast_outfile, infile, '2>&1 | tee job_h.${PBS_JOBID}'])
-
-        f.write(cmd)
-        f.write('\n')
-
-        if version in 'v2_1985':
-            mytype = "MO14 2015-04-27"
-        else:
-            import sys
-            print('TYPE {} not recognized, exiting'.format(version))
-            sys.exit(0)
-
-    tl_dir = '{}m_{}_{}_{}'.format(grid, climate, bed_type, vversion)
-    nc_dir = 'processed'
-    rc_dir = domain.lower()
-    fill = '-2e9'
-        
-    with open(post, 'w') as f:
-
-        f.write('#!/bin/bash\n')
-        f.write('#PBS -q transfer\n')
-        f.write('#PBS -l walltime=4:00:00\n')
-        f.write('#PBS -l nodes=1:ppn=1\n')
-        f.write('#PBS -j oe\n')
-        f.write('\n')
-        f.write('source ~/python/bin/activate\n')
-        f.write('\n')
-        f.write('cd $PBS_O_WORKDIR\n')
-        f.write('\n')
-
-        f.write(' if [ ! -d {tl_dir}/{nc_dir}/{rc_dir} ]; then mkdir -p {tl_dir}/{nc_dir}/{rc_dir}; fi\n'.format(tl_dir=tl_dir, nc_dir=nc_dir, rc_dir=rc_dir))
-        f.write('\n')
-        f.write('if [ -f {} ]; then\n'.format(relax_outfile))
-        f.write('  rm -f tmp_{relax_outfile} {tl_dir}/{nc_dir}/{rc_dir}/{relax_outfile}\n'.format(relax_outfile=relax_outfile, tl_dir=tl_dir, nc_dir=nc_dir, rc_dir=rc_dir))
-        f.write('  ncks -v enthalpy,litho_temp -x {relax_outfile} tmp_{relax_outfile}\n'.format(relax_outfile=relax_outfile))
-        f.write('  sh add_epsg3413_mapping.sh tmp_{}\n'.format(relax_outfile))
-        f.write('  ncpdq -o --64 -a time,y,x tmp_{relax_outfile} {tl_dir}/{nc_dir}/{rc_dir}/{relax_outfile}\n'.format(relax_outfile=relax_outfile, tl_dir=tl_dir, nc_dir=nc_dir, rc_dir=rc_dir))
-        f.write(  '''  ncap2 -O -s "uflux=ubar*thk; vflux=vbar*thk; velshear_mag=velsurf_mag-velbase_mag; where(thk<50) {{velshear_mag={fill}; velbase_mag={fill}; velsurf_mag={fill}; flux_mag={fill};}}; sliding_r = velbase_mag/velsurf_mag; tau_r = tauc/(taud_mag+1); tau_rel=(tauc-taud_mag)/(1+taud_mag);" {tl_dir}/{nc_dir}/{rc_dir}/{relax_outfile} {tl_dir}/{nc_dir}/{rc_dir}/{relax_outfile}\n'''.format(relax_outfile=relax_outfile, fill=fill, tl_dir=tl_dir, nc_dir=nc_dir, rc_dir=rc_dir))
-        f.write('  ncatted -a bed_data_set,run_stats,o,c,"{mytype}" -a grid_dx_meters,run_stats,o,f,{grid} -a grid_dy_meters,run_stats,o,f,{grid} -a long_name,uflux,o,c,"Vertically-integrated horizontal flux of ice in the X direction" -a long_name,vflux,o,c,"Vertically-integrated horizontal flux of ice in the Y direction" -a units,uflux,o,c,"m2 year-1" -a units,vflux,o,c,"m2 year-1" -a units,sliding_r,o,c,"1" -a units,tau_r,o,c,"1" -a units,tau_rel,o,c,"1" {tl_dir}/{nc_dir}/{rc_dir}/{relax_outfile}\n'.format(mytype=mytype, grid=grid, tl_dir=tl_dir, nc_dir=nc_dir, rc_dir=rc_dir, relax_outfile=relax_outfile))
-        f.write('fi\n')
-        f.write('\n')
-        f.write('if [ -f {} ]; then\n'.format(hindcast_outfile))
-        f.write('  rm -f tmp_{hindcast_outfile} tmp_ex_{hindcast_outfile} {tl_dir}/{nc_dir}/{rc_dir}/{hindcast_outfile} {tl_dir}/{nc_dir}/{rc_dir}/ex_{hindcast_outfile}\n'.format(hindcast_outfile=hindcast_outfile, tl_dir=tl_dir, nc_dir=nc_dir, rc_dir=rc_dir))
-        f.write('  ncks -v enthalpy,litho_temp -x {hindcast_outfile} tmp_{hindcast_outfile}\n'.format(hindcast_outfile=hindcast_outfile))
-        f.write('  ncks -O --64 ex_{hindcast_outfile} {tl_dir}/{nc_dir}/{rc_dir}/ex_{hindcast_outfile}\n'.format(hindcast_outfile=hindcast_outfile, tl_dir=tl_dir, nc_dir=nc_dir, rc_dir=rc_dir))
-        f.write('  sh add_epsg3413_mapping.sh tmp_{}\n'.format(hindcast_outfile))
-        f.write('  ncpdq -o --64 -a time,y,x tmp_{hindcast_outfile} {tl_dir}/{nc_dir}/{rc_dir}/{hindcast_outfile}\n'.format(hindcast_outfile=hindcast_outfile, tl_dir=tl_dir, nc_dir=nc_dir, rc_dir=rc_dir))
-        f.write(  '''  ncap2 -O -s "uflux=ubar*thk; vflux=vbar*thk; velshear_mag=velsurf_mag-velbase_mag; where(thk<50) {{velshear_mag={fill}; velbase_mag={fill}; velsurf_mag={fill}; flux_mag={fill};}}; sliding_r = velbase_mag/velsurf_mag; tau_r = tauc/(taud_mag+1); tau_rel=(tauc-taud_mag)/(1+taud_mag);" {tl_dir}/{nc_dir}/{rc_dir}/{hindcast_outfile} {tl_dir}/{nc_dir}/{rc_dir}/{hindcast_outfile}\n'''.format(hindcast_outfile=hindcast_outfile, fill=fill, tl_dir=tl_dir, nc_dir=nc_dir, rc_dir=rc_dir))
-        f.write('  ncatted -a bed_data_set,run_stats,o,c,"{mytype}" -a grid_dx_meters,run_stats,o,f,{grid} -a grid_dy_meters,run_stats,o,f,{grid} -a long_name,uflux,o,c,"Vertically-integrated horizontal flux of ice in the X direction" -a long_name,vflux,o,c,"Vertically-integrated horizontal flux of ice in the Y direction" -a units,uflux,o,c,"m2 year-1" -a units,vflux,o,c,"m2 year-1" -a units,sliding_r,o,c,"1" -a units,tau_r,o,c,"1" -a units,tau_rel,o,c,"1" {tl_dir}/{nc_dir}/{rc_dir}/{hindcast_outfile}\n'.format(mytype=mytype, grid=grid, tl_dir=tl_dir, nc_dir=nc_dir, rc_dir=rc_dir, hindcast_outfile=hindcast_outfile))
-        f.write('fi\n')
-        f.write('\n')
-        
-
-scripts = uniquify_list(scripts)
-posts = uniquify_list(posts)
-        
 submit = 'submit_{domain}_g{grid}m_{climate}_{bed_type}_hirham.sh'.format(domain=domain.lower(), grid=grid, climate=climate, bed_type=bed_type)
-try:
-    os.remove(submit)
-except OSError:
-    pass
-
-with open(submit, 'w') as f:
-
-    f.write('#!/bin/bash\n')
-
-    for k in range(len(scripts)):
-        f.write('JOBID=$(qsub {script})\n'.format(script=scripts[k]))
-        f.write('qsub -W depend=afterok:${{JOBID}} {post}\n'.format(post=posts[k]))
+generate_ensemble(space, build_member, submit, pbs_header, sizing_model=options.sizing_model,
+                  system=system, queue=queue)
 
 print("\nRun {} to submit all jobs to the scheduler\n".format(submit))
-
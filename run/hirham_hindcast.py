@@ -1,10 +1,12 @@
 #!/usr/bin/env python
 # Copyright (C) 2015 Andy Aschwanden
 
-import itertools
 from collections import OrderedDict
-import os
 from argparse import ArgumentParser
+from resources import *
+from ensemble import *
+from manifest import MANIFEST
+from submit import make_array_backend
 
 # set up the option parser
 parser = ArgumentParser()
@@ -43,9 +45,29 @@ parser.add_argument("-b", "--bed_type", dest="bed_type",
 parser.add_argument("--dataset_version", dest="version",
                     choices=['2_1985'],
                     help="input data set version", default='2_1985')
+parser.add_argument("--submit_backend", dest="backend",
+                    choices=['serial', 'array'],
+                    help="submit one job per member (serial) or a job array with packed small grids (array). default=serial", default='serial')
+parser.add_argument("--incremental", dest="incremental", action="store_true",
+                    help="only generate and submit members that are missing or failed", default=False)
+parser.add_argument("--resume", dest="resume", action="store_true",
+                    help="stop PISM before the walltime and resubmit unfinished runs from their latest backup (see resume.py)", default=False)
+parser.add_argument("--no_timing", dest="timing", action="store_false",
+                    help="do not add stage timers to job and post scripts (see stage_timing.py)", default=True)
+parser.add_argument("--manifest", dest="manifest",
+                    help="manifest database recording all members. default={}".format(MANIFEST), default=MANIFEST)
+parser.add_argument("--no_manifest", dest="manifest", action="store_const", const=None,
+                    help="do not record members in a manifest")
+parser.add_argument("--sizing_model", dest="sizing_model",
+                    help="sizing model (see job_sizing.py) choosing the number of cores and walltime of each member instead of -n and -w", default=None)
+parser.add_argument("--post_batch", dest="post_batch", type=int,
+                    help="post-process all members in one job on POST_BATCH cores of a transfer node (see post_batch.py)", default=None)
+parser.add_argument("--members_per_job", dest="members_per_job", type=int,
+                    help="number of 9000m/18000m members packed into one job by the array backend. default=4", default=4)
 
 
 options = parser.parse_args()
+manifest = options.manifest
 args = options.regridfile
 
 nn = options.n
@@ -99,20 +121,36 @@ phi_min_values = [5.0]
 phi_max_values = [40.]
 topg_min_values = [-700]
 topg_max_values = [700]
-combinations = list(itertools.product(calving_thk_threshold_values, calving_k_values, phi_min_values, phi_max_values, topg_min_values, topg_max_values))
 
 tsstep = 'daily'
 
 era_start = 1989
 era_end = 2011
 
-scripts = []
-posts = []
-for n, combination in enumerate(combinations):
+space = OrderedDict()
+space['calving_thk_threshold'] = calving_thk_threshold_values
+space['calving_k'] = calving_k_values
+space['phi_min'] = phi_min_values
+space['phi_max'] = phi_max_values
+space['topg_min'] = topg_min_values
+space['topg_max'] = topg_max_values
 
-    calving_thk_threshold, calving_k , phi_min, phi_max, topg_min, topg_max = combination
+resume_after = get_resume_after(walltime) if options.resume else None
 
-    ttphi = '{},{},{},{}'.format(phi_min, phi_max, topg_min, topg_max)
+bed_data_set = get_bed_data_set(version)
+tl_dir = '{}m_{}_{}_{}'.format(grid, climate, bed_type, vversion)
+nc_dir = 'processed'
+rc_dir = domain.lower()
+out_dir = '/'.join([tl_dir, nc_dir, rc_dir])
+pbs_header = make_pbs_header(system, nn, walltime, queue)
+
+
+def build_member(combination):
+
+    calving_thk_threshold = combination['calving_thk_threshold']
+    calving_k = combination['calving_k']
+    ttphi = '{},{},{},{}'.format(combination['phi_min'], combination['phi_max'],
+                                 combination['topg_min'], combination['topg_max'])
 
     name_options = OrderedDict()
     name_options['sia_e'] = sia_e
@@ -128,124 +166,55 @@ for n, combination in enumerate(combinations):
         name_options['calving_thk_threshold'] = calving_thk_threshold
     name_options['ocean'] = ocean
 
-    experiment =  '_'.join([climate, bed_type, vversion, '_'.join(['_'.join([k, str(v)]) for k, v in name_options.items()])])
-
-        
-    script = 'do_{}_g{}m_{}.sh'.format(domain.lower(), grid, experiment)
-    scripts.append(script)
-    post = 'do_{}_g{}m_{}_post.sh'.format(domain.lower(), grid, experiment)
-    posts.append(post)
-    
-    for filename in (script, post):
-        try:
-            os.remove(filename)
-        except OSError:
-            pass
-
-    pbs_header = make_pbs_header(system, nn, walltime, queue)
-        
-    
-    os.environ['PISM_EXPERIMENT'] = experiment
-    os.environ['PISM_TITLE'] = 'Greenland Paramter Study'
-    
-    with open(script, 'w') as f:
-
-        f.write(pbs_header)
-
-        hindcast_outfile = '{domain}_g{grid}m_{experiment}_hindcast_{start}-{end}.nc'.format(domain=domain.lower(),grid=grid, experiment=experiment, start=era_start, end=era_end)
-
-        exstep = 'monthly'
-        regridvars = 'litho_temp,enthalpy,tillwat,bmelt,Href,thk'
-        params_dict = dict()
-        params_dict['PISM_DO'] = ''
-        params_dict['PISM_OFORMAT'] = oformat
-        params_dict['PISM_OSIZE'] = osize
-        params_dict['PISM_EXEC'] = pism_exec
-        params_dict['PISM_DATANAME'] = pism_dataname
-        params_dict['EXSTEP'] = exstep
-        params_dict['REGRIDFILE'] = regridfile
-        params_dict['REGRIDVARS'] = regridvars        
-        params_dict['PISM_TIMEFILE'] = hindcast_surface_bcfile
-        params_dict['PISM_SURFACE_BCFILE']= hindcast_surface_bcfile
-        params_dict['PISM_OCEAN_BCFILE']= 'ocean_forcing_{grid}m_1989-2011_v{version}_{bed_type}_{ocean}.nc'.format(grid=grid, version=version, bed_type=bed_type, ocean=ocean)
-        params_dict['PISM_CONFIG'] = 'hindcast_config.nc'
-        params_dict['TSSTEP'] = tsstep
-        params_dict['EXSTEP'] = exstep
-        params_dict['REGRIDVARS'] = regridvars
-        params_dict['SIA_E'] = sia_e
-        params_dict['SSA_E'] = ssa_e
-        params_dict['SSA_N'] = ssa_n
-        params_dict['PARAM_NOAGE'] = 'foo'
-        params_dict['PARAM_PPQ'] = ppq
-        params_dict['PARAM_TEFO'] = tefo
-        params_dict['PARAM_TTPHI'] = ttphi
-        params_dict['PARAM_FTT'] = ''
-        params_dict['PARAM_CALVING'] = calving_hindcast
-        if calving_hindcast in ('eigen_calving'):
-            params_dict['PARAM_CALVING_K'] = calving_k
-        if calving_hindcast in ('eigen_calving', 'thickness_calving'):
-            params_dict['PARAM_CALVING_THK'] = calving_thk_threshold
-
-        params = ' '.join(['='.join([k, str(v)]) for k, v in params_dict.items()])
-        cmd = ' '.join([params, './run.sh', str(nn), climate, str(dura), str(grid), 'hybrid', hydro, hindcast_outfile, infile, '2>&1 | tee job_h.${PBS_JOBID}'])
-
-        f.write(cmd)
-        f.write('\n')
-
-        if version in 'v2_1985':
-            mytype = "MO14 2015-04-27"
-        else:
-            import sys
-            print('TYPE {} not recognized, exiting'.format(version))
-            sys.exit(0)
-
-    tl_dir = '{}m_{}_{}_{}'.format(grid, climate, bed_type, vversion)
-    nc_dir = 'processed'
-    rc_dir = domain.lower()
-    fill = '-2e9'
-        
-    with open(post, 'w') as f:
-
-        f.write('#!/bin/bash\n')
-        f.write('#PBS -q transfer\n')
-        f.write('#PBS -l walltime=4:00:00\n')
-        f.write('#PBS -l nodes=1:ppn=1\n')
-        f.write('#PBS -j oe\n')
-        f.write('\n')
-        f.write('source ~/python/bin/activate\n')
-        f.write('\n')
-        f.write('cd $PBS_O_WORKDIR\n')
-        f.write('\n')
-
-
-        f.write('if [ -f {} ]; then\n'.format(hindcast_outfile))
-        f.write('  rm -f tmp_{hindcast_outfile} tmp_ex_{hindcast_outfile} {tl_dir}/{nc_dir}/{rc_dir}/{hindcast_outfile} {tl_dir}/{nc_dir}/{rc_dir}/ex_{hindcast_outfile}\n'.format(hindcast_outfile=hindcast_outfile, tl_dir=tl_dir, nc_dir=nc_dir, rc_dir=rc_dir))
-        f.write('  ncks -v enthalpy,litho_temp -x {hindcast_outfile} tmp_{hindcast_outfile}\n'.format(hindcast_outfile=hindcast_outfile))
-        f.write('  ncks -O --64 ex_{hindcast_outfile} {tl_dir}/{nc_dir}/{rc_dir}/ex_{hindcast_outfile}\n'.format(hindcast_outfile=hindcast_outfile, tl_dir=tl_dir, nc_dir=nc_dir, rc_dir=rc_dir))
-        f.write('  sh add_epsg3413_mapping.sh tmp_{}\n'.format(hindcast_outfile))
-        f.write('  ncpdq -O --64 -a time,y,x tmp_{hindcast_outfile} {tl_dir}/{nc_dir}/{rc_dir}/{hindcast_outfile}\n'.format(hindcast_outfile=hindcast_outfile, tl_dir=tl_dir, nc_dir=nc_dir, rc_dir=rc_dir))
-        f.write(  '''  ncap2 -O -s "uflux=ubar*thk; vflux=vbar*thk; velshear_mag=velsurf_mag-velbase_mag; where(thk<50) {{velshear_mag={fill}; velbase_mag={fill}; velsurf_mag={fill}; flux_mag={fill};}}; sliding_r = velbase_mag/velsurf_mag; tau_r = tauc/(taud_mag+1); tau_rel=(tauc-taud_mag)/(1+taud_mag);" {tl_dir}/{nc_dir}/{rc_dir}/{hindcast_outfile} {tl_dir}/{nc_dir}/{rc_dir}/{hindcast_outfile}\n'''.format(hindcast_outfile=hindcast_outfile, fill=fill, tl_dir=tl_dir, nc_dir=nc_dir, rc_dir=rc_dir))
-        f.write('  ncatted -a bed_data_set,run_stats,o,c,"{mytype}" -a grid_dx_meters,run_stats,o,f,{grid} -a grid_dy_meters,run_stats,o,f,{grid} -a long_name,uflux,o,c,"Vertically-integrated horizontal flux of ice in the X direction" -a long_name,vflux,o,c,"Vertically-integrated horizontal flux of ice in the Y direction" -a units,uflux,o,c,"m2 year-1" -a units,vflux,o,c,"m2 year-1" -a units,sliding_r,o,c,"1" -a units,tau_r,o,c,"1" -a units,tau_rel,o,c,"1" {tl_dir}/{nc_dir}/{rc_dir}/{hindcast_outfile}\n'.format(mytype=mytype, grid=grid, tl_dir=tl_dir, nc_dir=nc_dir, rc_dir=rc_dir, hindcast_outfile=hindcast_outfile))
-        f.write('fi\n')
-        f.write('\n')
-        
-
-scripts = uniquify_list(scripts)
-posts = uniquify_list(posts)
-        
-submit = 'submit_{domain}_g{grid}m_{climate}_{bed_type}_hirham.sh'.format(domain=domain.lower(), grid=grid, climate=climate, bed_type=bed_type)
-try:
-    os.remove(submit)
-except OSError:
-    pass
-
-with open(submit, 'w') as f:
+    experiment = generate_experiment_name([climate, bed_type, vversion], name_options)
+
+    hindcast_outfile = '{domain}_g{grid}m_{experiment}_hindcast_{start}-{end}.nc'.format(domain=domain.lower(),grid=grid, experiment=experiment, start=era_start, end=era_end)
+
+    exstep = 'monthly'
+    regridvars = 'litho_temp,enthalpy,tillwat,bmelt,Href,thk'
+    params_dict = OrderedDict()
+    params_dict['PISM_DO'] = ''
+    params_dict['PISM_OFORMAT'] = oformat
+    params_dict['PISM_OSIZE'] = osize
+    params_dict['PISM_EXEC'] = pism_exec
+    params_dict['PISM_DATANAME'] = pism_dataname
+    params_dict['REGRIDFILE'] = regridfile
+    params_dict['PISM_TIMEFILE'] = hindcast_surface_bcfile
+    params_dict['PISM_SURFACE_BCFILE']= hindcast_surface_bcfile
+    params_dict['PISM_OCEAN_BCFILE']= 'ocean_forcing_{grid}m_1989-2011_v{version}_{bed_type}_{ocean}.nc'.format(grid=grid, version=version, bed_type=bed_type, ocean=ocean)
+    params_dict['PISM_CONFIG'] = 'hindcast_config.nc'
+    params_dict['TSSTEP'] = tsstep
+    params_dict['EXSTEP'] = exstep
+    params_dict['REGRIDVARS'] = regridvars
+    params_dict['SIA_E'] = sia_e
+    params_dict['SSA_E'] = ssa_e
+    params_dict['SSA_N'] = ssa_n
+    params_dict['PARAM_NOAGE'] = 'foo'
+    params_dict['PARAM_PPQ'] = ppq
+    params_dict['PARAM_TEFO'] = tefo
+    params_dict['PARAM_TTPHI'] = ttphi
+    params_dict['PARAM_FTT'] = ''
+    params_dict['PARAM_CALVING'] = calving_hindcast
+    if calving_hindcast in ('eigen_calving'):
+        params_dict['PARAM_CALVING_K'] = calving_k
+    if calving_hindcast in ('eigen_calving', 'thickness_calving'):
+        params_dict['PARAM_CALVING_THK'] = calving_thk_threshold
+
+    args = [nn, climate, dura, grid, 'hybrid', hydro, hindcast_outfile, infile]
+    runs = [make_run(params_dict, args, hindcast_outfile, log='job_h.${PBS_JOBID}', run_script='./run.sh', extra_file=True)]
+
+    return make_member(domain, grid, experiment, runs, out_dir, bed_data_set, params=name_options)
 
-    f.write('#!/bin/bash\n')
 
-    for k in range(len(scripts)):
-        f.write('JOBID=$(qsub {script})\n'.format(script=scripts[k]))
-        f.write('qsub -W depend=afterok:${{JOBID}} {post}\n'.format(post=posts[k]))
+submit = 'submit_{domain}_g{grid}m_{climate}_{bed_type}_hirham.sh'.format(domain=domain.lower(), grid=grid, climate=climate, bed_type=bed_type)
+if options.backend in ('array'):
+    backend = make_array_backend(system, nn, walltime, queue, members_per_job=options.members_per_job,
+                                 post_batch=options.post_batch)
+else:
+    backend = None
+generate_ensemble(space, build_member, submit, pbs_header, backend=backend, manifest=manifest,
+                  incremental=options.incremental, resume_after=resume_after,
+                  timing=options.timing, post_batch=options.post_batch, sizing_model=options.sizing_model,
+                  system=system, queue=queue)
 
 print("\nRun {} to submit all jobs to the scheduler\n".format(submit))
-
@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+# Copyright (C) 2015 Andy Aschwanden
+
+'''
+Wall-time and core-count predictor for job sizing.
+
+PISM writes timing information to the 'run_stats' variable of its
+output files and the run scripts log their settings to the
+job.${PBS_JOBID} tee files. A sizing model fits model years per wall
+clock hour of past runs as a power law of the core count, the number
+of horizontal grid points and Mz, with factors for the stress balance
+(SSA on or off) and the hydrology model:
+
+log(years/hour) = c0 + c1 log(cores) + c2 log(Mx My) + c3 log(Mz) + c4 ssa + c5 hydro
+
+and suggests the smallest core count whose predicted walltime fits
+into the queue limit.
+
+Example
+-------
+$ job_sizing.py fit -o sizing.json job.* g*m_*.nc
+$ job_sizing.py predict sizing.json -g 1500 --years 22 -s pleiades -q long
+'''
+
+import os
+import re
+import sys
+import json
+import glob
+import shlex
+import numpy as np
+from collections import OrderedDict
+from argparse import ArgumentParser
+from resources import *
+
+try:
+    from netCDF3 import Dataset as CDF
+except:
+    from netCDF4 import Dataset as CDF
+
+SIZING_MODEL = 'sizing.json'
+FEATURES = ('const', 'log_cores', 'log_points', 'log_mz', 'ssa', 'hydro')
+# factor applied to the predicted wall-clock time
+SAFETY = 1.25
+MAX_WALLTIME = '24:00:00'
+# largest number of nodes considered when suggesting a core count
+MAX_NODES = 32
+
+NN_PATTERN = re.compile(r'\bNN = (\d+)')
+STARTED_PATTERN = re.compile(r'started on (\d+) procs')
+PARAMS_PATTERN = re.compile(r"PISM_PARAMS = '?(.*?)'?\s*(?:\(already set\))?$")
+DYNAMICS_PATTERN = re.compile(r"dynamics = '(.*)'")
+HEADER_PATTERN = re.compile(r'#\s+\d+ processors, .*, (\S+) dynamics')
+OUTPUT_PATTERN = re.compile(r"Writing model state to file `([^']+)'")
+
+
+def parse_options(command):
+    '''
+    Return a dict of the -options of a PISM command line; options
+    without a value map to ''
+    '''
+
+    try:
+        tokens = shlex.split(command)
+    except ValueError:
+        tokens = command.split()
+    options = {}
+    for k, token in enumerate(tokens):
+        if token.startswith('-') and len(token) > 1 and not re.match(r'^-[\d.]', token):
+            if k + 1 < len(tokens) and (not tokens[k + 1].startswith('-') or re.match(r'^-[\d.]', tokens[k + 1])):
+                options[token[1:]] = tokens[k + 1]
+            else:
+                options[token[1:]] = ''
+
+    return options
+
+
+def get_physics(options, dynamics=None):
+    '''
+    Return (ssa, hydro) flags, 1 if the SSA is solved (ssa+sia stress
+    balance or hybrid dynamics) and 1 if a routing or distributed
+    hydrology model is used
+    '''
+
+    ssa = 0
+    if options.get('stress_balance', '') in ('ssa', 'ssa+sia') or 'ssa_sliding' in options:
+        ssa = 1
+    if dynamics in ('hybrid',):
+        ssa = 1
+    hydro = 0
+    if options.get('hydrology', 'null') in ('routing', 'distributed'):
+        hydro = 1
+
+    return ssa, hydro
+
+
+def get_pism_command(history):
+    '''
+    Return the PISM command line of a history attribute. NCO and PISM
+    prepend their lines, so the last line is the oldest entry, not
+    necessarily the PISM run
+    '''
+
+    for line in history.splitlines():
+        if 'pism' in line and ' -' in line:
+            return line
+
+    return ''
+
+
+def read_run_stats(filename):
+    '''
+    Return a record with the grid size, core count, physics and model
+    years per wall clock hour of a PISM output file, or None if it has
+    no run_stats
+    '''
+
+    try:
+        nc = CDF(filename, 'r')
+    except (IOError, OSError, RuntimeError):
+        return None
+    if 'run_stats' not in nc.variables:
+        nc.close()
+        return None
+    stats = nc.variables['run_stats']
+    options = parse_options(get_pism_command(getattr(nc, 'history', '')))
+    try:
+        wall_hours = float(stats.wall_clock_hours)
+        processor_hours = float(stats.processor_hours)
+        years_per_processor_hour = float(stats.model_years_per_processor_hour)
+    except (AttributeError, ValueError):
+        nc.close()
+        return None
+
+    record = OrderedDict()
+    record['file'] = filename
+    record['outfile'] = os.path.basename(filename)
+    record['cores'] = int(round(processor_hours / wall_hours)) if wall_hours > 0 else None
+    record['wall_hours'] = wall_hours
+    record['years_per_hour'] = years_per_processor_hour * processor_hours / wall_hours if wall_hours > 0 else None
+    record['Mx'] = len(nc.dimensions['x']) if 'x' in nc.dimensions else int(float(options.get('Mx', 0)))
+    record['My'] = len(nc.dimensions['y']) if 'y' in nc.dimensions else int(float(options.get('My', 0)))
+    record['Mz'] = len(nc.dimensions['z']) if 'z' in nc.dimensions else int(float(options.get('Mz', 0)))
+    record['ssa'], record['hydro'] = get_physics(options)
+    nc.close()
+
+    return record
+
+
+def parse_job_log(filename):
+    '''
+    Return a record with the core count, physics and output file of a
+    job log written by run.sh/run_main.sh, or None if it has none
+    '''
+
+    record = OrderedDict()
+    record['log'] = filename
+    options = {}
+    dynamics = None
+    with open(filename, 'r', errors='replace') as f:
+        for line in f:
+            m = NN_PATTERN.search(line) or STARTED_PATTERN.search(line)
+            if m is not None:
+                record['cores'] = int(m.group(1))
+            m = PARAMS_PATTERN.search(line)
+            if m is not None:
+                options.update(parse_options(m.group(1)))
+            m = DYNAMICS_PATTERN.search(line)
+            if m is not None:
+                options.update(parse_options(m.group(1)))
+            m = HEADER_PATTERN.search(line)
+            if m is not None:
+                dynamics = m.group(1)
+            m = OUTPUT_PATTERN.search(line)
+            if m is not None:
+                record['outfile'] = os.path.basename(m.group(1))
+    if 'outfile' not in record:
+        return None
+    record['ssa'], record['hydro'] = get_physics(options, dynamics=dynamics)
+
+    return record
+
+
+def collect_records(filenames):
+    '''
+    Return the records of the netCDF files among filenames, completed
+    with the core count and physics of the job logs among filenames
+    writing the same output file
+    '''
+
+    records = OrderedDict()
+    logs = []
+    for filename in filenames:
+        if filename.endswith('.nc'):
+            record = read_run_stats(filename)
+            if record is not None:
+                records[record['outfile']] = record
+        else:
+            record = parse_job_log(filename)
+            if record is not None:
+                logs.append(record)
+
+    for log in logs:
+        record = records.get(log['outfile'])
+        if record is None:
+            continue
+        # the log knows about run script options missing from the history
+        record['cores'] = log.get('cores', record['cores'])
+        record['ssa'] = max(record['ssa'], log['ssa'])
+        record['hydro'] = max(record['hydro'], log['hydro'])
+
+    return [r for r in records.values() if r['cores'] and r['years_per_hour'] and r['Mx'] and r['Mz']]
+
+
+def get_features(cores, mx, my, mz, ssa, hydro):
+    '''
+    Return the feature vector of the sizing model
+    '''
+
+    return [1., np.log(cores), np.log(float(mx) * float(my)), np.log(mz), float(ssa), float(hydro)]
+
+
+def fit_model(records):
+    '''
+    Fit the sizing model to records (see collect_records) and return it
+    as a dict with the coefficients and the residual standard deviation
+    of log(years/hour)
+    '''
+
+    if not records:
+        raise ValueError('no runs with run_stats found')
+    A = np.array([get_features(r['cores'], r['Mx'], r['My'], r['Mz'], r['ssa'], r['hydro']) for r in records])
+    b = np.log([r['years_per_hour'] for r in records])
+    coeffs = np.linalg.lstsq(A, b, rcond=None)[0]
+    residuals = b - A.dot(coeffs)
+
+    model = OrderedDict()
+    model['features'] = list(FEATURES)
+    model['coefficients'] = [float(c) for c in coeffs]
+    model['sigma'] = float(np.std(residuals)) if len(records) > 1 else 0.
+    model['n_runs'] = len(records)
+
+    return model
+
+
+def save_model(model, filename=SIZING_MODEL):
+    '''
+    Write a sizing model to a JSON file
+    '''
+
+    with open(filename, 'w') as f:
+        json.dump(model, f, indent=2)
+
+
+def load_model(filename=SIZING_MODEL):
+    '''
+    Read a sizing model from a JSON file
+    '''
+
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def predict_years_per_hour(model, cores, mx, my, mz, ssa=1, hydro=0):
+    '''
+    Return the predicted model years per wall clock hour
+    '''
+
+    return float(np.exp(np.dot(model['coefficients'], get_features(cores, mx, my, mz, ssa, hydro))))
+
+
+def get_cores_choices(system, queue, max_nodes=MAX_NODES):
+    '''
+    Return the core counts of whole nodes of a queue
+    '''
+
+    if system in ('debug',):
+        return [1, 2, 4, 8, 16, 32, 64]
+    ppn = systems[system][queue]
+
+    return [ppn * n for n in range(1, max_nodes + 1)]
+
+
+def suggest_job_size(model, grid, years, stress_balance='ssa+sia', hydrology='null', cores_choices=None,
+                     max_walltime=MAX_WALLTIME, safety=SAFETY):
+    '''
+    Return (cores, walltime) for a run of years model years on grid:
+    the smallest core count of cores_choices whose predicted walltime,
+    inflated by safety and one standard deviation of the fit, is below
+    max_walltime, or the fastest choice if none is. Walltimes are
+    rounded up to 15 minutes.
+    '''
+
+    if cores_choices is None:
+        cores_choices = [16, 32, 64, 128, 256, 512]
+    grid_dict = generate_grid_description(grid)
+    ssa, hydro = get_physics({'stress_balance': stress_balance, 'hydrology': hydrology})
+    factor = safety * np.exp(model.get('sigma', 0.))
+    limit = walltime_to_seconds(max_walltime)
+
+    fastest = None
+    for cores in sorted(cores_choices):
+        rate = predict_years_per_hour(model, cores, grid_dict['Mx'], grid_dict['My'], grid_dict['Mz'], ssa, hydro)
+        seconds = int(np.ceil(abs(years) / rate * 3600. * factor / 900.) * 900)
+        if seconds <= limit:
+            return cores, seconds_to_walltime(seconds)
+        if fastest is None or seconds < fastest[1]:
+            fastest = (cores, seconds)
+
+    return fastest[0], max_walltime
+
+
+def get_member_physics(member):
+    '''
+    Return (years, stress_balance, hydrology) of an ensemble member (see
+    ensemble.make_member): the model years of all its runs, 'ssa+sia' if
+    any run uses hybrid dynamics or the SSA, and the first hydrology
+    model other than null (see resume.get_run_years for the years)
+    '''
+
+    from resume import RUN_SCRIPTS, get_run_years
+
+    years = 0.
+    stress_balance = 'sia'
+    hydrology = 'null'
+    for run in member['runs']:
+        run_years = get_run_years(run)
+        if run_years is not None:
+            years += abs(run_years)
+        args = [str(arg) for arg in run['args']]
+        options = parse_options(str(run['params'].get('PISM_PARAMS', '')).strip("'\""))
+        # run.sh takes the dynamics as argument, run_main.sh the stress balance in PISM_PARAMS
+        dynamics = None
+        if run['run_script'] in ('./run.sh',) and len(args) > 4:
+            dynamics = args[4]
+        ssa, hydro = get_physics(options, dynamics=dynamics)
+        if ssa:
+            stress_balance = 'ssa+sia'
+        n = RUN_SCRIPTS.get(run['run_script'])
+        if n is not None and len(args) >= n and args[n - 1] not in ('null',) and hydrology in ('null',):
+            hydrology = args[n - 1]
+
+    return years, stress_balance, hydrology
+
+
+def suggest_member_size(model, member, cores_choices=None, max_walltime=MAX_WALLTIME):
+    '''
+    Return (cores, walltime) of the job script of an ensemble member
+    from its grid, stress balance, hydrology and model years (see
+    get_member_physics and suggest_job_size)
+    '''
+
+    years, stress_balance, hydrology = get_member_physics(member)
+
+    return suggest_job_size(model, member['grid'], years, stress_balance=stress_balance, hydrology=hydrology,
+                            cores_choices=cores_choices, max_walltime=max_walltime)
+
+
+if __name__ == "__main__":
+
+    # set up the option parser
+    parser = ArgumentParser()
+    parser.description = "Fit a wall-time model to past runs and suggest core counts and walltimes."
+    subparsers = parser.add_subparsers(dest="command")
+
+    fit_parser = subparsers.add_parser("fit", help="fit the sizing model to job logs and PISM output files")
+    fit_parser.add_argument("FILE", nargs='+',
+                            help="job logs (job.*) and output files with run_stats; globs are expanded")
+    fit_parser.add_argument("-o", "--output", dest="output",
+                            help="sizing model file. default={}".format(SIZING_MODEL), default=SIZING_MODEL)
+
+    predict_parser = subparsers.add_parser("predict", help="suggest cores and walltime of a run")
+    predict_parser.add_argument("MODEL", nargs=1,
+                                help="sizing model file")
+    predict_parser.add_argument("-g", "--grid", dest="grid", type=int,
+                                help="horizontal grid resolution", default=1500)
+    predict_parser.add_argument("--years", dest="years", type=float,
+                                help="model years of the run", default=100.)
+    predict_parser.add_argument("--stress_balance", dest="stress_balance",
+                                choices=['sia', 'ssa+sia'],
+                                help="stress balance solver", default='ssa+sia')
+    predict_parser.add_argument("--hydrology", dest="hydrology",
+                                choices=['null', 'routing', 'distributed'],
+                                help="hydrology model", default='null')
+    predict_parser.add_argument("-s", "--system", dest="system",
+                                choices=['pleiades', 'fish', 'pacman', 'debug'],
+                                help="computer system to use.", default='pacman')
+    predict_parser.add_argument("-q", '--queue', dest="queue",
+                                help='''queue. default=standard_4.''', default='standard_4')
+    predict_parser.add_argument("-w", '--max_wall_time', dest="max_walltime",
+                                help='''walltime limit. default: {}.'''.format(MAX_WALLTIME), default=MAX_WALLTIME)
+
+    options = parser.parse_args()
+
+    if options.command in ('fit',):
+        filenames = []
+        for pattern in options.FILE:
+            filenames.extend(sorted(glob.glob(pattern)) or [pattern])
+        records = collect_records(filenames)
+        for r in records:
+            print('{outfile:60} {cores:5d} cores {Mx:5d}x{My:<5d} Mz {Mz:4d} ssa {ssa} hydro {hydro}  {years_per_hour:10.3f} a/h'.format(**r))
+        model = fit_model(records)
+        save_model(model, options.output)
+        print('\nfitted {} runs, residual std of log(years/hour) {:.3f}, wrote {}'.format(
+            model['n_runs'], model['sigma'], options.output))
+    elif options.command in ('predict',):
+        model = load_model(options.MODEL[0])
+        cores, walltime = suggest_job_size(model, options.grid, options.years,
+                                           stress_balance=options.stress_balance, hydrology=options.hydrology,
+                                           cores_choices=get_cores_choices(options.system, options.queue),
+                                           max_walltime=options.max_walltime)
+        print('-n {} -w {}'.format(cores, walltime))
+    else:
+        parser.print_help()
+        sys.exit(1)
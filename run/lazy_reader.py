@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# Copyright (C) 2015 Andy Aschwanden
+
+# Lazy, block-cached access to PISM output. Opening a file reads no
+# data; a variable is a view restricted to a time range and a named
+# region (see regional_subset.REGIONS) or box, and slicing it reads only
+# the blocks it overlaps: BLOCK_RECORDS time records by BLOCK_SIZE x
+# BLOCK_SIZE grid points (other dimensions whole). Blocks are kept in an
+# LRU cache of at most CACHE_BYTES per file, so repeated reads of
+# neighbouring slices do not go back to disk and memory use does not
+# depend on the size of a variable, e.g. 3D fields on the 150 m grid
+# (Mx=10560, My=18240).
+#
+# Example
+# -------
+# >>> ds = LazyDataset('g150m_out.nc', region='Jakobshavn', time_range=(0., 3.15e8))
+# >>> thk = ds.variables['thk']
+# >>> thk.shape, thk.dimensions
+# >>> last = thk[-1]
+# >>> ds.close()
+#
+# $ lazy_reader.py -r Jakobshavn -v thk,velsurf_mag g150m_out.nc
+
+import itertools
+import numpy as np
+from collections import OrderedDict
+from argparse import ArgumentParser
+
+try:
+    from netCDF3 import Dataset as CDF
+except:
+    from netCDF4 import Dataset as CDF
+
+BLOCK_RECORDS = 1
+BLOCK_SIZE = 256
+CACHE_BYTES = 256 * 1024 ** 2
+
+
+class LazyDataset(object):
+    '''
+    Lazy view of a netCDF file, restricted to variables, a region and a
+    time range
+
+    Parameters
+    ----------
+    filename : netCDF file
+    variables : names of the variables to expose, default all
+    region : name of a region in regional_subset.REGIONS or a box
+             (xmin, xmax, ymin, ymax) in the units of x and y
+    time_range : (start, end) in the units of the time variable,
+                 both included
+    block_records, block_size : block shape along time and x/y
+    cache_bytes : size of the LRU block cache
+    '''
+
+    def __init__(self, filename, variables=None, region=None, time_range=None, block_records=BLOCK_RECORDS,
+                 block_size=BLOCK_SIZE, cache_bytes=CACHE_BYTES):
+        self.filename = filename
+        self.nc = CDF(filename, 'r')
+        self.block_records = block_records
+        self.block_size = block_size
+        self.cache_bytes = cache_bytes
+        self.cache = OrderedDict()
+        self.cached_bytes = 0
+        self.reads = 0
+
+        # index ranges of the view, per dimension
+        self.ranges = {}
+        if region is not None:
+            from regional_subset import REGIONS, get_region_boxes, get_box_slices
+            if isinstance(region, str):
+                box = get_region_boxes(OrderedDict([(region, REGIONS[region])]))[region]
+            else:
+                box = tuple(region)
+            slices = get_box_slices(self.nc.variables['x'][:], self.nc.variables['y'][:], box)
+            if slices is None:
+                raise ValueError('region {} is outside the grid of {}'.format(region, filename))
+            self.ranges['x'] = (slices[0].start, slices[0].stop)
+            self.ranges['y'] = (slices[1].start, slices[1].stop)
+        if time_range is not None and 'time' in self.nc.variables:
+            t = self.nc.variables['time'][:]
+            k = np.flatnonzero((t >= time_range[0]) & (t <= time_range[1]))
+            if len(k) == 0:
+                self.ranges['time'] = (0, 0)
+            else:
+                self.ranges['time'] = (k[0], k[-1] + 1)
+
+        if variables is None:
+            variables = list(self.nc.variables.keys())
+        self.variables = OrderedDict([(name, LazyVariable(self, name)) for name in variables])
+
+    def read_block(self, name, block):
+        '''
+        Return block (a tuple of block indices) of variable name, from
+        the cache if possible
+        '''
+
+        key = (name, block)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        var = self.nc.variables[name]
+        index = tuple([slice(b * s, min((b + 1) * s, n)) for b, s, n in
+                       zip(block, self.get_block_shape(name), var.shape)])
+        data = var[index]
+        dtype = self.get_dtype(name)
+        if dtype.kind in ('f',):
+            # fill values, also of packed integer variables, become NaN
+            data = np.ma.filled(np.ma.masked_invalid(np.ma.asarray(data).astype(dtype)), np.nan)
+        else:
+            data = np.ma.getdata(data)
+        self.reads += 1
+
+        self.cache[key] = data
+        self.cached_bytes += data.nbytes
+        while self.cached_bytes > self.cache_bytes and len(self.cache) > 1:
+            old_key, old = self.cache.popitem(last=False)
+            self.cached_bytes -= old.nbytes
+
+        return data
+
+    def get_dtype(self, name):
+        '''
+        Return the dtype of the values of variable name: float64 for
+        packed variables (scale_factor, add_offset) and integer variables
+        with fill values, which are returned as NaN, else the dtype on
+        disk
+        '''
+
+        var = self.nc.variables[name]
+        attrs = var.ncattrs()
+        if any([a in attrs for a in ('scale_factor', 'add_offset')]):
+            return np.dtype('float64')
+        if var.dtype.kind in ('i', 'u') and any([a in attrs for a in ('_FillValue', 'missing_value',
+                                                                       'valid_min', 'valid_max', 'valid_range')]):
+            return np.dtype('float64')
+
+        return np.dtype(var.dtype)
+
+    def get_block_shape(self, name):
+        '''
+        Return the block shape of variable name
+        '''
+
+        var = self.nc.variables[name]
+        shape = []
+        for dim, size in zip(var.dimensions, var.shape):
+            if dim in ('time',):
+                shape.append(self.block_records)
+            elif dim in ('x', 'y'):
+                shape.append(self.block_size)
+            else:
+                shape.append(max(size, 1))
+
+        return tuple(shape)
+
+    def close(self):
+        self.cache.clear()
+        self.cached_bytes = 0
+        self.nc.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class LazyVariable(object):
+    '''
+    Variable of a LazyDataset. Indexing with integers, slices and
+    Ellipsis reads only the blocks that are needed.
+    '''
+
+    def __init__(self, dataset, name):
+        self.dataset = dataset
+        self.name = name
+        var = dataset.nc.variables[name]
+        self.dimensions = var.dimensions
+        self.dtype = dataset.get_dtype(name)
+        self.offsets = []
+        shape = []
+        for dim, size in zip(var.dimensions, var.shape):
+            start, stop = dataset.ranges.get(dim, (0, size))
+            self.offsets.append(int(start))
+            shape.append(int(stop - start))
+        self.shape = tuple(shape)
+        self.ndim = len(shape)
+
+    def ncattrs(self):
+        return self.dataset.nc.variables[self.name].ncattrs()
+
+    def __getattr__(self, attr):
+        # netCDF attributes of the variable
+        if attr in ('dataset', 'name'):
+            raise AttributeError(attr)
+        return getattr(self.dataset.nc.variables[self.name], attr)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any([k is Ellipsis for k in key]):
+            k = [n for n, v in enumerate(key) if v is Ellipsis][0]
+            key = key[:k] + (slice(None),) * (self.ndim - len(key) + 1) + key[k + 1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        if len(key) > self.ndim:
+            raise IndexError('too many indices for {}'.format(self.name))
+
+        if self.ndim == 0:
+            return self.dataset.nc.variables[self.name].getValue()
+
+        # absolute, contiguous ranges to read and the steps applied after
+        starts, stops, steps, drop = [], [], [], []
+        for k, size, offset in zip(key, self.shape, self.offsets):
+            if isinstance(k, slice):
+                start, stop, step = k.indices(size)
+                if step < 0:
+                    start, stop = stop + 1, start + 1
+                if stop <= start:
+                    start = stop = 0
+                starts.append(offset + start)
+                stops.append(offset + stop)
+                steps.append(step)
+                drop.append(False)
+            else:
+                k = int(k)
+                if k < 0:
+                    k += size
+                if k < 0 or k >= size:
+                    raise IndexError('index {} is out of bounds for size {}'.format(k, size))
+                starts.append(offset + k)
+                stops.append(offset + k + 1)
+                steps.append(1)
+                drop.append(True)
+
+        out = np.empty([b - a for a, b in zip(starts, stops)], dtype=self.dtype)
+        block_shape = self.dataset.get_block_shape(self.name)
+        if out.size > 0:
+            ranges = [range(a // s, (b - 1) // s + 1) for a, b, s in zip(starts, stops, block_shape)]
+            for block in itertools.product(*ranges):
+                data = self.dataset.read_block(self.name, block)
+                src, dst = [], []
+                for b, s, a, e in zip(block, block_shape, starts, stops):
+                    lo = max(a, b * s)
+                    hi = min(e, (b + 1) * s)
+                    src.append(slice(lo - b * s, hi - b * s))
+                    dst.append(slice(lo - a, hi - a))
+                out[tuple(dst)] = data[tuple(src)]
+
+        out = out[tuple([slice(None, None, step) for step in steps])]
+        out = out[tuple([0 if d else slice(None) for d in drop])]
+
+        return out
+
+
+if __name__ == "__main__":
+
+    # set up the option parser
+    parser = ArgumentParser()
+    parser.description = "Summarize variables of a PISM file through the lazy, block-cached reader."
+    parser.add_argument("FILE", nargs=1)
+    parser.add_argument("-v", "--variables", dest="variables",
+                        help="comma-separated list of variables. default: all", default=None)
+    parser.add_argument("-r", "--region", dest="region",
+                        help="named region, see regional_subset.py", default=None)
+    parser.add_argument("-t", "--time_range", dest="time_range",
+                        help="start,end in units of the time variable", default=None)
+    parser.add_argument("--cache_mb", dest="cache_mb", type=float,
+                        help="block cache size in MB. default={}".format(CACHE_BYTES // 1024 ** 2),
+                        default=CACHE_BYTES // 1024 ** 2)
+
+    options = parser.parse_args()
+
+    variables = options.variables.split(',') if options.variables is not None else None
+    time_range = [float(t) for t in options.time_range.split(',')] if options.time_range is not None else None
+    with LazyDataset(options.FILE[0], variables=variables, region=options.region, time_range=time_range,
+                     cache_bytes=int(options.cache_mb * 1024 ** 2)) as ds:
+        for name, var in ds.variables.items():
+            if var.ndim == 0 or var.dtype.kind not in ('f', 'i', 'u'):
+                continue
+            # reduce one record at a time
+            if var.dimensions[0] in ('time',) and var.ndim > 1:
+                records = [var[k] for k in range(var.shape[0])]
+            else:
+                records = [var[:]]
+            lo = min([np.nanmin(r) if r.size else np.inf for r in records])
+            hi = max([np.nanmax(r) if r.size else -np.inf for r in records])
+            print('{:20} {:24} {:>20} min {:g} max {:g}'.format(name, ','.join(var.dimensions), str(var.shape), lo, hi))
+        print('{} block reads'.format(ds.reads))
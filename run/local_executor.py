@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# Copyright (C) 2015 Andy Aschwanden
+
+# Run the jobs of a generated submit script on a workstation or a single
+# node instead of submitting them with qsub. Jobs are started as soon as
+# the jobs they depend on have succeeded (-W depend=afterok:...) or
+# ended (afterany), and the sum of MPI ranks of all running jobs never
+# exceeds the available cores. Job IDs collected in a shell variable
+# (JOBIDS="$JOBIDS:$JOBID") are expanded.
+# The output of each job goes to its own log file in LOG_DIR instead of
+# being piped through 'tee job.${PBS_JOBID}'.
+#
+# Serial, job array and packed submit scripts (see ensemble.py, chain.py
+# and submit.py) are understood. Packed jobs get a local $PBS_NODEFILE.
+#
+# Example
+# -------
+# $ local_executor.py -n 16 submit_greenland_g9000m_const_ctrl_hirham.sh
+
+import os
+import re
+import sys
+import time
+import shlex
+import subprocess
+import multiprocessing
+from collections import OrderedDict
+from argparse import ArgumentParser
+
+LOG_DIR = 'logs'
+# '| tee job.${PBS_JOBID}' appended by generate_run_command
+TEE_PATTERN = re.compile(r'\s*\|\s*tee\s+\S+')
+QSUB_PATTERN = re.compile(r'^\s*(?:(\w+)=\$\()?qsub\s+(.*?)\)?\s*$')
+RANKS_PATTERN = re.compile(r'\./run(?:_main)?\.sh\s+(\d+)')
+NODES_PATTERN = re.compile(r'^#PBS\s+-l\s*(?:nodes|select)=(\d+):(?:ppn|ncpus)=(\d+)', re.M)
+ARRAY_PATTERN = re.compile(r'^#PBS\s+-[Jt]\s+(\d+)-(\d+)', re.M)
+# JOBIDS="$JOBIDS:$JOBID"
+COLLECT_PATTERN = re.compile(r'^\s*(\w+)="?\$\{?(\w+)\}?:\$\{?(\w+)\}?"?\s*$')
+
+
+def parse_submit_script(submit):
+    '''
+    Return an OrderedDict of jobs, name -> dict with 'script', 'parents'
+    and 'any_parents' (afterany, i.e. parents that only need to end),
+    from the qsub calls of a submit script. Jobs not assigned to a shell
+    variable get a generated name. A dependency on a variable that holds
+    no job is an error.
+    '''
+
+    jobs = OrderedDict()
+    # a variable reused by the submit script (e.g. JOBID) refers to the
+    # latest job assigned to it, a collecting variable to a list of jobs
+    latest = {}
+    collected = {}
+    with open(submit, 'r') as f:
+        for line in f:
+            m = COLLECT_PATTERN.match(line)
+            if m is not None and m.group(1) == m.group(2):
+                if m.group(3) not in latest:
+                    raise ValueError('{} collects {}, which holds no job'.format(m.group(1), m.group(3)))
+                collected.setdefault(m.group(1), []).append(latest[m.group(3)])
+                continue
+            m = QSUB_PATTERN.match(line)
+            if m is None:
+                continue
+            name, args = m.groups()
+            args = shlex.split(args, posix=False)
+            parents = []
+            any_parents = []
+            for k, arg in enumerate(args[:-1]):
+                if arg in ('-W',) and args[k + 1].startswith('depend='):
+                    # e.g. depend=afterokarray:${A},afterany:${B}:${C}
+                    for clause in args[k + 1][len('depend='):].split(','):
+                        for p in re.findall(r'\$\{?(\w+)\}?', clause):
+                            if p in collected:
+                                keys = collected[p]
+                            elif p in latest:
+                                keys = [latest[p]]
+                            else:
+                                raise ValueError('{} depends on {}, which holds no job'.format(args[-1], p))
+                            parents.extend(keys)
+                            if clause.startswith('afterany'):
+                                any_parents.extend(keys)
+            if name is None:
+                name = 'job'
+            key = name
+            if key in jobs:
+                key = '{}.{}'.format(name, len(jobs))
+            if name not in ('job',):
+                latest[name] = key
+            job = OrderedDict()
+            job['script'] = args[-1]
+            job['parents'] = parents
+            job['any_parents'] = any_parents
+            jobs[key] = job
+
+    return jobs
+
+
+def get_job_ranks(text):
+    '''
+    Return the number of MPI ranks of a job script: the largest number
+    of processes passed to run.sh/run_main.sh, else the cores requested
+    in the PBS header, else 1
+    '''
+
+    ranks = [int(n) for n in RANKS_PATTERN.findall(text)]
+    if ranks:
+        return max(ranks)
+    m = NODES_PATTERN.search(text)
+    if m is not None:
+        return int(m.group(1)) * int(m.group(2))
+
+    return 1
+
+
+def get_array_indices(text):
+    '''
+    Return the indices of a job array script, or [None]
+    '''
+
+    m = ARRAY_PATTERN.search(text)
+    if m is None:
+        return [None]
+
+    return list(range(int(m.group(1)), int(m.group(2)) + 1))
+
+
+def make_tasks(jobs):
+    '''
+    Return a list of tasks, one per job or job array index
+    '''
+
+    tasks = []
+    for key, job in jobs.items():
+        with open(job['script'], 'r') as f:
+            text = TEE_PATTERN.sub('', f.read())
+        ranks = get_job_ranks(text)
+        for index in get_array_indices(text):
+            task = OrderedDict()
+            task['job'] = key
+            task['index'] = index
+            task['script'] = job['script']
+            task['text'] = text
+            task['ranks'] = ranks
+            task['parents'] = job['parents']
+            task['any_parents'] = job['any_parents']
+            task['status'] = 'waiting'
+            tasks.append(task)
+
+    return tasks
+
+
+def get_job_status(tasks):
+    '''
+    Return a dict job -> 'done', 'failed' or None (still running)
+    '''
+
+    status = {}
+    for task in tasks:
+        job = task['job']
+        if task['status'] in ('failed', 'skipped'):
+            status[job] = 'failed'
+        elif task['status'] != 'done' and status.get(job) != 'failed':
+            status[job] = None
+        else:
+            status.setdefault(job, 'done')
+
+    return status
+
+
+def start_task(task, log_dir):
+    '''
+    Start a task in the background and return its Popen object
+    '''
+
+    name = os.path.splitext(os.path.basename(task['script']))[0]
+    jobid = 'local.{}'.format(task['job'])
+    if task['index'] is not None:
+        name = '{}.{}'.format(name, task['index'])
+        jobid = '{}[{}]'.format(jobid, task['index'])
+
+    env = dict(os.environ)
+    env['PBS_JOBID'] = jobid
+    env['PBS_O_WORKDIR'] = os.getcwd()
+    if task['index'] is not None:
+        env['PBS_ARRAYID'] = str(task['index'])
+        env['PBS_ARRAY_INDEX'] = str(task['index'])
+    if 'PBS_NODEFILE' in task['text']:
+        # packed jobs split the node file into one machine file per member
+        nodefile = os.path.join(log_dir, '{}.nodes'.format(name))
+        with open(nodefile, 'w') as f:
+            f.write('localhost\n' * task['ranks'])
+        env['PBS_NODEFILE'] = os.path.abspath(nodefile)
+
+    task['log'] = os.path.join(log_dir, '{}.log'.format(name))
+    log = open(task['log'], 'w')
+    proc = subprocess.Popen(['bash', '-c', task['text'], task['script']], env=env,
+                            stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+
+    return proc
+
+
+def run_tasks(tasks, n_procs, log_dir=LOG_DIR, poll=1.0):
+    '''
+    Run tasks, starting a task once all its parents succeeded (or
+    ended, for any_parents) and enough cores are free. Tasks with more
+    ranks than n_procs run alone.
+    Returns the number of failed or skipped tasks.
+    '''
+
+    try:
+        os.makedirs(log_dir)
+    except OSError:
+        pass
+
+    running = {}
+    free = n_procs
+    while True:
+        status = get_job_status(tasks)
+        for task in tasks:
+            if task['status'] != 'waiting':
+                continue
+            parents = [status[p] for p in task['parents'] if p not in task['any_parents']]
+            if 'failed' in parents:
+                task['status'] = 'skipped'
+                print('skipped  {}'.format(task['script']))
+                continue
+            if None in parents or None in [status[p] for p in task['any_parents']]:
+                continue
+            if task['ranks'] <= free or not running:
+                if task['ranks'] > n_procs:
+                    print('warning: {} needs {} ranks, {} cores available'.format(task['script'], task['ranks'], n_procs))
+                running[id(task)] = (task, start_task(task, log_dir), time.time())
+                task['status'] = 'running'
+                free -= task['ranks']
+                print('started  {} ({} ranks)'.format(task['script'], task['ranks']))
+
+        if not running:
+            break
+
+        time.sleep(poll)
+        for key, (task, proc, t0) in list(running.items()):
+            if proc.poll() is None:
+                continue
+            del running[key]
+            free += task['ranks']
+            task['status'] = 'done' if proc.returncode == 0 else 'failed'
+            print('{:8} {} in {:.0f}s, log {}'.format(task['status'], task['script'], time.time() - t0, task['log']))
+
+    return len([task for task in tasks if task['status'] in ('failed', 'skipped')])
+
+
+if __name__ == "__main__":
+
+    # set up the option parser
+    parser = ArgumentParser()
+    parser.description = "Run the jobs of a submit script locally, honoring afterok and afterany dependencies."
+    parser.add_argument("FILE", nargs=1,
+                        help="submit script written by a spawn generator")
+    parser.add_argument("-n", '--n_procs', dest="n", type=int,
+                        help='''number of cores to use. default: all cores.''', default=multiprocessing.cpu_count())
+    parser.add_argument("--log_dir", dest="log_dir",
+                        help="directory of the per-job log files. default={}".format(LOG_DIR), default=LOG_DIR)
+    parser.add_argument("--dry_run", dest="dry_run", action="store_true",
+                        help="list the jobs and their dependencies without running them", default=False)
+
+    options = parser.parse_args()
+    submit = options.FILE[0]
+
+    try:
+        jobs = parse_submit_script(submit)
+    except ValueError as e:
+        print('error: {}'.format(e))
+        sys.exit(1)
+    tasks = make_tasks(jobs)
+
+    if options.dry_run:
+        for task in tasks:
+            parents = [p + ('(any)' if p in task['any_parents'] else '') for p in task['parents']]
+            print('{:>10} {:>4} ranks  after {:20} {}'.format(task['job'], task['ranks'], ','.join(parents) or '-', task['script']))
+        sys.exit(0)
+
+    failed = run_tasks(tasks, options.n, log_dir=options.log_dir)
+    print('{} of {} tasks succeeded'.format(len(tasks) - failed, len(tasks)))
+    sys.exit(1 if failed else 0)
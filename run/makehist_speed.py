@@ -19,19 +19,17 @@
 
 __author__ = "Andy Aschwanden, University of Alaska Fairbanks"
 
+import sys
 import numpy as np
 import pylab as plt
 from argparse import ArgumentParser
 from operator import itemgetter, attrgetter
 
-try:
-    from netCDF3 import Dataset as CDF
-except:
-    from netCDF4 import Dataset as CDF
 try:
     import pypismtools.pypismtools as ppt
 except:
     import pypismtools as ppt
+from obs_cache import CACHE_DIR, load_observation, read_field
 
 # Number of bins
 NBINS = 50
@@ -186,7 +184,107 @@ def set_mode(mode):
         print("%s mode not recognized, using onecol instead" % mode)
         return set_onecol()
 
-def make_histogram_plot(study,**kwargs):
+def read_valid_values(filename, variable, valid_idx, shape=None):
+    '''
+    Read the last time record of variable from filename and return its
+    values at the flat (y, x) indices valid_idx. Missing values are NaN.
+    Raises ValueError if the grid of filename is not shape.
+    '''
+
+    data, units = read_field(filename, variable)
+    if shape is not None and data.shape != tuple([int(n) for n in shape]):
+        raise ValueError('grid of {} {} does not match the observations {}'.format(
+            filename, data.shape, tuple([int(n) for n in shape])))
+
+    return data.ravel()[valid_idx]
+
+
+def stack_experiments(files, variable, valid_idx, shape=None):
+    '''
+    Return the files on the grid shape and an (experiments, valid
+    cells) array of variable for them. Files on other grids are skipped.
+    '''
+
+    kept = []
+    rows = []
+    for filename in files:
+        try:
+            rows.append(read_valid_values(filename, variable, valid_idx, shape=shape))
+        except ValueError as e:
+            print('  skipped {}'.format(e))
+            continue
+        kept.append(filename)
+    values = np.empty((len(kept), len(valid_idx)))
+    for k, row in enumerate(rows):
+        values[k] = row
+
+    return kept, values
+
+
+def batch_histograms(values, bins, valid):
+    '''
+    Histogram every row of values, counting only cells where valid is
+    True, with one call to np.bincount. Matches np.histogram, i.e. the
+    last bin includes its right edge.
+    '''
+
+    no_experiments = values.shape[0]
+    nbins = len(bins) - 1
+    idx = np.searchsorted(bins, values, side='right') - 1
+    idx[values == bins[-1]] = nbins - 1
+    in_range = valid & (idx >= 0) & (idx < nbins)
+    rows = np.repeat(np.arange(no_experiments), values.shape[1]).reshape(values.shape)
+    flat = rows[in_range] * nbins + idx[in_range]
+    counts = np.bincount(flat, minlength=no_experiments * nbins)
+
+    return counts.reshape(no_experiments, nbins)
+
+
+def batch_statistics(values, obs, outlier):
+    '''
+    Compute outlier masks, RMSE and bias (mean of experiment minus
+    observation) of all experiments at once.
+
+    Returns a dict with 'valid', 'outliers', 'rmse', 'bias' and
+    'no_valid'. A cell is valid if experiment and observation are
+    defined and abs(experiment - obs) <= outlier.
+    '''
+
+    diff = values - obs[np.newaxis, :]
+    defined = np.isfinite(diff)
+    outliers = defined & (np.abs(np.where(defined, diff, 0)) > outlier)
+    valid = defined & ~outliers
+    no_valid = valid.sum(axis=1)
+    diff = np.where(valid, diff, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rmse = np.sqrt((diff ** 2).sum(axis=1) / no_valid)
+        bias = diff.sum(axis=1) / no_valid
+
+    stats = {}
+    stats['valid'] = valid
+    stats['outliers'] = outliers
+    stats['no_valid'] = no_valid
+    stats['rmse'] = rmse
+    stats['bias'] = bias
+
+    return stats
+
+
+def print_statistics(files, stats, obs_range):
+    '''
+    Print RMSE and bias of all experiments, sorted by RMSE
+    '''
+
+    print("\nOverall statistics (sorted by rmse):")
+    print("  {:>10} {:>8} {:>10} {:>8} {:>10}  {}".format('rmse', 'rmse %', 'avg', 'avg %', 'cells', 'file'))
+    for k in np.argsort(stats['rmse']):
+        print("  {:10.2f} {:8.2f} {:10.2f} {:8.2f} {:10d}  {}".format(
+            stats['rmse'][k], stats['rmse'][k] / obs_range * 100,
+            stats['bias'][k], stats['bias'][k] / obs_range * 100,
+            stats['no_valid'][k], files[k]))
+
+
+def make_histogram_plot(hists, titles, **kwargs):
     '''Make a histogram plot with observations and experiments'''
 
     kwargsdict = {}
@@ -215,15 +313,11 @@ def make_histogram_plot(study,**kwargs):
     fig = plt.figure()
     labels = []
     ax = fig.add_subplot(111)
-    ax.plot(x,velsurf_mag_obs.n,obs_marker,markerfacecolor='0.65',markeredgecolor='k')
-    labels.append(velsurf_mag_obs.title)
-    for e in range(0,len(study)):
-        ax.plot(x,study[e].n,exp_markers[e],markerfacecolor=colors[e],markeredgecolor='k')
-        if label_param_list is None:
-            title = study[e].title
-        else:
-            title = ', '.join(["%s = %s" % (key,str(val)) for key,val in study[e].parameter_short_dict.iteritems() if key in label_param_list])
-        labels.append(title)
+    ax.plot(x,observation['hist'],obs_marker,markerfacecolor='0.65',markeredgecolor='k')
+    labels.append('observed')
+    for e in range(0,len(hists)):
+        ax.plot(x,hists[e],exp_markers[e % len(exp_markers)],markerfacecolor=colors[e % len(colors)],markeredgecolor='k')
+        labels.append(titles[e])
 
     ax.set_xlabel("ice surface velocity, m a$^{-1}$")
     ax.set_ylabel("number of grid cells")
@@ -235,16 +329,13 @@ def make_histogram_plot(study,**kwargs):
         ax.legend(explicit_labels,numpoints=1,shadow=True)
     ax.set_yscale("log")
 
-    grid_spacing = study[0].grid_spacing
-    grid_spacing_units = study[0].grid_spacing_units
-    
     for out_format in out_formats:
         if out_file is None:
             ## out_file = "g" + str(grid_spacing) + grid_spacing_units + "_" + param1 + "_" + str(value1) + "_" + param2 + "_" + str(value2) + "." + out_format
             out_file = param1 + "_" + str(value1) + "_" + param2 + "_" + str(value2) + "." + out_format
         else:
             out_file = out_file + "." + out_format
-        print "  - writing image %s ..." % out_file
+        print("  - writing image %s ..." % out_file)
         fig.savefig(out_file ,bbox_inches='tight',pad_inches=pad_inches,dpi=out_res)
         plt.close()
         del fig
@@ -263,12 +354,18 @@ if __name__ == "__main__":
                       help="Debugging mode",default=False)
     parser.add_argument("-f", "--output_format",dest="out_formats",
                       help="Comma-separated list with output graphics suffix, default = pdf",default='pdf')
-    parser.add_argument("--bins",dest="Nbins",
+    parser.add_argument("--bins",dest="Nbins",type=int,
                       help="  specifies the number of bins",default=NBINS)
-    parser.add_argument("--histmax",dest="histmax",
+    parser.add_argument("--histmax",dest="histmax",type=float,
                       help="  max velocity (m/a) used in histogram",default=HISTMAX)
-    parser.add_argument("--outlier",dest="outlier",
+    parser.add_argument("--outlier",dest="outlier",type=float,
                       help=" speed difference (m/a) above which velocities are not used in histogramm",default=OUTLIER_THRESHOLD)
+    parser.add_argument("--cache_dir",dest="cache_dir",
+                      help="directory caching the masked observations, default = %s" % CACHE_DIR,default=CACHE_DIR)
+    parser.add_argument("--no_cache",dest="no_cache",action="store_true",
+                      help="do not cache the masked observations",default=False)
+    parser.add_argument("--field_store",dest="store_dir",
+                      help="take boot and observed fields from this shared field store (see field_store.py)",default=None)
     parser.add_argument("-l", "--labels",dest="labels",
                   help="comma-separated list with labels, put in quotes like \
                   'label 1,label 2'",default=None)
@@ -286,7 +383,14 @@ if __name__ == "__main__":
     outlier = options.outlier
     boot_file = options.boot_file
     obs_file = options.obs_file
-    explicit_labels = options.labels.split(',')
+    if options.no_cache:
+        cache_dir = None
+    else:
+        cache_dir = options.cache_dir
+    if options.labels is None:
+        explicit_labels = None
+    else:
+        explicit_labels = options.labels.split(',')
     print_mode = options.print_mode
     out_formats = options.out_formats.split(',')
     out_res = options.out_res
@@ -313,38 +417,28 @@ if __name__ == "__main__":
     bins = np.linspace(vmin, vmax, Nbins+1)
     print("\nBins used in this study:\n  %s" % str(bins))
 
-    # Create observations of ice thickness ('thk') and magnitude of
-    # horizontal surface velocity ('velsurf_mag').
-    thk_obs = ppt.Observation(boot_file, thk_variable, bins)
-    velsurf_mag_obs = ppt.Observation(obs_file, obs_variable, bins)
+    # Masked observations of the magnitude of horizontal surface
+    # velocity ('velsurf_mag') where ice thickness ('thk') > thk_min,
+    # read from the observation cache if possible.
+    print("\n  * Applying mask (%s <= %3.2f), updating histogram" %(thk_variable, thk_min))
+    observation = load_observation(boot_file, obs_file, thk_variable=thk_variable, obs_variable=obs_variable,
+                                   thk_min=thk_min, bins=bins, cache_dir=cache_dir, store_dir=options.store_dir)
+    valid_idx = observation['valid_idx']
+    obs = observation['obs']
+    obs_range = np.ptp(obs)
+
+    print("\n  * Reading {} experiments ({} valid cells)".format(len(args), len(valid_idx)))
+    args, values = stack_experiments(args, variable, valid_idx, shape=observation['shape'])
+    if not args:
+        print("no experiments on the grid of the observations")
+        sys.exit(1)
+    stats = batch_statistics(values, obs, outlier)
+    hists = batch_histograms(values, bins, stats['valid'])
+    titles = [filename.split('/')[-1] for filename in args]
 
-    print("\n  * Applying mask (%s <= %3.2f %s), updating histogram" %(thk_variable, thk_min, thk_obs.units))
-    velsurf_mag_obs.add_mask(thk_obs.values <= thk_min)
     if DEBUG:
-        plot_mapview(velsurf_mag_obs.values, log=True, show=True)
-
-   
-    experiments = []
-    no_experiments = len(args)
-    for k in range(0,no_experiments):
-        filename = args[k]
-        # Create individual experiment from observations and options.
-        experiment = ppt.Experiment(velsurf_mag_obs, outlier, params, abbr_dict, filename, variable, bins)
-        valid_cells = experiment.get_valid_cells()
-        # Some statistics
-        print("  * Statistics")
-        rmse = ppt.get_rmse(experiment.values, velsurf_mag_obs.values, valid_cells)
-        experiment.set_rmse(rmse)
-        print("    - rmse = %3.2f m/a" % rmse)
-        print("    - rmse normalized = %3.2f %%" % (rmse / (np.ptp(velsurf_mag_obs.values)) * 100))
-        avg = ppt.get_avg(experiment.values, velsurf_mag_obs.values, valid_cells)
-        experiment.set_avg(avg)
-        print("    - avg  = %3.2f m/a" % avg)
-        print("    - avg  normalized = %3.2f %%" % (avg / (np.ptp(velsurf_mag_obs.values)) * 100))
-        if DEBUG:
-            plot_mapview(np.abs(velsurf_mag_obs.values-experiment.values),log=True,title='abs(obs-expr)')
-        experiments.append(experiment)
-
+        for k in range(0, len(args)):
+            print("    - {}: {} outliers".format(titles[k], stats['outliers'][k].sum()))
 
     # Histogram plots of observations and experiments
     print("\nMaking histogram plots...")
@@ -358,10 +452,10 @@ if __name__ == "__main__":
     x = bins[:-1:]+width/2
 
     out_file = "speed_histogram"
-    make_histogram_plot(experiments,out_file=out_file,explicit_labels=explicit_labels)
+    make_histogram_plot(hists,titles,out_file=out_file,explicit_labels=explicit_labels)
 
     # Print statistics
-    ppt.print_overall_statistics(experiments)
+    print_statistics(args, stats, obs_range)
 
 
 if DEBUG:
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# Copyright (C) 2015 Andy Aschwanden
+
+'''
+SQLite manifest of ensemble members.
+
+Generators record every member (parameters, grid, input files, scripts,
+output files, job IDs and status) in MANIFEST, so runs can be found by
+their parameters instead of by parsing file names:
+
+$ manifest.py query --grid 1500 ppq=0.6
+$ manifest.py query --status failed --format output
+
+Submit scripts written with a manifest store the job IDs:
+
+$ manifest.py set do_greenland_g1500m_....sh --job_id 12345 --status submitted
+'''
+
+import os
+import sys
+import time
+import sqlite3
+from argparse import ArgumentParser
+
+MANIFEST = 'manifest.sqlite'
+# environment variables of run.sh/run_main.sh holding input files
+INPUT_VARS = ('PISM_DATANAME', 'REGRIDFILE', 'PISM_CONFIG', 'PISM_TIMEFILE', 'PISM_SURFACE_BCFILE',
+              'PISM_SURFACE_BC_FILE', 'PISM_OCEAN_BCFILE')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS members (
+    id INTEGER PRIMARY KEY,
+    script TEXT UNIQUE,
+    post TEXT,
+    domain TEXT,
+    grid INTEGER,
+    experiment TEXT,
+    out_dir TEXT,
+    bed_data_set TEXT,
+    job_id TEXT,
+    status TEXT,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS params (
+    member_id INTEGER,
+    name TEXT,
+    value TEXT,
+    number REAL
+);
+CREATE TABLE IF NOT EXISTS files (
+    member_id INTEGER,
+    kind TEXT,
+    path TEXT
+);
+CREATE INDEX IF NOT EXISTS members_grid ON members (grid);
+CREATE INDEX IF NOT EXISTS members_status ON members (status);
+CREATE INDEX IF NOT EXISTS params_name_value ON params (name, value);
+CREATE INDEX IF NOT EXISTS params_name_number ON params (name, number);
+CREATE INDEX IF NOT EXISTS files_member ON files (member_id);
+CREATE INDEX IF NOT EXISTS files_path ON files (path);
+'''
+
+
+def open_manifest(filename=MANIFEST):
+    '''
+    Open (and create if needed) a manifest database
+    '''
+
+    conn = sqlite3.connect(filename, timeout=60)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+
+    return conn
+
+
+def to_number(value):
+    '''
+    Return value as float, or None if it is not a number
+    '''
+
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_member_params(member):
+    '''
+    Return the parameters of a member: its parameter space combination
+    and the name options it was named after (member['params'])
+    '''
+
+    params = {}
+    params.update(member.get('combination', {}))
+    params.update(member.get('params', {}))
+
+    return params
+
+
+def get_member_files(member):
+    '''
+    Return a list of (kind, path) of the input, output and
+    post-processed files of a member
+    '''
+
+    files = []
+    for run in member['runs']:
+        for var in INPUT_VARS:
+            if run['params'].get(var):
+                files.append(('input', str(run['params'][var])))
+        files.append(('output', run['outfile']))
+        files.append(('processed', os.path.join(member['out_dir'], run['outfile'])))
+
+    return files
+
+
+def record_member(conn, member, status='generated'):
+    '''
+    Insert or replace a member, keyed by its job script
+    '''
+
+    cur = conn.execute('SELECT id FROM members WHERE script = ?', (member['script'],))
+    row = cur.fetchone()
+    if row is not None:
+        member_id = row['id']
+        conn.execute('DELETE FROM params WHERE member_id = ?', (member_id,))
+        conn.execute('DELETE FROM files WHERE member_id = ?', (member_id,))
+        conn.execute('''UPDATE members SET post = ?, domain = ?, grid = ?, experiment = ?, out_dir = ?,
+                        bed_data_set = ?, job_id = NULL, status = ?, updated = ? WHERE id = ?''',
+                     (member['post'], member['domain'], member['grid'], member['experiment'], member['out_dir'],
+                      member['bed_data_set'], status, time.time(), member_id))
+    else:
+        cur = conn.execute('''INSERT INTO members (script, post, domain, grid, experiment, out_dir, bed_data_set,
+                              status, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                           (member['script'], member['post'], member['domain'], member['grid'],
+                            member['experiment'], member['out_dir'], member['bed_data_set'], status, time.time()))
+        member_id = cur.lastrowid
+
+    conn.executemany('INSERT INTO params (member_id, name, value, number) VALUES (?, ?, ?, ?)',
+                     [(member_id, k, str(v), to_number(v)) for k, v in get_member_params(member).items()])
+    conn.executemany('INSERT INTO files (member_id, kind, path) VALUES (?, ?, ?)',
+                     [(member_id, kind, path) for kind, path in get_member_files(member)])
+
+    return member_id
+
+
+def record_members(filename, members, status='generated'):
+    '''
+    Record members in the manifest filename in one transaction
+    '''
+
+    conn = open_manifest(filename)
+    with conn:
+        for member in members:
+            record_member(conn, member, status=status)
+    conn.close()
+
+
+def set_member(conn, script, job_id=None, status=None):
+    '''
+    Set the job ID and/or status of the member with job script script
+    '''
+
+    if job_id is not None:
+        conn.execute('UPDATE members SET job_id = ?, updated = ? WHERE script = ?', (job_id, time.time(), script))
+    if status is not None:
+        conn.execute('UPDATE members SET status = ?, updated = ? WHERE script = ?', (status, time.time(), script))
+
+
+def get_job_ids(filename):
+    '''
+    Return a dict job script -> job ID of all members with a job ID
+    '''
+
+    conn = open_manifest(filename)
+    job_ids = dict([(row['script'], row['job_id']) for row in
+                    conn.execute('SELECT script, job_id FROM members WHERE job_id IS NOT NULL')])
+    conn.close()
+
+    return job_ids
+
+
+def query_members(conn, grid=None, status=None, experiment=None, **params):
+    '''
+    Return members matching grid, status, an experiment name pattern
+    (SQL LIKE) and parameter values, as a list of dicts with 'params'
+    and 'files'. Numeric parameters are compared as numbers.
+    '''
+
+    where = []
+    values = []
+    if grid is not None:
+        where.append('m.grid = ?')
+        values.append(int(grid))
+    if status is not None:
+        where.append('m.status = ?')
+        values.append(status)
+    if experiment is not None:
+        where.append('m.experiment LIKE ?')
+        values.append(experiment)
+    for name, value in params.items():
+        number = to_number(value)
+        if number is not None:
+            where.append('m.id IN (SELECT member_id FROM params WHERE name = ? AND number = ?)')
+            values.extend([name, number])
+        else:
+            where.append('m.id IN (SELECT member_id FROM params WHERE name = ? AND value = ?)')
+            values.extend([name, str(value)])
+
+    sql = 'SELECT * FROM members m'
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY m.id'
+
+    members = []
+    for row in conn.execute(sql, values).fetchall():
+        member = dict(row)
+        member['params'] = dict([(r['name'], r['value']) for r in
+                                 conn.execute('SELECT name, value FROM params WHERE member_id = ?', (row['id'],))])
+        member['files'] = [(r['kind'], r['path']) for r in
+                           conn.execute('SELECT kind, path FROM files WHERE member_id = ?', (row['id'],))]
+        members.append(member)
+
+    return members
+
+
+def get_member_paths(member, kind):
+    '''
+    Return the paths of kind ('input', 'output', 'processed') of a
+    member returned by query_members
+    '''
+
+    return [path for k, path in member['files'] if k == kind]
+
+
+if __name__ == "__main__":
+
+    # set up the option parser
+    parser = ArgumentParser()
+    parser.description = "Query and update the ensemble manifest."
+    parser.add_argument("-f", "--manifest", dest="manifest",
+                        help="manifest file. default={}".format(MANIFEST), default=MANIFEST)
+    subparsers = parser.add_subparsers(dest="command")
+
+    query_parser = subparsers.add_parser("query", help="list members")
+    query_parser.add_argument("PARAM", nargs='*',
+                              help="parameter values, e.g. ppq=0.6")
+    query_parser.add_argument("-g", "--grid", dest="grid", type=int,
+                              help="horizontal grid resolution", default=None)
+    query_parser.add_argument("--status", dest="status",
+                              help="member status", default=None)
+    query_parser.add_argument("--experiment", dest="experiment",
+                              help="experiment name pattern, e.g. '%%calving_k_1e+18%%'", default=None)
+    query_parser.add_argument("--format", dest="format",
+                              choices=['table', 'script', 'post', 'output', 'processed', 'input', 'experiment'],
+                              help="print a table or one path per line. default=table", default='table')
+
+    set_parser = subparsers.add_parser("set", help="set job ID or status of a member")
+    set_parser.add_argument("SCRIPT", nargs=1,
+                            help="job script of the member")
+    set_parser.add_argument("--job_id", dest="job_id",
+                            help="job ID", default=None)
+    set_parser.add_argument("--status", dest="status",
+                            help="status, e.g. submitted, done, failed", default=None)
+
+    options = parser.parse_args()
+
+    conn = open_manifest(options.manifest)
+
+    if options.command in ('set',):
+        with conn:
+            set_member(conn, options.SCRIPT[0], job_id=options.job_id, status=options.status)
+    elif options.command in ('query',):
+        params = dict([p.split('=', 1) for p in options.PARAM])
+        members = query_members(conn, grid=options.grid, status=options.status,
+                                experiment=options.experiment, **params)
+        for member in members:
+            if options.format in ('table',):
+                print('{id:5} g{grid}m {status:10} {job_id!s:12} {experiment}'.format(**member))
+            elif options.format in ('script', 'post', 'experiment'):
+                print(member[options.format])
+            else:
+                for path in get_member_paths(member, options.format):
+                    print(path)
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+    conn.close()
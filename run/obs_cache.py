@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# Copyright (C) 2015 Andy Aschwanden
+
+# On-disk cache of masked observation fields for model-observation
+# comparison. The masked observation vector, the flat (y, x) indices of
+# valid cells and the observed histogram are stored as .npy files that
+# are memory-mapped on load. Entries are keyed by the checksums of the
+# boot and observation files (and hence their grid), the variables, the
+# thickness threshold and the histogram bins. The quick checksum covers
+# size, mtime and inode besides the first and last MiB; use --full_checksum to
+# hash whole files when mtimes are not trustworthy.
+#
+# Example
+# -------
+# $ obs_cache.py --boot_file pism_Greenland_1500m_mcb_jpl_v2_ctrl.nc \
+#   --obs_file surf_vels_1500m.nc
+
+import os
+import json
+import hashlib
+import numpy as np
+from argparse import ArgumentParser
+
+from lazy_reader import LazyDataset
+
+CACHE_DIR = '.obs_cache'
+# bytes hashed at the start and the end of a file for the quick checksum
+CHECKSUM_BLOCK = 1024 * 1024
+
+
+def file_checksum(filename, full=False):
+    '''
+    Return a sha1 checksum of filename. Unless full is True, only the
+    file size, modification time and inode, the first and the last
+    CHECKSUM_BLOCK bytes are hashed, which is enough to tell netCDF
+    files apart without reading GBs. An in-place rewrite (e.g. ncap2 -O)
+    changes the mtime, so it does not reuse the checksum of the old
+    contents.
+    '''
+
+    sha = hashlib.sha1()
+    st = os.stat(filename)
+    size = st.st_size
+    sha.update(str(size).encode('utf-8'))
+    with open(filename, 'rb') as f:
+        if full:
+            for block in iter(lambda: f.read(CHECKSUM_BLOCK), b''):
+                sha.update(block)
+        else:
+            sha.update('{}:{}'.format(st.st_mtime, st.st_ino).encode('utf-8'))
+            sha.update(f.read(CHECKSUM_BLOCK))
+            if size > CHECKSUM_BLOCK:
+                f.seek(max(size - CHECKSUM_BLOCK, CHECKSUM_BLOCK))
+                sha.update(f.read(CHECKSUM_BLOCK))
+
+    return sha.hexdigest()
+
+
+def read_field(filename, variable):
+    '''
+    Read the last time record of a 2D variable as a float64 (y, x)
+    array, with missing values set to NaN
+    '''
+
+    # block-wise reads (see lazy_reader.py) keep memory use bounded on fine grids
+    ds = LazyDataset(filename, variables=[variable])
+    var = ds.variables[variable]
+    dims = list(var.dimensions)
+    if 'time' in dims:
+        index = [slice(None)] * len(dims)
+        index[dims.index('time')] = -1
+        data = var[tuple(index)]
+        dims.remove('time')
+    else:
+        data = var[:]
+    if dims.index('x') < dims.index('y'):
+        data = data.T
+    units = getattr(var, 'units', '')
+    ds.close()
+
+    return np.ma.filled(np.ma.masked_invalid(data).astype('float64'), np.nan), units
+
+
+def get_cache_key(meta):
+    '''
+    Return the cache key of the dict returned by get_cache_meta
+    '''
+
+    return hashlib.sha1(json.dumps(meta, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def get_cache_meta(boot_file, obs_file, thk_variable, obs_variable, thk_min, bins, full=False):
+    '''
+    Return the dict of everything a cache entry depends on
+    '''
+
+    meta = {}
+    meta['boot_checksum'] = file_checksum(boot_file, full=full)
+    meta['obs_checksum'] = file_checksum(obs_file, full=full)
+    meta['thk_variable'] = thk_variable
+    meta['obs_variable'] = obs_variable
+    meta['thk_min'] = float(thk_min)
+    meta['bins'] = [float(b) for b in bins]
+
+    return meta
+
+
+def build_observation(boot_file, obs_file, thk_variable, obs_variable, thk_min, bins, store_dir=None):
+    '''
+    Mask obs_variable where thk_variable <= thk_min and return a dict
+    with the valid observations 'obs', their flat (y, x) indices
+    'valid_idx', the observed histogram 'hist', 'bins', the grid 'shape'
+    and the observation 'units'. With store_dir, the fields are taken
+    from the shared field store (see field_store.py).
+    '''
+
+    if store_dir is not None:
+        from field_store import attach_field
+        thk, thk_units = attach_field(boot_file, thk_variable, store_dir=store_dir)
+        values, units = attach_field(obs_file, obs_variable, store_dir=store_dir)
+    else:
+        thk, thk_units = read_field(boot_file, thk_variable)
+        values, units = read_field(obs_file, obs_variable)
+    if thk.shape != values.shape:
+        raise ValueError('grid of {} {} does not match grid of {} {}'.format(boot_file, thk.shape, obs_file, values.shape))
+
+    valid = np.isfinite(values) & np.isfinite(thk) & (thk > thk_min)
+    valid_idx = np.flatnonzero(valid)
+    obs = values.ravel()[valid_idx]
+    hist, bins = np.histogram(obs, bins)
+
+    observation = {}
+    observation['obs'] = obs
+    observation['valid_idx'] = valid_idx
+    observation['hist'] = hist
+    observation['bins'] = np.asarray(bins, dtype='float64')
+    observation['shape'] = np.array(values.shape)
+    observation['units'] = units
+
+    return observation
+
+
+def save_observation(observation, entry_dir, meta):
+    '''
+    Write an observation dict to entry_dir, one .npy file per array
+    '''
+
+    tmp_dir = entry_dir + '.tmp{}'.format(os.getpid())
+    os.makedirs(tmp_dir)
+    for name in ('obs', 'valid_idx', 'hist', 'bins', 'shape'):
+        np.save(os.path.join(tmp_dir, name + '.npy'), observation[name])
+    meta = dict(meta)
+    meta['units'] = observation['units']
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2, sort_keys=True)
+    # another process may have filled the entry in the meantime
+    try:
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        import shutil
+        shutil.rmtree(tmp_dir)
+
+
+def read_observation(entry_dir, mmap_mode='r'):
+    '''
+    Read a cached observation dict, memory-mapping its arrays
+    '''
+
+    observation = {}
+    for name in ('obs', 'valid_idx', 'hist', 'bins', 'shape'):
+        observation[name] = np.load(os.path.join(entry_dir, name + '.npy'), mmap_mode=mmap_mode)
+    with open(os.path.join(entry_dir, 'meta.json'), 'r') as f:
+        observation['units'] = json.load(f)['units']
+
+    return observation
+
+
+def load_observation(boot_file, obs_file, thk_variable='thk', obs_variable='velsurf_mag', thk_min=25.,
+                     bins=None, cache_dir=CACHE_DIR, full=False, mmap_mode='r', store_dir=None):
+    '''
+    Return the masked observation dict (see build_observation), from
+    cache_dir if possible. Set cache_dir to None to disable the cache.
+    '''
+
+    if bins is None:
+        bins = np.linspace(0., 5000., 51)
+
+    if cache_dir is None:
+        return build_observation(boot_file, obs_file, thk_variable, obs_variable, thk_min, bins,
+                                 store_dir=store_dir)
+
+    meta = get_cache_meta(boot_file, obs_file, thk_variable, obs_variable, thk_min, bins, full=full)
+    entry_dir = os.path.join(cache_dir, get_cache_key(meta))
+    if os.path.isdir(entry_dir):
+        return read_observation(entry_dir, mmap_mode=mmap_mode)
+
+    observation = build_observation(boot_file, obs_file, thk_variable, obs_variable, thk_min, bins,
+                                    store_dir=store_dir)
+    meta['boot_file'] = boot_file
+    meta['obs_file'] = obs_file
+    try:
+        os.makedirs(cache_dir)
+    except OSError:
+        pass
+    save_observation(observation, entry_dir, meta)
+
+    return observation
+
+
+if __name__ == "__main__":
+
+    # Set up the argument parser
+    parser = ArgumentParser()
+    parser.description = "Fill the observation cache used by makehist_speed.py."
+    parser.add_argument("--boot_file", dest="boot_file",
+                        help="file containing original ice thickness for masking", default="foo.nc")
+    parser.add_argument("--obs_file", dest="obs_file",
+                        help="file containing observations", default="bar.nc")
+    parser.add_argument("--obs_variable", dest="obs_variable",
+                        help="observed variable. default=velsurf_mag", default="velsurf_mag")
+    parser.add_argument("--thk_min", dest="thk_min", type=float,
+                        help="mask observations where thk <= thk_min. default=25", default=25.)
+    parser.add_argument("--bins", dest="Nbins", type=int,
+                        help="number of histogram bins. default=50", default=50)
+    parser.add_argument("--histmax", dest="histmax", type=float,
+                        help="max value used in histogram. default=5000", default=5000.)
+    parser.add_argument("--cache_dir", dest="cache_dir",
+                        help="cache directory. default={}".format(CACHE_DIR), default=CACHE_DIR)
+    parser.add_argument("--field_store", dest="store_dir",
+                        help="take the fields from this shared field store (see field_store.py)", default=None)
+    parser.add_argument("--full_checksum", dest="full", action="store_true",
+                        help="hash complete files instead of their size, head and tail", default=False)
+
+    options = parser.parse_args()
+    bins = np.linspace(0., options.histmax, options.Nbins + 1)
+    observation = load_observation(options.boot_file, options.obs_file, obs_variable=options.obs_variable,
+                                   thk_min=options.thk_min, bins=bins, cache_dir=options.cache_dir,
+                                   full=options.full, store_dir=options.store_dir)
+    print("{} valid cells on a {} grid".format(len(observation['valid_idx']), tuple(observation['shape'])))
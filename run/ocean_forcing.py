@@ -5,7 +5,7 @@
 import netCDF4 as netCDF
 NC = netCDF.Dataset
 from netcdftime import utime
-import dateutil
+import dateutil.parser
 import numpy as np
 from datetime import datetime, timedelta
 from argparse import ArgumentParser
@@ -20,6 +20,12 @@ parser.add_argument("-e",dest="b_e",
                     help="basal melt rate from t_e on, in kg m-2 s-1",default=285e3*0.91)
 parser.add_argument("--ta",dest="t_a",
                   help="time t_e, udunits string, e.g. 1989-1-1",default="1997-1-31")
+parser.add_argument("-o", "--output_file",dest="output_file",
+                  help="write forcing to a new compressed, chunked NetCDF4 file instead of appending to FILE",default=None)
+parser.add_argument("-c", "--chunk",dest="chunk",type=int,
+                  help="number of time records written at once. default=1",default=1)
+parser.add_argument("-L", "--deflate_level",dest="complevel",type=int,
+                  help="deflate level of NetCDF4 output. default=3",default=3)
 
 # From Motyka et al (2011)
 # melt rates increased by 25% from 228 m/yr to 285 m/yr
@@ -27,13 +33,22 @@ parser.add_argument("--ta",dest="t_a",
 options = parser.parse_args()
 args = options.FILE
 
-b_a = options.b_a
-b_e = options.b_e
+b_a = float(options.b_a)
+b_e = float(options.b_e)
 t_a = str(options.t_a)
+output_file = options.output_file
+chunk = options.chunk
+complevel = options.complevel
 
 infile = args[0]
 
-nc = NC(infile,'a')
+if output_file is None:
+    nc = NC(infile,'a')
+    nc_out = nc
+else:
+    nc = NC(infile,'r')
+    nc_out = NC(output_file,'w',format='NETCDF4')
+
 time = nc.variables["time"]
 time_units = time.units
 time_calendar = time.calendar
@@ -44,43 +59,66 @@ dates = cdftime.num2date(time[:])
 if time_calendar in ("365_day", "366_day"):
     dates = np.array([dateutil.parser.parse(x.strftime()) for x in dates])
 
-acab = nc.variables["climatic_mass_balance"]
-bmelt = np.ones_like(acab[:])
-
-
 t_a_date = dateutil.parser.parse(t_a)
-t_e_dates = dates[dates>=t_a_date]
-time_e = cdftime.date2num(t_e_dates)
 
 x = nc.variables['x']
 y = nc.variables['y']
 
+nt = len(time)
 nx = len(x)
 ny = len(y)
 
+
+def copy_var(nc, nc_out, name):
+    # copy coordinate variables and their attributes to the new file
+    var = nc.variables[name]
+    for dim in var.dimensions:
+        if dim not in nc_out.dimensions:
+            size = nc.dimensions[dim]
+            nc_out.createDimension(dim, None if size.isunlimited() else len(size))
+    var_out = nc_out.createVariable(name, var.dtype, var.dimensions)
+    for attr in var.ncattrs():
+        setattr(var_out, attr, getattr(var, attr))
+    var_out[:] = var[:]
+
+
 def def_var(nc, name, units):
     # dimension transpose is standard: "float thk(y, x)" in NetCDF file
-    var = nc.createVariable(name, 'f', dimensions=("time","y", "x"))
+    if nc.file_format in ('NETCDF4', 'NETCDF4_CLASSIC'):
+        var = nc.createVariable(name, 'f', dimensions=("time","y", "x"),
+                                zlib=True, complevel=complevel, shuffle=True,
+                                chunksizes=(1, ny, nx))
+    else:
+        var = nc.createVariable(name, 'f', dimensions=("time","y", "x"))
     var.units = units
     return var
 
-idx = np.squeeze(np.nonzero(dates>t_a_date))
-nte = len(idx)
-var = "shelfbmassflux"
-if (var not in nc.variables.keys()):
-    bmelt_var = def_var(nc, var, "kg m-2 yr-1")
-    bmelt_var[:] = b_a*np.ones_like(acab)
-    bmelt_var[idx,:,:] = b_e*np.ones((nte,ny,nx))
 
+if nc_out is not nc:
+    for name in ('time', 'time_bounds', 'x', 'y'):
+        if name in nc.variables:
+            copy_var(nc, nc_out, name)
+
+var = "shelfbmassflux"
+if (var not in nc_out.variables.keys()):
+    bmelt_var = def_var(nc_out, var, "kg m-2 yr-1")
 else:
-    nc.variables[var][:,:,:] = b_a*np.ones_like(acab)
-    nc.variables[var][idx,:,:] = b_e*np.ones((nte,ny,nx))
-    
+    bmelt_var = nc_out.variables[var]
+
 var = "shelfbtemp"
-if (var not in nc.variables.keys()):
-    btemp_var = def_var(nc, var, "deg_C")
-    btemp_var[:] = np.zeros_like(acab[:])
+if (var not in nc_out.variables.keys()):
+    btemp_var = def_var(nc_out, var, "deg_C")
 else:
-    nc.variables[var][:] = np.zeros_like(acab[:])
-
+    btemp_var = nc_out.variables[var]
+
+# write one block of records at a time so memory use does not depend
+# on the length of the record
+for start in range(0, nt, chunk):
+    end = min(start + chunk, nt)
+    bmelt = np.where(dates[start:end] > t_a_date, b_e, b_a)
+    bmelt_var[start:end,:,:] = np.tile(bmelt[:, np.newaxis, np.newaxis], (1, ny, nx))
+    btemp_var[start:end,:,:] = np.zeros((end - start, ny, nx))
+
+if nc_out is not nc:
+    nc_out.close()
 nc.close()
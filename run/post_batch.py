@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# Copyright (C) 2015 Andy Aschwanden
+
+# Run the post scripts of many ensemble members on all cores of one
+# node instead of one single-core transfer job per member. Members
+# whose outputs are missing, invalid or short of the end time their job
+# script asked for (e.g. failed or walltime-killed runs) are skipped.
+# At most N_PROCS post scripts run at once, largest outputs first, and
+# a new one only starts while the outputs being processed add up to less
+# than IO_LIMIT GB, so a few huge members do not saturate the file
+# system.
+#
+# Example
+# -------
+# $ post_batch.py -n 16 --io_limit 40 do_greenland_g1500m_*_post.sh
+# $ post_batch.py -n 16 --list submit_greenland_g1500m_const_ctrl_hirham_posts.txt
+
+import os
+import re
+import sys
+import time
+import subprocess
+import multiprocessing
+from argparse import ArgumentParser
+from ensemble import is_valid_output, is_finished_run
+from resume import parse_run_line
+
+LOG_DIR = 'logs'
+IO_LIMIT = 20
+# outputs are tested by 'if [ -f OUTFILE ]' in post scripts (see generate_post_commands)
+OUTPUT_PATTERN = re.compile(r'^\s*if \[ -f (\S+) \]; then', re.M)
+
+
+def get_post_outputs(script):
+    '''
+    Return the output files post-processed by a post script
+    '''
+
+    with open(script, 'r') as f:
+        return OUTPUT_PATTERN.findall(f.read())
+
+
+def get_post_size(script):
+    '''
+    Return the size in bytes of the outputs (and extra files) of a post
+    script
+    '''
+
+    size = 0
+    for outfile in get_post_outputs(script):
+        for filename in (outfile, 'ex_' + outfile):
+            if os.path.isfile(filename):
+                size += os.path.getsize(filename)
+
+    return size
+
+
+def get_run_script(script):
+    '''
+    Return the job script of the member of a post script
+    '''
+
+    return re.sub(r'_post\.sh$', '.sh', script)
+
+
+def is_finished(script):
+    '''
+    Return True if all outputs of a post script are valid and the runs
+    of the member's job script that write them reached their end time
+    '''
+
+    outputs = get_post_outputs(script)
+    if len(outputs) == 0 or not all([is_valid_output(outfile) for outfile in outputs]):
+        return False
+    run_script = get_run_script(script)
+    if not os.path.isfile(run_script):
+        return True
+    with open(run_script, 'r') as f:
+        runs = [parse_run_line(line) for line in f]
+
+    return all([is_finished_run(run) for run in runs if run is not None and run['outfile'] in outputs])
+
+
+def run_posts(scripts, n_procs, io_limit=IO_LIMIT, log_dir=LOG_DIR, poll=1.0):
+    '''
+    Run post scripts with at most n_procs at once and, unless nothing
+    else is running, at most io_limit GB of outputs being processed.
+    Returns the number of failed scripts.
+    '''
+
+    try:
+        os.makedirs(log_dir)
+    except OSError:
+        pass
+
+    limit = io_limit * 1024 ** 3
+    waiting = sorted([(get_post_size(script), script) for script in scripts], reverse=True)
+    running = []
+    in_flight = 0
+    failed = 0
+    while waiting or running:
+        k = 0
+        while k < len(waiting) and len(running) < n_procs:
+            size, script = waiting[k]
+            if running and in_flight + size > limit:
+                k += 1
+                continue
+            waiting.pop(k)
+            log = os.path.join(log_dir, '{}.log'.format(os.path.splitext(os.path.basename(script))[0]))
+            with open(log, 'w') as f:
+                proc = subprocess.Popen(['bash', script], stdout=f, stderr=subprocess.STDOUT)
+            running.append((proc, script, size, time.time()))
+            in_flight += size
+            print('started  {} ({:.1f} GB)'.format(script, size / 1024. ** 3))
+
+        time.sleep(poll)
+        for item in list(running):
+            proc, script, size, t0 = item
+            if proc.poll() is None:
+                continue
+            running.remove(item)
+            in_flight -= size
+            status = 'done' if proc.returncode == 0 else 'failed'
+            if proc.returncode != 0:
+                failed += 1
+            print('{:8} {} in {:.0f}s'.format(status, script, time.time() - t0))
+
+    return failed
+
+
+if __name__ == "__main__":
+
+    # set up the option parser
+    parser = ArgumentParser()
+    parser.description = "Run the post scripts of finished members in parallel on one node."
+    parser.add_argument("SCRIPT", nargs='*',
+                        help="post scripts")
+    parser.add_argument("-l", "--list", dest="list_file",
+                        help="file with one post script per line", default=None)
+    parser.add_argument("-n", '--n_procs', dest="n", type=int,
+                        help='''number of post scripts run at once. default: all cores.''', default=multiprocessing.cpu_count())
+    parser.add_argument("--io_limit", dest="io_limit", type=float,
+                        help="GB of outputs processed at once. default={}".format(IO_LIMIT), default=IO_LIMIT)
+    parser.add_argument("--log_dir", dest="log_dir",
+                        help="directory of the per-member log files. default={}".format(LOG_DIR), default=LOG_DIR)
+
+    options = parser.parse_args()
+
+    scripts = list(options.SCRIPT)
+    if options.list_file is not None:
+        with open(options.list_file, 'r') as f:
+            scripts.extend([line.strip() for line in f if line.strip()])
+
+    finished = []
+    for script in scripts:
+        if is_finished(script):
+            finished.append(script)
+        else:
+            print('skipped  {} (outputs missing or invalid)'.format(script))
+
+    failed = run_posts(finished, options.n, io_limit=options.io_limit, log_dir=options.log_dir)
+    print('{} of {} post scripts succeeded, {} skipped'.format(len(finished) - failed, len(finished),
+                                                           len(scripts) - len(finished)))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# Copyright (C) 2015 Andy Aschwanden
+
+# In-process replacement of the ncks/add_epsg3413_mapping.sh/ncpdq/ncap2/
+# ncatted chain in the *_post.sh scripts. Variables are read once, in
+# slabs of time records, reordered to (time, y, x), derived fields are
+# computed on the fly and everything is written to OUTFILE in one pass.
+#
+# Example
+# -------
+# $ postprocess.py --grid 1500 --bed_data_set "MO14 2015-04-27" \
+#   g1500m_out.nc 1500m_const_ctrl/processed/greenland/g1500m_out.nc
+
+import time
+import numpy as np
+from collections import OrderedDict
+from argparse import ArgumentParser
+
+try:
+    from netCDF3 import Dataset as CDF
+except:
+    from netCDF4 import Dataset as CDF
+from add_epsg3413_mapping import add_mapping
+
+# Variables dropped from the output, i.e. 'ncks -v enthalpy,litho_temp -x'
+EXCLUDE_VARS = ('enthalpy', 'litho_temp')
+# Dimension order in the output, i.e. 'ncpdq -a time,y,x'
+DIM_ORDER = ('time', 'y', 'x')
+# Speeds are masked where ice is thinner than THK_MIN
+THK_MIN = 50.0              # m
+FILL_VALUE = -2e9
+MASKED_VARS = ('velshear_mag', 'velbase_mag', 'velsurf_mag', 'flux_mag')
+
+# name: (inputs, attributes)
+DERIVED_VARS = OrderedDict()
+DERIVED_VARS['uflux'] = (('ubar', 'thk'),
+                         {'long_name': 'Vertically-integrated horizontal flux of ice in the X direction',
+                          'units': 'm2 year-1'})
+DERIVED_VARS['vflux'] = (('vbar', 'thk'),
+                         {'long_name': 'Vertically-integrated horizontal flux of ice in the Y direction',
+                          'units': 'm2 year-1'})
+DERIVED_VARS['velshear_mag'] = (('velsurf_mag', 'velbase_mag'),
+                                {'units': 'm year-1'})
+DERIVED_VARS['sliding_r'] = (('velsurf_mag', 'velbase_mag'),
+                             {'units': '1'})
+DERIVED_VARS['tau_r'] = (('tauc', 'taud_mag'),
+                         {'units': '1'})
+DERIVED_VARS['tau_rel'] = (('tauc', 'taud_mag'),
+                           {'units': '1'})
+
+
+def reorder_dimensions(dims, order=DIM_ORDER):
+    '''
+    Return dims with the dimensions in order permuted into that order,
+    keeping all other dimensions in place (as ncpdq -a does)
+    '''
+
+    positions = [k for k, dim in enumerate(dims) if dim in order]
+    ordered = [dim for dim in order if dim in dims]
+    new_dims = list(dims)
+    for position, dim in zip(positions, ordered):
+        new_dims[position] = dim
+
+    return tuple(new_dims)
+
+
+def get_permutation(dims, new_dims):
+    '''
+    Return the axes permutation from dims to new_dims
+    '''
+
+    return tuple([dims.index(dim) for dim in new_dims])
+
+
+def compute_derived(name, data):
+    '''
+    Compute derived variable name from a dict of (masked) input slabs
+    '''
+
+    if name == 'uflux':
+        return data['ubar'] * data['thk']
+    elif name == 'vflux':
+        return data['vbar'] * data['thk']
+    elif name == 'velshear_mag':
+        return data['velsurf_mag'] - data['velbase_mag']
+    elif name == 'sliding_r':
+        return data['velbase_mag'] / np.ma.masked_equal(data['velsurf_mag'], 0)
+    elif name == 'tau_r':
+        return data['tauc'] / (data['taud_mag'] + 1)
+    elif name == 'tau_rel':
+        return (data['tauc'] - data['taud_mag']) / (1 + data['taud_mag'])
+    else:
+        raise ValueError('derived variable {} not recognized'.format(name))
+
+
+def copy_attributes(src, dst, exclude=('_FillValue',)):
+    '''
+    Copy netCDF attributes from src to dst
+    '''
+
+    for attr in src.ncattrs():
+        if attr not in exclude:
+            setattr(dst, attr, getattr(src, attr))
+
+
+def postprocess_file(infile, outfile, grid=None, bed_data_set=None, exclude_vars=EXCLUDE_VARS,
+                     thk_min=THK_MIN, fill_value=FILL_VALUE, chunk=1, format='NETCDF3_64BIT'):
+    '''
+    Post-process a PISM output file in one pass.
+
+    Parameters
+    ----------
+    infile : PISM output file
+    outfile : post-processed file
+    grid : grid spacing in meters, written to run_stats
+    bed_data_set : bed data set description, written to run_stats
+    exclude_vars : variables not copied to outfile
+    thk_min : speeds are masked where thk < thk_min
+    fill_value : fill value of masked speeds and derived fields
+    chunk : number of time records read at once
+    format : netCDF format of outfile
+    '''
+
+    nc_in = CDF(infile, 'r')
+    nc_out = CDF(outfile, 'w', format=format)
+
+    copy_attributes(nc_in, nc_out)
+    for name, dim in nc_in.dimensions.items():
+        nc_out.createDimension(name, None if dim.isunlimited() else len(dim))
+
+    variables = [name for name in nc_in.variables.keys() if name not in exclude_vars]
+    derived = [name for name, (inputs, attrs) in DERIVED_VARS.items()
+               if all([v in variables for v in inputs])]
+    # inputs of derived fields and masking are kept per slab
+    needed = set(['thk'])
+    for name in derived:
+        needed.update(DERIVED_VARS[name][0])
+
+    out_dims = OrderedDict()
+    for name in variables:
+        var_in = nc_in.variables[name]
+        dims = reorder_dimensions(var_in.dimensions)
+        out_dims[name] = dims
+        if name in MASKED_VARS:
+            fill = fill_value
+        else:
+            fill = getattr(var_in, '_FillValue', None)
+        var_out = nc_out.createVariable(name, var_in.dtype, dims, fill_value=fill)
+        copy_attributes(var_in, var_out)
+
+    for name in derived:
+        inputs, attrs = DERIVED_VARS[name]
+        if name in out_dims:
+            var_out = nc_out.variables[name]
+        else:
+            dims = out_dims[inputs[0]]
+            var_out = nc_out.createVariable(name, 'f', dims, fill_value=fill_value)
+            out_dims[name] = dims
+        for attr, value in attrs.items():
+            setattr(var_out, attr, value)
+
+    add_mapping(nc_out)
+
+    if 'run_stats' in nc_out.variables:
+        run_stats = nc_out.variables['run_stats']
+        if bed_data_set is not None:
+            run_stats.bed_data_set = bed_data_set
+        if grid is not None:
+            run_stats.grid_dx_meters = float(grid)
+            run_stats.grid_dy_meters = float(grid)
+
+    # copy variables without a time dimension
+    static = OrderedDict()
+    for name in variables:
+        var_in = nc_in.variables[name]
+        if 'time' in var_in.dimensions:
+            continue
+        if var_in.ndim == 0:
+            nc_out.variables[name].assignValue(var_in.getValue())
+            continue
+        perm = get_permutation(var_in.dimensions, out_dims[name])
+        values = np.transpose(var_in[:], perm)
+        if name in needed:
+            static[name] = values
+        nc_out.variables[name][:] = values
+
+    time_vars = [name for name in variables if 'time' in nc_in.variables[name].dimensions]
+    if 'time' in nc_in.dimensions:
+        nt = len(nc_in.dimensions['time'])
+    else:
+        nt = 0
+
+    # stream time-dependent variables in slabs of chunk records
+    for start in range(0, nt, chunk):
+        end = min(start + chunk, nt)
+        data = dict(static)
+        for name in time_vars:
+            var_in = nc_in.variables[name]
+            dims = var_in.dimensions
+            t_axis = dims.index('time')
+            index = [slice(None)] * var_in.ndim
+            index[t_axis] = slice(start, end)
+            values = np.transpose(var_in[tuple(index)], get_permutation(dims, out_dims[name]))
+            if name in needed or name in MASKED_VARS:
+                data[name] = values
+            else:
+                nc_out.variables[name][start:end] = values
+
+        if 'thk' in data:
+            mask = np.ma.filled(data['thk'], 0) < thk_min
+        else:
+            mask = None
+
+        if mask is not None:
+            for name in MASKED_VARS:
+                if name in data:
+                    data[name] = np.ma.masked_where(np.broadcast_to(mask, data[name].shape), data[name])
+
+        for name in derived:
+            data[name] = compute_derived(name, data)
+
+        for name, values in data.items():
+            if name in static:
+                continue
+            if name in MASKED_VARS or name in derived:
+                values = np.ma.filled(np.ma.masked_invalid(values), fill_value)
+            nc_out.variables[name][start:end] = values
+
+    script_command = ' '.join([time.ctime(), ':', __file__.split('/')[-1], infile, outfile])
+    if hasattr(nc_in, 'history'):
+        nc_out.history = '\n'.join([script_command, nc_in.history])
+    else:
+        nc_out.history = script_command
+
+    nc_in.close()
+    nc_out.close()
+
+
+if __name__ == "__main__":
+
+    # Set up the option parser
+    parser = ArgumentParser()
+    parser.description = "Post-process a PISM output file: drop 3D fields, reorder dimensions to (time, y, x), add derived fields and EPSG:3413 mapping information in one pass."
+    parser.add_argument("FILE", nargs=2)
+    parser.add_argument("-g", "--grid", dest="grid", type=float,
+                        help="horizontal grid resolution in meters", default=None)
+    parser.add_argument("--bed_data_set", dest="bed_data_set",
+                        help="bed data set description written to run_stats", default=None)
+    parser.add_argument("-x", "--exclude", dest="exclude",
+                        help="comma-separated list of variables to drop", default=','.join(EXCLUDE_VARS))
+    parser.add_argument("--thk_min", dest="thk_min", type=float,
+                        help="mask speeds where thk < thk_min. default={}".format(THK_MIN), default=THK_MIN)
+    parser.add_argument("--fill_value", dest="fill_value", type=float,
+                        help="fill value of masked fields. default={}".format(FILL_VALUE), default=FILL_VALUE)
+    parser.add_argument("-c", "--chunk", dest="chunk", type=int,
+                        help="number of time records read at once. default=1", default=1)
+    parser.add_argument("-f", "--o_format", dest="oformat",
+                        choices=['NETCDF3_64BIT', 'NETCDF4', 'NETCDF4_CLASSIC'],
+                        help="output format. default=NETCDF3_64BIT", default='NETCDF3_64BIT')
+
+    options = parser.parse_args()
+    infile, outfile = options.FILE
+
+    postprocess_file(infile, outfile, grid=options.grid, bed_data_set=options.bed_data_set,
+                     exclude_vars=options.exclude.split(','), thk_min=options.thk_min,
+                     fill_value=options.fill_value, chunk=options.chunk, format=options.oformat)
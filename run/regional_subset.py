@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# Copyright (C) 2015 Andy Aschwanden
+
+# Cut named regional boxes out of PISM output and extra files. Each
+# source file is read once, restricted to the bounding box of all
+# regions, and every region's subset is written in the same pass,
+# reordered to (time, y, x), compressed and tagged with the EPSG:3413
+# mapping and lat/lon (i.e. what 'ncpdq -4 -L 3 -a time,y,x -d x,...
+# -d y,...' followed by nc2cdo.py did, once per file and region). Files
+# are processed in parallel.
+#
+# Regions are boxes (xmin, xmax, ymin, ymax) in EPSG:3413, or the
+# bounding box of an outline shapefile in ../outlines.
+#
+# Example
+# -------
+# $ regional_subset.py -n 8 -o 1500m_hindcast/processed/regional ex_g1500m_hydro_null_*.nc
+# $ regional_subset.py -r Jakobshavn,NEGIS --box 'Petermann,-330000,-220000,-1000000,-900000' g1500m_out.nc
+
+import os
+import sys
+import glob
+import time
+import numpy as np
+from collections import OrderedDict
+from multiprocessing import Pool
+from argparse import ArgumentParser
+
+try:
+    from netCDF3 import Dataset as CDF
+except:
+    from netCDF4 import Dataset as CDF
+from add_epsg3413_mapping import add_mapping, PROJ4
+from postprocess import reorder_dimensions, get_permutation, copy_attributes
+
+OUTLINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'outlines')
+COMPLEVEL = 3
+
+# name: (xmin, xmax, ymin, ymax) in EPSG:3413 (m), or outline shapefile
+REGIONS = OrderedDict()
+REGIONS['Jakobshavn'] = (-222000., -60000., -2330000., -2230000.)
+REGIONS['Helheim'] = (220000., 340000., -2640000., -2520000.)
+REGIONS['Kangerdlugssuaq'] = (420000., 540000., -2350000., -2220000.)
+REGIONS['NEGIS'] = 'negis_outline.shp'
+
+
+def parse_box(box):
+    '''
+    Return (name, (xmin, xmax, ymin, ymax)) from 'name,xmin,xmax,ymin,ymax'
+    '''
+
+    fields = box.split(',')
+
+    return fields[0], tuple([float(v) for v in fields[1:5]])
+
+
+def get_outline_box(filename):
+    '''
+    Return the bounding box (xmin, xmax, ymin, ymax) in EPSG:3413 of all
+    features of an outline shapefile
+    '''
+
+    from osgeo import ogr, osr
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(3413)
+    ds = ogr.Open(filename)
+    if ds is None:
+        raise IOError('could not open {}'.format(filename))
+    layer = ds.GetLayer()
+    transform = osr.CoordinateTransformation(layer.GetSpatialRef(), srs)
+    extents = []
+    for feature in layer:
+        geometry = feature.GetGeometryRef().Clone()
+        geometry.Transform(transform)
+        extents.append(geometry.GetEnvelope())
+    ds = None
+    if not extents:
+        raise ValueError('{} has no features'.format(filename))
+    extents = np.array(extents)
+
+    return extents[:, 0].min(), extents[:, 1].max(), extents[:, 2].min(), extents[:, 3].max()
+
+
+def get_region_boxes(regions, outline_dir=OUTLINE_DIR):
+    '''
+    Return an OrderedDict name -> (xmin, xmax, ymin, ymax) of regions,
+    with outline shapefiles replaced by their bounding boxes
+    '''
+
+    boxes = OrderedDict()
+    for name, region in regions.items():
+        if isinstance(region, str):
+            boxes[name] = get_outline_box(os.path.join(outline_dir, region))
+        else:
+            boxes[name] = tuple(region)
+
+    return boxes
+
+
+def get_box_slices(x, y, box):
+    '''
+    Return the (x, y) index slices of the points of x, y inside box, or
+    None if the box does not overlap the grid
+    '''
+
+    xmin, xmax, ymin, ymax = box
+    i = np.flatnonzero((x >= xmin) & (x <= xmax))
+    j = np.flatnonzero((y >= ymin) & (y <= ymax))
+    if len(i) == 0 or len(j) == 0:
+        return None
+
+    return slice(i[0], i[-1] + 1), slice(j[0], j[-1] + 1)
+
+
+def add_latlon(nc, x, y):
+    '''
+    Add lat and lon of the (y, x) grid points to nc, as nc2cdo.py does
+    '''
+
+    from pyproj import Proj
+
+    proj = Proj(PROJ4)
+    xx, yy = np.meshgrid(x, y)
+    lon, lat = proj(xx, yy, inverse=True)
+    for name, values, units, standard_name in (('lon', lon, 'degrees_east', 'longitude'),
+                                               ('lat', lat, 'degrees_north', 'latitude')):
+        var = nc.createVariable(name, 'f8', ('y', 'x'))
+        var.units = units
+        var.long_name = standard_name
+        var.standard_name = standard_name
+        var[:] = values
+
+
+def subset_file(infile, boxes, out_dir, chunk=1, complevel=COMPLEVEL, latlon=True):
+    '''
+    Write the subset of infile inside each box to
+    out_dir/REGION_basename(infile). Returns the list of files written.
+    '''
+
+    nc_in = CDF(infile, 'r')
+    x = nc_in.variables['x'][:]
+    y = nc_in.variables['y'][:]
+    slices = OrderedDict()
+    for name, box in boxes.items():
+        s = get_box_slices(x, y, box)
+        if s is None:
+            print('{}: region {} is outside the grid, skipping'.format(infile, name))
+            continue
+        slices[name] = s
+    if not slices:
+        nc_in.close()
+        return []
+
+    # read only the bounding box of all regions
+    i0 = min([s[0].start for s in slices.values()])
+    i1 = max([s[0].stop for s in slices.values()])
+    j0 = min([s[1].start for s in slices.values()])
+    j1 = max([s[1].stop for s in slices.values()])
+    union = {'x': slice(i0, i1), 'y': slice(j0, j1)}
+
+    outputs = OrderedDict()
+    script_command = ' '.join([time.ctime(), ':', __file__.split('/')[-1], infile])
+    for region, (xs, ys) in slices.items():
+        outfile = os.path.join(out_dir, '{}_{}'.format(region, os.path.basename(infile)))
+        nc_out = CDF(outfile, 'w', format='NETCDF4')
+        copy_attributes(nc_in, nc_out)
+        for name, dim in nc_in.dimensions.items():
+            if name in ('x',):
+                size = xs.stop - xs.start
+            elif name in ('y',):
+                size = ys.stop - ys.start
+            else:
+                size = None if dim.isunlimited() else len(dim)
+            nc_out.createDimension(name, size)
+        for name, var_in in nc_in.variables.items():
+            fill = getattr(var_in, '_FillValue', None)
+            dims = reorder_dimensions(var_in.dimensions)
+            if var_in.ndim > 0:
+                var_out = nc_out.createVariable(name, var_in.dtype, dims, fill_value=fill,
+                                                zlib=complevel > 0, complevel=complevel, shuffle=True)
+            else:
+                var_out = nc_out.createVariable(name, var_in.dtype, dims, fill_value=fill)
+            copy_attributes(var_in, var_out)
+            if 'x' in dims and 'y' in dims and not hasattr(var_out, 'grid_mapping'):
+                var_out.grid_mapping = 'mapping'
+        add_mapping(nc_out)
+        if latlon and 'lat' not in nc_out.variables:
+            add_latlon(nc_out, x[xs], y[ys])
+            for var_out in nc_out.variables.values():
+                if 'x' in var_out.dimensions and 'y' in var_out.dimensions and var_out.ndim > 2:
+                    var_out.coordinates = 'lat lon'
+        if hasattr(nc_in, 'history'):
+            nc_out.history = '\n'.join([script_command, nc_in.history])
+        else:
+            nc_out.history = script_command
+        outputs[region] = nc_out
+
+    def write(name, index, values):
+        # values cover the union box; cut and write each region
+        var_in = nc_in.variables[name]
+        dims = var_in.dimensions
+        new_dims = reorder_dimensions(dims)
+        for region, (xs, ys) in slices.items():
+            cut = [slice(None)] * len(dims)
+            for axis, dim in enumerate(dims):
+                if dim in ('x',):
+                    cut[axis] = slice(xs.start - i0, xs.stop - i0)
+                elif dim in ('y',):
+                    cut[axis] = slice(ys.start - j0, ys.stop - j0)
+            out_index = [index[dims.index(dim)] if dim not in ('x', 'y') else slice(None)
+                         for dim in new_dims]
+            outputs[region].variables[name][tuple(out_index)] = np.transpose(
+                values[tuple(cut)], get_permutation(dims, new_dims))
+
+    if 'time' in nc_in.dimensions:
+        nt = len(nc_in.dimensions['time'])
+    else:
+        nt = 0
+    for name, var_in in nc_in.variables.items():
+        dims = var_in.dimensions
+        if var_in.ndim == 0:
+            for nc_out in outputs.values():
+                nc_out.variables[name].assignValue(var_in.getValue())
+            continue
+        index = [union.get(dim, slice(None)) for dim in dims]
+        if 'time' in dims and var_in.ndim > 1:
+            # stream slabs of chunk records
+            t_axis = dims.index('time')
+            for start in range(0, nt, chunk):
+                index[t_axis] = slice(start, min(start + chunk, nt))
+                write(name, index, var_in[tuple(index)])
+        else:
+            write(name, [slice(None)] * len(dims), var_in[tuple(index)])
+
+    nc_in.close()
+    for nc_out in outputs.values():
+        nc_out.close()
+
+    return [os.path.join(out_dir, '{}_{}'.format(region, os.path.basename(infile))) for region in outputs.keys()]
+
+
+def _subset(args):
+    infile, boxes, out_dir, chunk, complevel, latlon = args
+    t0 = time.time()
+    outputs = subset_file(infile, boxes, out_dir, chunk=chunk, complevel=complevel, latlon=latlon)
+
+    return infile, outputs, time.time() - t0
+
+
+def subset_files(filenames, boxes, out_dir, n_procs=1, chunk=1, complevel=COMPLEVEL, latlon=True):
+    '''
+    Run subset_file on all files with n_procs processes. Returns a list
+    of (infile, outputs, seconds).
+    '''
+
+    try:
+        os.makedirs(out_dir)
+    except OSError:
+        pass
+
+    args = [(filename, boxes, out_dir, chunk, complevel, latlon) for filename in filenames]
+    if n_procs > 1 and len(filenames) > 1:
+        pool = Pool(min(n_procs, len(filenames)))
+        results = pool.map(_subset, args)
+        pool.close()
+        pool.join()
+    else:
+        results = [_subset(a) for a in args]
+
+    return results
+
+
+if __name__ == "__main__":
+
+    # set up the option parser
+    parser = ArgumentParser()
+    parser.description = "Cut named regions out of PISM files, all regions in one pass per file."
+    parser.add_argument("FILE", nargs='+',
+                        help="input files or globs")
+    parser.add_argument("-o", "--out_dir", dest="out_dir",
+                        help="output directory. default=regional", default='regional')
+    parser.add_argument("-r", "--regions", dest="regions",
+                        help="comma-separated list of regions. default: all of {}".format(', '.join(REGIONS.keys())),
+                        default=None)
+    parser.add_argument("--box", dest="boxes", action="append",
+                        help="additional region 'name,xmin,xmax,ymin,ymax' in EPSG:3413 (m), may be repeated",
+                        default=[])
+    parser.add_argument("--outline_dir", dest="outline_dir",
+                        help="directory of outline shapefiles. default={}".format(OUTLINE_DIR), default=OUTLINE_DIR)
+    parser.add_argument("-n", '--n_procs', dest="n", type=int,
+                        help='''number of files processed at once. default=1.''', default=1)
+    parser.add_argument("-c", "--chunk", dest="chunk", type=int,
+                        help="number of time records read at once. default=1", default=1)
+    parser.add_argument("-L", "--complevel", dest="complevel", type=int,
+                        help="deflate level, 0 to disable. default={}".format(COMPLEVEL), default=COMPLEVEL)
+    parser.add_argument("--no_latlon", dest="latlon", action="store_false",
+                        help="do not add lat/lon (needs pyproj)", default=True)
+
+    options = parser.parse_args()
+
+    if options.regions is not None:
+        regions = OrderedDict([(name, REGIONS[name]) for name in options.regions.split(',')])
+    elif options.boxes:
+        regions = OrderedDict()
+    else:
+        regions = OrderedDict(REGIONS)
+    regions.update([parse_box(box) for box in options.boxes])
+    boxes = get_region_boxes(regions, outline_dir=options.outline_dir)
+
+    filenames = []
+    for pattern in options.FILE:
+        filenames.extend(sorted(glob.glob(pattern)))
+    if not filenames:
+        print('no input files found')
+        sys.exit(1)
+
+    for infile, outputs, seconds in subset_files(filenames, boxes, options.out_dir, n_procs=options.n,
+                                                 chunk=options.chunk, complevel=options.complevel,
+                                                 latlon=options.latlon):
+        print('{}: {} regions in {:.1f}s'.format(infile, len(outputs), seconds))
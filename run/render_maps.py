@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+# Copyright (C) 2015 Andy Aschwanden
+
+# Render the map panels and the composite sheet of many runs from one
+# process. Replaces the basemap-plot.py calls, pdflatex and convert in
+# run-postpro-2.sh and run-postpro-fc.sh: each model file is opened once
+# and all panels are drawn from the fields in memory. Model grids are EPSG:3413, so panels
+# are drawn in projected coordinates and no basemap instance is needed.
+# GeoTIFF backgrounds are cropped to each region once and cached in
+# CACHE_DIR (keyed by the GeoTIFF checksum and the region), shapefile
+# overlays are read once per worker. Members are rendered by a pool of
+# workers. A layer of many members (see speed_contours.py) is drawn with
+# the features of each panel's member only.
+#
+# Example
+# -------
+# $ render_maps.py -n 8 -o figures --shape_file speed_contours_epsg4326.shp processed/g1500m_*.nc
+# $ render_maps.py -n 8 -o figures --member_shape_file g1500m_speed_contours_epsg4326.geojson processed/g1500m_*.nc
+
+import os
+import sys
+import glob
+import hashlib
+import numpy as np
+from collections import OrderedDict
+from multiprocessing import Pool
+from argparse import ArgumentParser
+
+try:
+    from netCDF3 import Dataset as CDF
+except:
+    from netCDF4 import Dataset as CDF
+from obs_cache import file_checksum
+from regional_subset import REGIONS
+
+CACHE_DIR = '.map_cache'
+DPI = 300
+
+# (region, variable) panels written per member; region None is the whole grid
+PANELS = (('Jakobshavn', 'velsurf_mag'),
+          ('Kangerdlugssuaq', 'velsurf_mag'),
+          ('Helheim', 'velsurf_mag'),
+          ('Jakobshavn', 'velbase_mag'),
+          ('Kangerdlugssuaq', 'velbase_mag'),
+          ('Helheim', 'velbase_mag'),
+          (None, 'velsurf_mag'),
+          (None, 'velbase_mag'),
+          (None, 'velshear_mag'),
+          (None, 'tau_r'),
+          (None, 'sliding_r'))
+# Greenland-wide panels of the composite sheet
+SHEET = ('velsurf_mag', 'velbase_mag', 'velshear_mag', 'sliding_r', 'tau_r')
+# background GeoTIFF per region, None is the whole grid
+BACKGROUNDS = {'Jakobshavn': 'MODISJakobshavn250m.tif',
+               'Kangerdlugssuaq': 'MODISKangerdlugssuaq250m.tif',
+               'Helheim': 'MODISHelheim250m.tif',
+               None: 'MODISGreenland1kmclean_cut.tif'}
+# variable: (colormap, vmin, vmax, log scale)
+STYLES = {'velsurf_mag': ('jet', 1., 3000., True),
+          'velbase_mag': ('jet', 1., 3000., True),
+          'velshear_mag': ('jet', 1., 300., True),
+          'sliding_r': ('RdBu_r', 0., 1., False),
+          'tau_r': ('RdBu_r', 0., 2., False)}
+
+
+def read_fields(filename, variables):
+    '''
+    Return x, y and an OrderedDict variable -> last time record as a
+    (y, x) masked array of variables in filename, opening it once
+    '''
+
+    nc = CDF(filename, 'r')
+    x = nc.variables['x'][:]
+    y = nc.variables['y'][:]
+    fields = OrderedDict()
+    for name in variables:
+        if name not in nc.variables:
+            continue
+        var = nc.variables[name]
+        dims = list(var.dimensions)
+        index = [slice(None)] * len(dims)
+        for k, dim in enumerate(dims):
+            if dim in ('time',):
+                index[k] = -1
+            elif dim not in ('x', 'y'):
+                index[k] = 0
+        data = var[tuple(index)]
+        dims = [dim for dim in dims if dim in ('x', 'y')]
+        if dims.index('x') < dims.index('y'):
+            data = data.T
+        fields[name] = np.ma.masked_invalid(data)
+    nc.close()
+
+    return x, y, fields
+
+
+def get_box(region, x, y, regions=REGIONS):
+    '''
+    Return the extent (xmin, xmax, ymin, ymax) of region, the whole grid
+    if region is None
+    '''
+
+    if region is None:
+        return (x.min(), x.max(), y.min(), y.max())
+
+    return tuple(regions[region])
+
+
+def read_background(geotiff, box):
+    '''
+    Return the pixels of geotiff inside box as an array (rows, cols[,
+    bands]) and its extent (xmin, xmax, ymin, ymax). geotiff must be in
+    EPSG:3413.
+    '''
+
+    from osgeo import gdal
+
+    ds = gdal.Open(geotiff)
+    x0, dx, _, y0, _, dy = ds.GetGeoTransform()
+    xmin, xmax, ymin, ymax = box
+    i0 = int(np.clip(np.floor((xmin - x0) / dx), 0, ds.RasterXSize))
+    i1 = int(np.clip(np.ceil((xmax - x0) / dx), 0, ds.RasterXSize))
+    j0 = int(np.clip(np.floor((ymax - y0) / dy), 0, ds.RasterYSize))
+    j1 = int(np.clip(np.ceil((ymin - y0) / dy), 0, ds.RasterYSize))
+    data = ds.ReadAsArray(i0, j0, max(i1 - i0, 1), max(j1 - j0, 1))
+    if data.ndim == 3:
+        data = np.transpose(data, (1, 2, 0))
+    ds = None
+    extent = np.array([x0 + i0 * dx, x0 + i1 * dx, y0 + j1 * dy, y0 + j0 * dy])
+
+    return data, extent
+
+
+def load_background(geotiff, box, cache_dir=CACHE_DIR):
+    '''
+    Return the background crop (see read_background) from cache_dir,
+    reading and caching it on a miss
+    '''
+
+    sha = hashlib.sha1()
+    sha.update(file_checksum(geotiff).encode('utf-8'))
+    sha.update(np.asarray(box, dtype='float64').tobytes())
+    filename = os.path.join(cache_dir, sha.hexdigest() + '.npz')
+    if os.path.isfile(filename):
+        data = np.load(filename)
+        return data['data'], data['extent']
+
+    data, extent = read_background(geotiff, box)
+    try:
+        os.makedirs(cache_dir)
+    except OSError:
+        pass
+    tmp = '{}.tmp{}.npz'.format(filename[:-len('.npz')], os.getpid())
+    np.savez(tmp, data=data, extent=extent)
+    os.rename(tmp, filename)
+
+    return data, extent
+
+
+def read_lines(shape_file, field=None):
+    '''
+    Return the lines of shape_file in EPSG:3413 as a list of (N, 2)
+    arrays or, if field is given, as an OrderedDict value of field ->
+    list of arrays
+    '''
+
+    from osgeo import ogr, osr
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(3413)
+    ds = ogr.Open(shape_file)
+    layer = ds.GetLayer()
+    transform = osr.CoordinateTransformation(layer.GetSpatialRef(), srs)
+    lines = OrderedDict()
+    for feature in layer:
+        key = feature.GetField(field) if field is not None else None
+        geometry = feature.GetGeometryRef().Clone()
+        geometry.Transform(transform)
+        parts = [geometry.GetGeometryRef(k) for k in range(geometry.GetGeometryCount())] or [geometry]
+        for part in parts:
+            points = part.GetPoints()
+            if points:
+                lines.setdefault(key, []).append(np.array(points)[:, 0:2])
+    ds = None
+
+    if field is None:
+        return lines.get(None, [])
+    return lines
+
+
+# per worker caches
+_backgrounds = {}
+_overlays = {}
+
+
+def get_background(region, box, geotiff_dir, cache_dir):
+    if region not in _backgrounds:
+        _backgrounds[region] = None
+        if geotiff_dir is not None and region in BACKGROUNDS:
+            geotiff = os.path.join(geotiff_dir, BACKGROUNDS[region])
+            if os.path.isfile(geotiff):
+                _backgrounds[region] = load_background(geotiff, box, cache_dir=cache_dir)
+
+    return _backgrounds[region]
+
+
+def get_overlays(shape_files, member_shape_files=[], member=None):
+    for shape_file in shape_files:
+        if shape_file not in _overlays:
+            _overlays[shape_file] = read_lines(shape_file)
+    # layers of many members (see speed_contours.py) contribute the features of member only
+    for shape_file in member_shape_files:
+        if shape_file not in _overlays:
+            _overlays[shape_file] = read_lines(shape_file, field='member')
+
+    return ([_overlays[shape_file] for shape_file in shape_files] +
+            [_overlays[shape_file].get(member, []) for shape_file in member_shape_files])
+
+
+def draw_panel(ax, x, y, data, variable, box, background=None, overlays=[], title=None):
+    '''
+    Draw data on ax, cropped to box, over an optional background and
+    under optional overlay lines. Returns the image.
+    '''
+
+    from matplotlib.colors import LogNorm, Normalize
+
+    cmap, vmin, vmax, log = STYLES.get(variable, ('jet', None, None, False))
+    if log:
+        norm = LogNorm(vmin=vmin, vmax=vmax, clip=True)
+        data = np.ma.masked_less_equal(data, 0)
+    else:
+        norm = Normalize(vmin=vmin, vmax=vmax)
+
+    dx = abs(x[1] - x[0]) / 2.
+    dy = abs(y[1] - y[0]) / 2.
+    if background is not None:
+        pixels, extent = background
+        ax.imshow(pixels, extent=extent, origin='upper', cmap='gray')
+    origin = 'lower' if y[-1] > y[0] else 'upper'
+    im = ax.imshow(data, extent=[x.min() - dx, x.max() + dx, y.min() - dy, y.max() + dy], origin=origin,
+                   cmap=cmap, norm=norm, alpha=0.8 if background is not None else 1., interpolation='nearest')
+    for lines in overlays:
+        for line in lines:
+            ax.plot(line[:, 0], line[:, 1], color='k', linewidth=0.3)
+    ax.set_xlim(box[0], box[1])
+    ax.set_ylim(box[2], box[3])
+    ax.set_aspect('equal')
+    ax.set_xticks([])
+    ax.set_yticks([])
+    if title is not None:
+        ax.set_title(title)
+
+    return im
+
+
+def render_member(filename, out_dir, panels=PANELS, sheet=SHEET, geotiff_dir=None, shape_files=[],
+                  member_shape_files=[], title=None, dpi=DPI, cache_dir=CACHE_DIR, formats=('pdf',)):
+    '''
+    Render all panels and the composite sheet of filename to out_dir.
+    Returns the list of files written.
+    '''
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import pylab as plt
+
+    prefix = os.path.splitext(os.path.basename(filename))[0]
+    if title is None:
+        title = prefix
+    variables = [v for r, v in panels] + list(sheet)
+    x, y, fields = read_fields(filename, variables)
+    overlays = get_overlays(shape_files, member_shape_files, os.path.basename(filename))
+
+    written = []
+    for region, variable in panels:
+        if variable not in fields:
+            continue
+        box = get_box(region, x, y)
+        fig = plt.figure()
+        ax = fig.add_subplot(111)
+        im = draw_panel(ax, x, y, fields[variable], variable, box,
+                        background=get_background(region, box, geotiff_dir, cache_dir),
+                        overlays=overlays, title=variable)
+        fig.colorbar(im, ax=ax, shrink=0.8, label=variable)
+        for ext in formats:
+            outfile = os.path.join(out_dir, '{}_{}_{}.{}'.format(region or 'Greenland', prefix, variable, ext))
+            fig.savefig(outfile, dpi=dpi, bbox_inches='tight')
+            written.append(outfile)
+        plt.close(fig)
+
+    sheet = [v for v in sheet if v in fields]
+    if sheet:
+        box = get_box(None, x, y)
+        background = get_background(None, box, geotiff_dir, cache_dir)
+        n_cols = 3
+        n_rows = int(np.ceil(len(sheet) / float(n_cols)))
+        fig = plt.figure(figsize=(11.7, 8.3))
+        for k, variable in enumerate(sheet):
+            ax = fig.add_subplot(n_rows, n_cols, k + 1)
+            im = draw_panel(ax, x, y, fields[variable], variable, box, background=background,
+                            overlays=overlays, title=variable)
+            fig.colorbar(im, ax=ax, shrink=0.8)
+        fig.suptitle(title)
+        for ext in ('pdf', 'png'):
+            outfile = os.path.join(out_dir, 'Greenland_{}.{}'.format(prefix, ext))
+            fig.savefig(outfile, dpi=dpi, bbox_inches='tight')
+            written.append(outfile)
+        plt.close(fig)
+
+    return written
+
+
+def _render(args):
+    filename, kwargs = args
+    try:
+        return filename, render_member(filename, **kwargs)
+    except (IOError, RuntimeError, KeyError) as e:
+        print('could not render {}: {}'.format(filename, e))
+        return filename, []
+
+
+def render_members(filenames, out_dir, n_procs=1, **kwargs):
+    '''
+    Render filenames (see render_member) with n_procs workers. Returns a
+    list of (filename, files written).
+    '''
+
+    try:
+        os.makedirs(out_dir)
+    except OSError:
+        pass
+
+    # crop and cache the backgrounds once, before forking
+    geotiff_dir = kwargs.get('geotiff_dir')
+    if geotiff_dir is not None and filenames:
+        nc = CDF(filenames[0], 'r')
+        x, y = nc.variables['x'][:], nc.variables['y'][:]
+        nc.close()
+        regions = set([r for r, v in kwargs.get('panels', PANELS)] + [None])
+        for region in regions:
+            get_background(region, get_box(region, x, y), geotiff_dir, kwargs.get('cache_dir', CACHE_DIR))
+
+    kwargs['out_dir'] = out_dir
+    args = [(filename, kwargs) for filename in filenames]
+    if n_procs > 1 and len(filenames) > 1:
+        pool = Pool(min(n_procs, len(filenames)))
+        results = pool.map(_render, args)
+        pool.close()
+        pool.join()
+    else:
+        results = [_render(a) for a in args]
+
+    return results
+
+
+if __name__ == "__main__":
+
+    # set up the option parser
+    parser = ArgumentParser()
+    parser.description = "Render map panels and composite sheets of many runs in one process."
+    parser.add_argument("FILE", nargs='+',
+                        help="post-processed PISM files or globs")
+    parser.add_argument("-o", "--out_dir", dest="out_dir",
+                        help="output directory. default=figures", default='figures')
+    parser.add_argument("--geotiff_dir", dest="geotiff_dir",
+                        help="directory of the background GeoTIFFs ({})".format(
+                            ', '.join(sorted(set(BACKGROUNDS.values())))), default=None)
+    parser.add_argument("--shape_file", dest="shape_files", nargs='*',
+                        help="shapefiles drawn on top of every panel", default=[])
+    parser.add_argument("--member_shape_file", dest="member_shape_files", nargs='*',
+                        help='''layers with a 'member' field (see speed_contours.py) of which
+                        each panel only draws the features of its member''', default=[])
+    parser.add_argument("--title", dest="title",
+                        help="title of the composite sheet. default: file name", default=None)
+    parser.add_argument("-r", "--resolution", dest="dpi", type=int,
+                        help="figure resolution in dpi. default={}".format(DPI), default=DPI)
+    parser.add_argument("--cache_dir", dest="cache_dir",
+                        help="background cache directory. default={}".format(CACHE_DIR), default=CACHE_DIR)
+    parser.add_argument("-n", '--n_procs', dest="n", type=int,
+                        help='''number of workers. default=1.''', default=1)
+
+    options = parser.parse_args()
+
+    filenames = []
+    for pattern in options.FILE:
+        filenames.extend(sorted(glob.glob(pattern)))
+    if not filenames:
+        print('no input files found')
+        sys.exit(1)
+
+    results = render_members(filenames, options.out_dir, n_procs=options.n, geotiff_dir=options.geotiff_dir,
+                             shape_files=options.shape_files, member_shape_files=options.member_shape_files,
+                             title=options.title, dpi=options.dpi, cache_dir=options.cache_dir)
+    for filename, written in results:
+        print('{}: {} figures'.format(filename, len(written)))
@@ -1,5 +1,9 @@
+import os
 from collections import OrderedDict
 
+# directory of the stage timing records of job scripts
+TIMING_DIR = 'timing'
+
 
 def generate_domain(domain):
     '''
@@ -68,6 +72,10 @@ def generate_scalar_ts(outfile, step, start=None, end=None):
 
 
     
+# horizontal grid resolutions (m) of the Greenland grids
+accepted_resolutions = (150, 300, 450, 600, 900, 1200, 1500, 1800, 2400, 3000, 3600, 4500, 9000, 18000, 36000)
+
+
 def generate_grid_description(grid_resolution):
     '''
     Generate grid description dict
@@ -77,8 +85,6 @@ def generate_grid_description(grid_resolution):
     my_max = 18240
     resolution_max = 150
     
-    accepted_resolutions = (150, 300, 450, 600, 900, 1200, 1500, 1800, 2400, 3000, 3600, 4500, 9000, 18000, 36000)
-
     try:
         grid_resolution in accepted_resolutions
         pass
@@ -181,21 +187,41 @@ def generate_stress_balance(stress_balance, params_dict):
         stress_balance_params_dict['topg_to_phi'] = params_dict['topg_to_phi']
         stress_balance_params_dict['tauc_slippery_grounding_lines'] = ''
 
-        return merge_dicts(params_dict, stress_balance_params_dict)
-        
+    return merge_dicts(params_dict, stress_balance_params_dict)
+
+
+
+def make_pbs_array_line(system, array):
+    '''
+    Return the PBS directive requesting a job array with index range
+    array, e.g. '0-99'. PBS Pro (pleiades) uses -J, Torque uses -t.
+    '''
 
+    if array is None:
+        return ''
+    elif system in ('pleiades',):
+        return '#PBS -J {}\n'.format(array)
+    else:
+        return '#PBS -t {}\n'.format(array)
+
+
+# processors per node of the queues of each system
+systems = {}
+systems['debug'] = {}
+systems['fish'] = {'gpu' : 16,
+                   'gpu_long' : 16,
+                   'standard' : 12}
+systems['pacman'] = {'standard_4' : 4,
+                    'standard_16' : 16}
+systems['pleiades'] = {'long' : 20,
+                       'normal': 20}
 
 
-def make_pbs_header(system, cores, walltime, queue):
-    systems = {}
-    systems['debug'] = {}
-    systems['fish'] = {'gpu' : 16,
-                       'gpu_long' : 16,
-                       'standard' : 12}
-    systems['pacman'] = {'standard_4' : 4,
-                        'standard_16' : 16}
-    systems['pleiades'] = {'long' : 20,
-                           'normal': 20}
+def make_pbs_header(system, cores, walltime, queue, array=None):
+    '''
+    Return the PBS header of a job script. If array is given, e.g.
+    '0-99', the header requests a job array with that index range.
+    '''
 
     assert system in systems.keys()
     if system not in 'debug':
@@ -203,7 +229,9 @@ def make_pbs_header(system, cores, walltime, queue):
         assert cores > 0
 
         ppn = systems[system][queue]
-        nodes = cores / ppn
+        nodes = cores // ppn
+
+    array_line = make_pbs_array_line(system, array)
 
     if system in ('debug'):
 
@@ -218,21 +246,199 @@ def make_pbs_header(system, cores, walltime, queue):
 #PBS -m e
 #PBS -q {queue}
 #PBS -lselect={nodes}:ncpus={ppn}:mpiprocs={ppn}:model=ivy
-#PBS -j oe
+{array_line}#PBS -j oe
 
 cd $PBS_O_WORKDIR
 
-""".format(queue=queue, walltime=walltime, nodes=nodes, ppn=ppn)
+""".format(queue=queue, walltime=walltime, nodes=nodes, ppn=ppn, array_line=array_line)
     else:
         header = """
 #!/bin/bash
 #PBS -q {queue}
 #PBS -l walltime={walltime}
 #PBS -l nodes={nodes}:ppn={ppn}
-#PBS -j oe
+{array_line}#PBS -j oe
 
 cd $PBS_O_WORKDIR
 
-""".format(queue=queue, walltime=walltime, nodes=nodes, ppn=ppn)
+""".format(queue=queue, walltime=walltime, nodes=nodes, ppn=ppn, array_line=array_line)
 
     return header
+
+
+def walltime_to_seconds(walltime):
+    '''
+    Convert a PBS walltime, e.g. 12:00:00, to seconds
+    '''
+
+    seconds = 0
+    for field in walltime.split(':'):
+        seconds = seconds * 60 + int(field)
+
+    return seconds
+
+
+def seconds_to_walltime(seconds):
+    '''
+    Convert seconds to a PBS walltime, e.g. 43200 to 12:00:00
+    '''
+
+    seconds = int(seconds)
+
+    return '{:02d}:{:02d}:{:02d}'.format(seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+def get_resume_after(walltime, margin=900):
+    '''
+    Return the seconds after which PISM should be stopped to leave
+    margin seconds of walltime for writing output and resubmitting
+    '''
+
+    return max(walltime_to_seconds(walltime) - margin, 60)
+
+
+def get_bed_data_set(version, bed_type='ctrl'):
+    '''
+    Return the bed data set description for an input data set version
+    and bed type
+    '''
+
+    # '2_1985' and 'v2' are variants of data set version 2
+    version = str(version).lstrip('v').split('_')[0]
+    bed_data_sets = {('ctrl', '2'): "MO14 2015-04-27",
+                     ('cresis', '2'): "MO14+CReSIS 2015-04-27",
+                     ('ctrl', '1.2'): "MO14 2014-11-19",
+                     ('ctrl', '1.1'): "MO14 2014-06-26"}
+
+    if bed_type in ('old_bed',):
+        return "BA01"
+    if (bed_type, version) not in bed_data_sets:
+        print('TYPE {} {} not recognized, exiting'.format(bed_type, version))
+        import sys
+        sys.exit(0)
+
+    return bed_data_sets[(bed_type, version)]
+
+
+def make_timing_functions(script):
+    '''
+    Return the shell functions of the stage timers of a job script:
+    'timed STAGE TARGET CMD...' runs CMD and appends a tab-separated
+    record (job ID, stage, target, start, end, exit status) to
+    $TIMING_FILE, and 'stamp FILE' copies its input to stdout and,
+    prefixed with time stamps, to FILE. See stage_timing.py. stamp
+    takes the time from $EPOCHREALTIME (bash 5) or printf (bash 4.2),
+    so it does not fork per line; pipefail makes the status of a
+    stamped pipeline that of the run, not of stamp or tee.
+    '''
+
+    functions = """# stage timers, see stage_timing.py
+set -o pipefail
+mkdir -p {timing_dir}
+TIMING_FILE={timing_dir}/{name}.${{PBS_JOBID}}.tsv
+timed () {{
+    local stage=$1 target=$2 t0=$(date +%s.%N) status
+    shift 2
+    "$@"
+    status=$?
+    printf '%s\\t%s\\t%s\\t%s\\t%s\\t%s\\n' "$PBS_JOBID" $stage $target $t0 $(date +%s.%N) $status >> $TIMING_FILE
+    return $status
+}}
+stamp () {{
+    local line now
+    while IFS= read -r line; do
+        printf '%s\\n' "$line"
+        now=${{EPOCHREALTIME/,/.}}
+        [ -n "$now" ] || printf -v now '%(%s)T' -1
+        printf '%s %s\\n' "$now" "$line" >&3
+    done 3>> $1
+}}
+
+""".format(timing_dir=TIMING_DIR, name=os.path.splitext(os.path.basename(script))[0])
+
+    return functions
+
+
+def get_stamp_file(outfile):
+    '''
+    Return the time stamped log of the run writing outfile
+    '''
+
+    return '{}/{}.${{PBS_JOBID}}.log'.format(TIMING_DIR, os.path.splitext(outfile)[0])
+
+
+def generate_run_command(params_dict, args, log='job.${PBS_JOBID}', run_script='./run_main.sh', timing=None):
+    '''
+    Return the command line calling run_script with the environment
+    variables in params_dict and the positional arguments in args. If
+    timing (the output file of the run) is given, the run is timed as
+    stage 'pism' and its output time stamped (see make_timing_functions).
+    '''
+
+    params = ' '.join(['='.join([k, str(v)]) for k, v in params_dict.items()])
+    if timing is not None:
+        run_script = 'timed pism {} {}'.format(timing, run_script)
+        pipe = '2>&1 | stamp {} | tee {}'.format(get_stamp_file(timing), log)
+    else:
+        pipe = '2>&1 | tee {}'.format(log)
+    cmd = ' '.join([params, run_script] + [str(arg) for arg in args] + [pipe])
+
+    return cmd
+
+
+def make_post_header(system=None, array=None, cores=1, walltime='4:00:00'):
+    '''
+    Return the header of a post-processing script on the transfer queue,
+    optionally requesting a job array (see make_pbs_header) or several
+    cores of the node (see post_batch.py)
+    '''
+
+    array_line = make_pbs_array_line(system, array)
+
+    header = """#!/bin/bash
+#PBS -q transfer
+#PBS -l walltime={walltime}
+#PBS -l nodes=1:ppn={cores}
+{array_line}#PBS -j oe
+
+source ~/python/bin/activate
+
+cd $PBS_O_WORKDIR
+
+""".format(array_line=array_line, cores=cores, walltime=walltime)
+
+    return header
+
+
+def generate_post_commands(outfile, out_dir, grid, bed_data_set, fill='-2e9', extra_file=False, method='python',
+                           timing=False):
+    '''
+    Return the commands that post-process outfile into out_dir, either
+    in one pass with postprocess.py (method='python') or with the NCO
+    chain (method='nco'). If timing is True, each step is timed (see
+    make_timing_functions).
+    '''
+
+    def timed(stage, cmd):
+        if timing:
+            return '  timed {} {} {}'.format(stage, outfile, cmd.lstrip())
+        return cmd
+
+    lines = []
+    lines.append('if [ -f {} ]; then'.format(outfile))
+    if extra_file:
+        lines.append('  rm -f tmp_{outfile} tmp_ex_{outfile} {out_dir}/{outfile} {out_dir}/ex_{outfile}'.format(outfile=outfile, out_dir=out_dir))
+        lines.append(timed('compress_extra', '  python compress_extra.py ex_{outfile} {out_dir}/ex_{outfile}'.format(outfile=outfile, out_dir=out_dir)))
+    else:
+        lines.append('  rm -f tmp_{outfile} {out_dir}/{outfile}'.format(outfile=outfile, out_dir=out_dir))
+    if method in ('python'):
+        lines.append(timed('postprocess', '  python postprocess.py --grid {grid} --bed_data_set "{bed_data_set}" --fill_value {fill} {outfile} {out_dir}/{outfile}'.format(grid=grid, bed_data_set=bed_data_set, fill=fill, outfile=outfile, out_dir=out_dir)))
+    else:
+        lines.append(timed('ncks', '  ncks -v enthalpy,litho_temp -x {outfile} tmp_{outfile}'.format(outfile=outfile)))
+        lines.append(timed('add_epsg3413_mapping', '  sh add_epsg3413_mapping.sh tmp_{}'.format(outfile)))
+        lines.append(timed('ncpdq', '  ncpdq -O --64 -a time,y,x tmp_{outfile} {out_dir}/{outfile}'.format(outfile=outfile, out_dir=out_dir)))
+        lines.append(timed('ncap2', '''  ncap2 -O -s "uflux=ubar*thk; vflux=vbar*thk; velshear_mag=velsurf_mag-velbase_mag; where(thk<50) {{velshear_mag={fill}; velbase_mag={fill}; velsurf_mag={fill}; flux_mag={fill};}}; sliding_r = velbase_mag/velsurf_mag; tau_r = tauc/(taud_mag+1); tau_rel=(tauc-taud_mag)/(1+taud_mag);" {out_dir}/{outfile} {out_dir}/{outfile}'''.format(outfile=outfile, fill=fill, out_dir=out_dir)))
+        lines.append(timed('ncatted', '  ncatted -a bed_data_set,run_stats,o,c,"{bed_data_set}" -a grid_dx_meters,run_stats,o,f,{grid} -a grid_dy_meters,run_stats,o,f,{grid} -a long_name,uflux,o,c,"Vertically-integrated horizontal flux of ice in the X direction" -a long_name,vflux,o,c,"Vertically-integrated horizontal flux of ice in the Y direction" -a units,uflux,o,c,"m2 year-1" -a units,vflux,o,c,"m2 year-1" -a units,sliding_r,o,c,"1" -a units,tau_r,o,c,"1" -a units,tau_rel,o,c,"1" {out_dir}/{outfile}'.format(bed_data_set=bed_data_set, grid=grid, out_dir=out_dir, outfile=outfile)))
+    lines.append('fi')
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+# Copyright (C) 2015 Andy Aschwanden
+
+# Detect runs of a job script that did not reach their end time (e.g.
+# killed at walltime) and write a resume script that restarts them from
+# the latest of their output, backup and save_* files (PISM_RESTART_FILE,
+# see run.sh and run_main.sh). Runs that finished are dropped from the
+# resume script. With --submit, the resume script and a dependent post
+# job are submitted.
+#
+# Job scripts written with resume enabled (see ensemble.write_run_script)
+# run PISM under 'timeout' and call this script at the end, so long runs
+# are split into walltime-sized chunks that chain automatically. It can
+# also be run by hand on the login node as a supervisor:
+#
+# $ resume.py --submit do_greenland_g450m_*.sh
+#
+# Exit status: 0 if all runs are complete, 1 if a resume script was
+# written, 2 if a run made no progress since its last restart.
+
+import os
+import re
+import sys
+import glob
+import shlex
+import subprocess
+import numpy as np
+from collections import OrderedDict
+from argparse import ArgumentParser
+
+try:
+    from netCDF3 import Dataset as CDF
+except:
+    from netCDF4 import Dataset as CDF
+
+# position of the output file among the arguments of the run scripts
+RUN_SCRIPTS = OrderedDict([('./run_main.sh', 4), ('./run.sh', 6)])
+# PISM's year length for non-365 day calendars
+SECONDS_PER_YEAR = 3.15569259747e7
+# days per year of the fixed-length calendars
+CALENDAR_DAYS = {'365_day': 365., 'noleap': 365., '366_day': 366., 'all_leap': 366., '360_day': 360.}
+UNIT_SECONDS = OrderedDict([('second', 1.), ('minute', 60.), ('hour', 3600.), ('day', 86400.)])
+MAX_RESTARTS = 20
+# tolerance in years when comparing end times
+TIME_TOL = 1e-3
+RESUME_MARKER = '# resumed from'
+
+
+def parse_run_line(line):
+    '''
+    Return a dict with the environment variables 'params', 'run_script'
+    and positional 'args' of a run command, or None if line is not one
+    '''
+
+    try:
+        tokens = shlex.split(line)
+    except ValueError:
+        return None
+    for k, token in enumerate(tokens):
+        if token in RUN_SCRIPTS:
+            params = OrderedDict([t.split('=', 1) for t in tokens[:k] if '=' in t])
+            args = []
+            for arg in tokens[k + 1:]:
+                if arg.startswith('2>') or arg in ('|', '>', '&&', ';'):
+                    break
+                args.append(arg)
+            run = {'params': params, 'run_script': token, 'args': args}
+            n = RUN_SCRIPTS[token]
+            run['outfile'] = args[n] if len(args) > n else None
+            return run
+
+    return None
+
+
+def to_years(value, units='seconds', calendar='standard'):
+    '''
+    Convert value in time units (e.g. 'days since 1989-01-01') of
+    calendar to years of that calendar, ignoring the reference date
+    '''
+
+    unit = units.split()[0].lower() if units else 'seconds'
+    if calendar in CALENDAR_DAYS:
+        seconds_per_year = CALENDAR_DAYS[calendar] * 86400.
+    else:
+        seconds_per_year = SECONDS_PER_YEAR
+    for name, seconds in UNIT_SECONDS.items():
+        if unit.startswith(name):
+            return value * seconds / seconds_per_year
+
+    return value
+
+
+def convert_time(value, units, calendar, to_units, to_calendar):
+    '''
+    Convert value in units and calendar to the time units and calendar
+    to_units and to_calendar, going through the date, so that
+    reference dates and year lengths of both are taken into account
+    '''
+
+    import cftime
+
+    date = cftime.num2date(value, units, calendar=calendar)
+    date = cftime.datetime(date.year, date.month, date.day, date.hour, date.minute, date.second,
+                           calendar=to_calendar)
+
+    return float(cftime.date2num(date, to_units, calendar=to_calendar))
+
+
+def get_time_units(filename):
+    '''
+    Return (units, calendar) of the time variable of filename, or None
+    if it has none or cannot be read
+    '''
+
+    if not os.path.isfile(filename):
+        return None
+    try:
+        nc = CDF(filename, 'r')
+    except (IOError, OSError, RuntimeError):
+        return None
+    units = None
+    if 'time' in nc.variables:
+        time = nc.variables['time']
+        units = (getattr(time, 'units', 'seconds'), getattr(time, 'calendar', 'standard'))
+    nc.close()
+
+    return units
+
+
+def get_last_time(filename, units=None):
+    '''
+    Return the last model time (years) of a netCDF file, i.e. the end of
+    its last time bounds or its last time, or None if it cannot be read.
+    If units, a (time units, calendar) tuple, is given, the time is
+    converted to these units before, so that it compares with times of
+    the file they belong to (see get_run_end).
+    '''
+
+    if not os.path.isfile(filename) or os.path.getsize(filename) == 0:
+        return None
+    try:
+        nc = CDF(filename, 'r')
+    except (IOError, OSError, RuntimeError):
+        return None
+    t = None
+    try:
+        if 'time' in nc.variables and nc.variables['time'].size > 0:
+            time = nc.variables['time']
+            if 'time_bounds' in nc.variables and nc.variables['time_bounds'].size > 0:
+                value = np.ravel(nc.variables['time_bounds'][:])[-1]
+            else:
+                value = np.ravel(time[:])[-1]
+            own_units = (getattr(time, 'units', 'seconds'), getattr(time, 'calendar', 'standard'))
+            value = float(value)
+            if units is not None and tuple(units) != own_units and ' since ' in own_units[0]:
+                value = convert_time(value, own_units[0], own_units[1], units[0], units[1])
+                own_units = tuple(units)
+            t = to_years(value, own_units[0], own_units[1])
+    except (IOError, OSError, RuntimeError, IndexError, ValueError):
+        t = None
+    nc.close()
+    if t is not None and not np.isfinite(t):
+        return None
+
+    return t
+
+
+def get_run_end(run):
+    '''
+    Return the end time (years) of a run: END of STARTEND, the end of
+    PISM_TIMEFILE (in the units of its time variable, see
+    get_run_units), or the duration for runs starting at 0
+    '''
+
+    params = run['params']
+    if params.get('STARTEND'):
+        return float(params['STARTEND'].split(',')[1])
+    elif params.get('PISM_TIMEFILE'):
+        return get_last_time(params['PISM_TIMEFILE'])
+    elif len(run['args']) > 2:
+        try:
+            return float(run['args'][2])
+        except ValueError:
+            return None
+
+    return None
+
+
+def get_run_years(run):
+    '''
+    Return the model years of a run: the span of STARTEND or of the
+    time axis of PISM_TIMEFILE or, if that cannot be read, the duration,
+    or None if unknown
+    '''
+
+    params = run['params']
+    if params.get('STARTEND'):
+        start, end = [float(t) for t in params['STARTEND'].split(',')]
+        return end - start
+    if params.get('PISM_TIMEFILE'):
+        filename = params['PISM_TIMEFILE']
+        units = get_time_units(filename)
+        end = get_last_time(filename)
+        if units is not None and end is not None:
+            nc = CDF(filename, 'r')
+            if 'time_bounds' in nc.variables and nc.variables['time_bounds'].size > 0:
+                value = np.ravel(nc.variables['time_bounds'][:])[0]
+            else:
+                value = np.ravel(nc.variables['time'][:])[0]
+            nc.close()
+            return end - to_years(float(value), units[0], units[1])
+    if len(run['args']) > 2:
+        try:
+            return float(run['args'][2])
+        except ValueError:
+            return None
+
+    return None
+
+
+def get_run_units(run):
+    '''
+    Return the (time units, calendar) the end of a run is measured in:
+    those of PISM_TIMEFILE, or None for model years
+    '''
+
+    if run['params'].get('STARTEND') or not run['params'].get('PISM_TIMEFILE'):
+        return None
+
+    return get_time_units(run['params']['PISM_TIMEFILE'])
+
+
+def is_complete(outfile, end, units=None):
+    '''
+    Return True if outfile exists and reaches end, measured in units
+    (see get_last_time). PISM writes -o also when stopped by SIGTERM,
+    so existence alone is not enough.
+    '''
+
+    t = get_last_time(outfile, units=units)
+    if t is None:
+        return False
+    if end is None:
+        return True
+
+    return t >= end - TIME_TOL
+
+
+def is_run_complete(run):
+    '''
+    Return True if the output file of run reaches the end of the run
+    '''
+
+    return is_complete(run['outfile'], get_run_end(run), units=get_run_units(run))
+
+
+def get_restart_candidates(outfile):
+    '''
+    Return the files a run with output file outfile may be restarted
+    from: the (truncated) output file, PISM backups and save_* files
+    '''
+
+    outname = os.path.splitext(outfile)[0]
+    candidates = [outfile, '{}_backup.nc'.format(outname), 'backup_{}'.format(outfile)]
+    candidates.extend(sorted(glob.glob('save_{}_*.nc'.format(outname))))
+
+    return candidates
+
+
+def find_restart_file(outfile):
+    '''
+    Return (filename, time) of the restart candidate with the latest
+    model time, or (None, None)
+    '''
+
+    best = (None, None)
+    for filename in get_restart_candidates(outfile):
+        t = get_last_time(filename)
+        if t is not None and (best[1] is None or t > best[1]):
+            best = (filename, t)
+
+    return best
+
+
+def get_resume_name(script):
+    '''
+    Return the name of the next resume script of script and the number
+    of restarts so far, e.g. do_x_resume2.sh for do_x_resume1.sh
+    '''
+
+    name = os.path.splitext(script)[0]
+    m = re.match(r'(.*)_resume(\d+)$', name)
+    if m is None:
+        return '{}_resume1.sh'.format(name), 0
+    n = int(m.group(2))
+
+    return '{}_resume{}.sh'.format(m.group(1), n + 1), n
+
+
+def get_base_script(script):
+    '''
+    Return the job script a resume script was derived from
+    '''
+
+    return re.sub(r'_resume\d+\.sh$', '.sh', script)
+
+
+def write_resume_script(script, max_restarts=MAX_RESTARTS):
+    '''
+    Check the runs of script and write a resume script if needed.
+    Returns (status, resume_script) with status 'complete', 'resume' or
+    'stalled' (no progress since the last restart or too many restarts).
+    '''
+
+    with open(script, 'r') as f:
+        lines = f.readlines()
+
+    resume_script, n = get_resume_name(script)
+    # restart times of the previous attempt, by output file
+    previous = {}
+    for line in lines:
+        if line.startswith(RESUME_MARKER):
+            fields = line.split()
+            previous[fields[-3]] = float(fields[-1])
+
+    new_lines = []
+    markers = []
+    pending = False
+    for line in lines:
+        if line.startswith(RESUME_MARKER):
+            continue
+        run = parse_run_line(line)
+        if run is None or run['outfile'] is None:
+            if line.startswith('python resume.py'):
+                line = line.replace(script, resume_script)
+            new_lines.append(line)
+            continue
+        if not pending and is_run_complete(run):
+            continue
+        if not pending:
+            restart_file, t = find_restart_file(run['outfile'])
+            line = re.sub(r'^PISM_RESTART_FILE=\S+\s+', '', line)
+            if restart_file is not None:
+                if run['outfile'] in previous and t <= previous[run['outfile']] + TIME_TOL:
+                    return 'stalled', None
+                line = 'PISM_RESTART_FILE={} {}'.format(restart_file, line)
+                markers.append('{} {} for {} at {}\n'.format(RESUME_MARKER, restart_file, run['outfile'], t))
+            pending = True
+        new_lines.append(line)
+
+    if not pending:
+        return 'complete', None
+    if n >= max_restarts:
+        return 'stalled', None
+
+    with open(resume_script, 'w') as f:
+        # keep the PBS header first
+        k = 0
+        while k < len(new_lines) and (new_lines[k].startswith('#') or not new_lines[k].strip()):
+            f.write(new_lines[k])
+            k += 1
+        f.writelines(markers)
+        f.writelines(new_lines[k:])
+
+    return 'resume', resume_script
+
+
+def submit_resume(resume_script, post=None):
+    '''
+    Submit a resume script and, if given, a dependent post job. Returns
+    the job ID of the resume job.
+    '''
+
+    job_id = subprocess.check_output(['qsub', resume_script]).decode('utf-8').strip()
+    if post is not None:
+        subprocess.check_call(['qsub', '-W', 'depend=afterok:{}'.format(job_id), post])
+
+    return job_id
+
+
+if __name__ == "__main__":
+
+    # set up the option parser
+    parser = ArgumentParser()
+    parser.description = "Resume runs of job scripts from their latest backup, save or output file."
+    parser.add_argument("SCRIPT", nargs='+',
+                        help="job scripts")
+    parser.add_argument("--submit", dest="submit", action="store_true",
+                        help="submit the resume scripts", default=False)
+    parser.add_argument("--post", dest="post",
+                        help="post script to submit after a resume script; by default the member's _post.sh", default=None)
+    parser.add_argument("--then", dest="then",
+                        help="script run as 'bash THEN JOBID' after submitting, instead of the post job, e.g. to requeue the rest of a spinup chain", default=None)
+    parser.add_argument("--max_restarts", dest="max_restarts", type=int,
+                        help="maximum number of restarts. default={}".format(MAX_RESTARTS), default=MAX_RESTARTS)
+    parser.add_argument("-f", "--manifest", dest="manifest",
+                        help="manifest recording the new job IDs (see manifest.py), if it exists", default='manifest.sqlite')
+
+    options = parser.parse_args()
+
+    exit_status = 0
+    for script in options.SCRIPT:
+        status, resume_script = write_resume_script(script, max_restarts=options.max_restarts)
+        print('{:9} {}'.format(status, script))
+        if status in ('stalled',):
+            exit_status = max(exit_status, 2)
+            continue
+        elif status in ('complete',):
+            continue
+        exit_status = max(exit_status, 1)
+        if not options.submit:
+            print('          wrote {}'.format(resume_script))
+            continue
+        post = options.post
+        if options.then is not None:
+            post = None
+        elif post is None:
+            base = os.path.splitext(get_base_script(script))[0]
+            if os.path.isfile(base + '_post.sh'):
+                post = base + '_post.sh'
+        job_id = submit_resume(resume_script, post=post)
+        print('          submitted {} as {}'.format(resume_script, job_id))
+        if options.then is not None:
+            subprocess.check_call(['bash', options.then, job_id])
+        if os.path.isfile(options.manifest):
+            from manifest import open_manifest, set_member
+            conn = open_manifest(options.manifest)
+            with conn:
+                set_member(conn, get_base_script(script), job_id=job_id, status='resumed')
+            conn.close()
+
+    sys.exit(exit_status)
@@ -0,0 +1,61 @@
+
+# Writes $ENSEMBLE_PLOT, the map and speed contour job of a whole
+# ensemble. Source it once, after the member loop that sources
+# run-postpro-2.sh or run-postpro-fc.sh, and submit the job once after
+# the post jobs of all members, e.g.
+#
+#   IDS=""
+#   for FILE in do_g${GRID}m_${CLIMATE}_${TYPE}_*_post.sh; do
+#     IDS="$IDS:$(qsub $FILE)"
+#   done
+#   qsub -W depend=afterany$IDS $ENSEMBLE_PLOT
+#
+# ENSEMBLE_PATTERN selects the processed member files, by default
+# g${GRID}m_*; use g${GRID}m_*_${DURA2}a for run-postpro-2.sh.
+
+ MYSHEBANGLINE="#!/bin/bash"
+MYMPIQUEUELINE="#PBS -q transfer"
+ MYMPITIMELINE="#PBS -l walltime=2:00:00"
+  MYMPIOUTLINE="#PBS -j oe"
+
+res=300
+plot_procs=8
+MYPLOTSIZELINE="#PBS -l nodes=1:ppn=${plot_procs}"
+
+tl_dir=${GRID}m_${CLIMATE}_${TYPE}
+nc_dir=processed
+fig_dir=figures
+spc_dir=speed_contours
+
+pattern=${ENSEMBLE_PATTERN:-g${GRID}m_*}
+ensemble_files=${tl_dir}/${nc_dir}/${pattern}.nc
+ensemble_contours=${tl_dir}/${spc_dir}/${pattern//\*/all}_speed_contours_epsg4326.geojson
+
+cat - > $ENSEMBLE_PLOT <<EOF
+$MYSHEBANGLINE
+$MYMPIQUEUELINE
+$MYMPITIMELINE
+$MYPLOTSIZELINE
+$MYMPIOUTLINE
+
+source ~/python/bin/activate
+
+cd \$PBS_O_WORKDIR
+
+if [ ! -d ${tl_dir}/${fig_dir} ]; then
+    mkdir -p ${tl_dir}/${fig_dir}
+fi
+
+if [ ! -d ${tl_dir}/${spc_dir} ]; then
+    mkdir -p ${tl_dir}/${spc_dir}
+fi
+
+if ls ${ensemble_files} > /dev/null 2>&1; then
+    # one layer with a feature per member and level
+    python speed_contours.py -n ${plot_procs} -l 100,200,1000 -o ${ensemble_contours} "${ensemble_files}"
+
+    python render_maps.py -n ${plot_procs} -r $res --geotiff_dir . --shape_file greenland_sar_velocities_500m_2005-2009_speed_contours_epsg4326.shp --member_shape_file ${ensemble_contours} -o ${tl_dir}/${fig_dir} "${ensemble_files}"
+fi
+
+
+EOF
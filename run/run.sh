@@ -95,6 +95,8 @@ if [ $# -lt 5 ] ; then
   echo "    PISM_EXEC    defaults to 'pismr'"
   echo "    PISM_CONFIG  config file, defaults to hydro_config.nc"
   echo "    PISM_SAVE    set -save_times, defaults to None"
+  echo "    PISM_RESTART_FILE  restart from this backup, save or output file with -i"
+  echo "                 instead of bootstrapping and run until END; defaults to empty"
   echo "    REGRIDFILE   set to file name to regrid from; defaults to empty (no regrid)"
   echo "    REGRIDVARS   desired -regrid_vars; applies *if* REGRIDFILE set;"
   echo "                   defaults to 'bmelt,enthalpy,litho_temp,thk,tillwat,Href'"
@@ -623,12 +625,27 @@ if [ -z "${NODIAGS}" ] ; then  # check if env var is NOT set
     EXNAME=ex_$OUTNAME
     # check_stationarity.py can be applied to $EXNAME
     DIAGNOSTICS="-ts_file $TSNAME -ts_times $TSTIMES $EXSPLIT -extra_file $EXNAME -extra_times $EXTIMES -extra_vars $EXVARS"
+    echo "$SCRIPTNAME         EXTIMES = $EXTIMES"
 else
   DIAGNOSTICS=""
 fi
 
+# restart from a backup, save or truncated output file instead of bootstrapping:
+if [ -n "${PISM_RESTART_FILE:+1}" ] ; then  # check if env var is set
+  echo "$SCRIPTNAME   PISM_RESTART_FILE = $PISM_RESTART_FILE  (restarting)"
+  INPUT="-i $PISM_RESTART_FILE -ts_append -extra_append"
+  regridcommand=""
+  if [ -z "${PISM_TIMEFILE}" ] ; then  # check if env var is NOT set
+    RUNSTARTEND="-ye $END"
+  else
+    RUNSTARTEND="-time_file $PISM_TIMEFILE -time_file_continue_run"
+  fi
+else
+  INPUT="-i $INNAME -bootstrap -Mx $myMx -My $myMy $vgrid"
+fi
+
 # construct command
-cmd="$PISM_MPIDO $NN $PISM ${SHELF_BASE_MELT_RATE} -config_override $CONFIG $AGE -i $INNAME -bootstrap -Mx $myMx -My $myMy $vgrid $RUNSTARTEND $regridcommand $PARAM_E_AGE_COUPLING $PISM_PARAM $COUPLER $PHYS $FRACTURE $HYDRO $DIAGNOSTICS $SAVE $HIGHRESPETSC -o_format $OFORMAT -o_size $OSIZE -o $OUTNAME"
+cmd="$PISM_MPIDO $NN $PISM ${SHELF_BASE_MELT_RATE} -config_override $CONFIG $AGE $INPUT $RUNSTARTEND $regridcommand $PARAM_E_AGE_COUPLING $PISM_PARAM $COUPLER $PHYS $FRACTURE $HYDRO $DIAGNOSTICS $SAVE $HIGHRESPETSC -o_format $OFORMAT -o_size $OSIZE -o $OUTNAME"
 echo
 $PISM_DO $cmd
 
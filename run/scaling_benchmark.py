@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+# Copyright (C) 2015 Andy Aschwanden
+
+'''
+Strong and weak scaling benchmarks of the Greenland configurations.
+
+'generate' writes one short, fixed-length run per grid, core count and
+stress balance, using the grid descriptions and stress balance options
+of the generators (resources.generate_grid_description and
+generate_stress_balance), and a submit script queueing all of them.
+Every line PISM prints is time stamped, so the log of a run splits its
+wall time into the stages of stage_timing.py: initialization
+(bootstrapping, reading, regridding), time stepping, writing -extra_file
+records and writing the output. All but time stepping count as I/O.
+
+'collect' reads the logs into one results table with strong scaling
+speedup and efficiency (per grid, relative to the smallest core count)
+and weak scaling efficiency (relative to the coarsest grid run with the
+same number of grid points per core), and plots both.
+
+Example
+-------
+$ scaling_benchmark.py generate -g 18000,9000,4500 -n 1,2,4,8 -s debug --run_local 8
+$ scaling_benchmark.py generate -g 1500,900,450 -n 40,80,160,320,640 -s pleiades -q long
+$ scaling_benchmark.py collect -o scaling.csv --plot
+'''
+
+import os
+import re
+import sys
+import csv
+import glob
+import numpy as np
+from collections import OrderedDict
+from argparse import ArgumentParser
+from resources import *
+from job_sizing import read_run_stats
+from stage_timing import IO_STAGES, split_run_log
+
+PREFIX = 'scaling'
+RESULTS = 'scaling.csv'
+# PISM prints one 'S' summary line per time step
+STEP_PATTERN = re.compile(r'^S\s+-?[\d.]+:')
+# time stamp every line of the run's output, without forking date per line
+STAMP = ('while IFS= read -r line; do now=${EPOCHREALTIME/,/.}; [ -n "$now" ] || printf -v now \'%(%s)T\' -1; '
+         'printf \'%s %s\\n\' "$now" "$line"; done')
+# configurations with fewer or more grid points per core are skipped
+MIN_POINTS_PER_CORE = 1000
+MAX_POINTS_PER_CORE = 500000
+
+
+def get_benchmark_name(grid, stress_balance, cores):
+    '''
+    Return the name of a benchmark run, e.g. scaling_g4500m_ssa+sia_n16
+    '''
+
+    return '{}_g{}m_{}_n{}'.format(PREFIX, grid, stress_balance, cores)
+
+
+def get_points_per_core(grid, cores):
+    '''
+    Return the number of horizontal grid points per core
+    '''
+
+    grid_dict = generate_grid_description(grid)
+
+    return grid_dict['Mx'] * grid_dict['My'] / cores
+
+
+def make_benchmark(grid, cores, stress_balance, years, pism_exec='pismr', bed_type='ctrl', version=2,
+                   surface_bcfile='GR6b_ERAI_1989_2011_4800M_BIL_1989_baseline.nc', exstep=None):
+    '''
+    Return a dict describing one benchmark run: a constant-climate run
+    of years model years bootstrapped from the input data set of grid,
+    writing one -extra_file record every exstep years (by default once,
+    at the end)
+    '''
+
+    name = get_benchmark_name(grid, stress_balance, cores)
+    outfile = '{}.nc'.format(name)
+    pism_dataname = 'pism_Greenland_{}m_mcb_jpl_v{}_{}.nc'.format(grid, version, bed_type)
+    if exstep is None:
+        exstep = years
+
+    grid_params_dict = generate_grid_description(grid)
+    for k in ('Mx', 'My'):
+        grid_params_dict[k] = int(grid_params_dict[k])
+
+    sb_params_dict = OrderedDict()
+    sb_params_dict['sia_e'] = 3.0
+    sb_params_dict['ssa_e'] = 1.0
+    sb_params_dict['ssa_n'] = 3.25
+    sb_params_dict['pseudo_plastic_q'] = 0.6
+    sb_params_dict['till_effective_fraction_overburden'] = 0.02
+    sb_params_dict['topg_to_phi'] = '5.0,40.0,-700,700'
+    stress_balance_params_dict = generate_stress_balance(stress_balance, sb_params_dict)
+
+    exvars = 'thk,usurf,velsurf_mag,velbase_mag,mask'
+    spatial_ts_dict = generate_spatial_ts(outfile, exvars, exstep, start=-years, end=0)
+
+    all_params_dict = merge_dicts(grid_params_dict, stress_balance_params_dict, spatial_ts_dict)
+    all_params = ' '.join([' '.join(['-' + k, str(v)]) for k, v in all_params_dict.items()])
+
+    params_dict = OrderedDict()
+    params_dict['PISM_DO'] = ''
+    params_dict['PISM_EXEC'] = pism_exec
+    params_dict['PISM_PARAMS'] = '\'{}\''.format(all_params)
+    params_dict['STARTEND'] = '{},{}'.format(-years, 0)
+    params_dict['PISM_DATANAME'] = pism_dataname
+    params_dict['PISM_SURFACE_BC_FILE'] = surface_bcfile
+    params_dict['PISM_CONFIG'] = 'spinup_config.nc'
+    params_dict['PARAM_NOAGE'] = ''
+
+    bench = OrderedDict()
+    bench['name'] = name
+    bench['grid'] = grid
+    bench['cores'] = cores
+    bench['stress_balance'] = stress_balance
+    bench['years'] = years
+    bench['script'] = '{}.sh'.format(name)
+    bench['log'] = '{}.log'.format(name)
+    bench['outfile'] = outfile
+    bench['params'] = params_dict
+    bench['args'] = [cores, 'const', years, 'null', outfile]
+
+    return bench
+
+
+def write_benchmark_script(bench, header):
+    '''
+    Write the job script of a benchmark run. Its output is time stamped
+    and written to bench['log'].
+    '''
+
+    params = ' '.join(['='.join([k, str(v)]) for k, v in bench['params'].items()])
+    args = ' '.join([str(arg) for arg in bench['args']])
+    with open(bench['script'], 'w') as f:
+        f.write(header)
+        f.write('rm -f {outfile} ex_{outfile}\n'.format(**bench))
+        f.write('{params} ./run_main.sh {args} 2>&1 | {stamp} > {log}\n'.format(
+            params=params, args=args, stamp=STAMP, log=bench['log']))
+
+
+def generate_benchmarks(grids, cores_choices, stress_balances, years, submit, header, min_points=MIN_POINTS_PER_CORE,
+                        max_points=MAX_POINTS_PER_CORE, **kwargs):
+    '''
+    Write the job scripts of all benchmark runs and a submit script
+    queueing them, and return the list of runs. header(cores) returns
+    the PBS header of a run with cores cores. Runs with fewer than
+    min_points or more than max_points grid points per core are skipped.
+    '''
+
+    benchmarks = []
+    with open(submit, 'w') as f:
+        f.write('#!/bin/bash\n')
+        for grid in grids:
+            for cores in cores_choices:
+                if not min_points <= get_points_per_core(grid, cores) <= max_points:
+                    continue
+                for stress_balance in stress_balances:
+                    bench = make_benchmark(grid, cores, stress_balance, years, **kwargs)
+                    write_benchmark_script(bench, header(cores))
+                    f.write('qsub {}\n'.format(bench['script']))
+                    benchmarks.append(bench)
+
+    return benchmarks
+
+
+def parse_benchmark_log(filename):
+    '''
+    Return (total, stages, n_steps) of a time stamped benchmark log: the
+    wall-clock seconds of the whole run, the seconds per stage (see
+    stage_timing.split_run_log) and the number of steps. Returns None
+    if the log has no time steps.
+    '''
+
+    stages = split_run_log(filename)
+    if stages is None:
+        return None
+
+    first_line = last_line = None
+    n_steps = 0
+    with open(filename, 'r', errors='replace') as f:
+        for line in f:
+            fields = line.rstrip('\n').split(' ', 1)
+            try:
+                t = float(fields[0])
+            except ValueError:
+                continue
+            if first_line is None:
+                first_line = t
+            last_line = t
+            if len(fields) > 1 and STEP_PATTERN.match(fields[1]):
+                n_steps += 1
+
+    return (last_line - first_line, stages, n_steps)
+
+
+def collect_results(pattern='{}_g*m_*_n*.log'.format(PREFIX)):
+    '''
+    Return a list of result records, one per benchmark log matching
+    pattern, sorted by stress balance, grid and cores
+    '''
+
+    name_pattern = re.compile(r'{}_g(\d+)m_(.+)_n(\d+)\.log$'.format(PREFIX))
+    results = []
+    for filename in glob.glob(pattern):
+        m = name_pattern.search(os.path.basename(filename))
+        if m is None:
+            continue
+        timing = parse_benchmark_log(filename)
+        if timing is None:
+            print('no time steps in {}, skipped'.format(filename))
+            continue
+        grid, stress_balance, cores = int(m.group(1)), m.group(2), int(m.group(3))
+        grid_dict = generate_grid_description(grid)
+
+        record = OrderedDict()
+        record['grid'] = grid
+        record['stress_balance'] = stress_balance
+        record['cores'] = cores
+        record['Mx'] = int(grid_dict['Mx'])
+        record['My'] = int(grid_dict['My'])
+        record['Mz'] = grid_dict['Mz']
+        record['points_per_core'] = int(get_points_per_core(grid, cores))
+        record['wall_seconds'], stages, record['n_steps'] = timing
+        record['init_seconds'] = stages['init'] + stages['regrid']
+        record['step_seconds'] = stages['stepping']
+        record['extra_write_seconds'] = stages['extra_write']
+        record['write_seconds'] = stages['write']
+        record['io_seconds'] = sum([stages[stage] for stage in IO_STAGES])
+        record['seconds_per_step'] = record['step_seconds'] / record['n_steps']
+        stats = read_run_stats(filename[:-len('.log')] + '.nc')
+        record['years_per_hour'] = stats['years_per_hour'] if stats is not None else np.nan
+        results.append(record)
+
+    results.sort(key=lambda r: (r['stress_balance'], -r['grid'], r['cores']))
+    add_scaling(results)
+
+    return results
+
+
+def add_scaling(results):
+    '''
+    Add strong scaling speedup and efficiency, relative to the run of
+    the same grid and stress balance with the fewest cores, and weak
+    scaling efficiency, relative to the run of the same stress balance
+    and (within 10%) the same grid points per core on the coarsest grid,
+    to each record. Both compare the time per time step.
+    '''
+
+    for r in results:
+        same = [o for o in results if o['grid'] == r['grid'] and o['stress_balance'] == r['stress_balance']]
+        base = min(same, key=lambda o: o['cores'])
+        r['speedup'] = base['seconds_per_step'] / r['seconds_per_step'] * base['cores']
+        r['strong_efficiency'] = r['speedup'] / r['cores']
+
+        same = [o for o in results if o['stress_balance'] == r['stress_balance'] and
+                abs(o['points_per_core'] - r['points_per_core']) <= 0.1 * r['points_per_core']]
+        base = max(same, key=lambda o: o['grid'])
+        r['weak_efficiency'] = base['seconds_per_step'] / r['seconds_per_step']
+
+
+def write_results(results, filename=RESULTS):
+    '''
+    Write result records as a CSV table
+    '''
+
+    with open(filename, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(list(results[0].keys()))
+        for r in results:
+            writer.writerow([('{:.4g}'.format(v) if isinstance(v, float) else v) for v in r.values()])
+
+
+def print_best(results):
+    '''
+    Print the largest core count of each grid and stress balance that
+    still has a strong scaling efficiency of at least 0.7
+    '''
+
+    keys = uniquify_list([(r['stress_balance'], r['grid']) for r in results])
+    for stress_balance, grid in keys:
+        same = [r for r in results if r['grid'] == grid and r['stress_balance'] == stress_balance]
+        efficient = [r for r in same if r['strong_efficiency'] >= 0.7] or same
+        best = max(efficient, key=lambda r: r['cores'])
+        print('g{:>5}m {:8} most cores at >= 70% efficiency: {:5d} ({:.2f} s/step, {:.0f}% I/O)'.format(
+            grid, stress_balance, best['cores'], best['seconds_per_step'],
+            100 * best['io_seconds'] / best['wall_seconds']))
+
+
+def plot_scaling(results, prefix=PREFIX):
+    '''
+    Plot strong scaling (speedup vs cores per grid) and weak scaling
+    (seconds per step vs cores at constant points per core)
+    '''
+
+    import pylab as plt
+
+    for stress_balance in uniquify_list([r['stress_balance'] for r in results]):
+        sb_results = [r for r in results if r['stress_balance'] == stress_balance]
+
+        fig = plt.figure()
+        ax = fig.add_subplot(111)
+        for grid in uniquify_list([r['grid'] for r in sb_results]):
+            rs = [r for r in sb_results if r['grid'] == grid]
+            ax.loglog([r['cores'] for r in rs], [r['speedup'] for r in rs], 'o-', label='{} m'.format(grid))
+        cores = [r['cores'] for r in sb_results]
+        ax.loglog([min(cores), max(cores)], [min(cores), max(cores)], 'k:', label='ideal')
+        ax.set_xlabel('cores')
+        ax.set_ylabel('speedup')
+        ax.set_title('strong scaling, {}'.format(stress_balance))
+        ax.legend(loc='upper left')
+        fig.savefig('{}_strong_{}.pdf'.format(prefix, stress_balance), bbox_inches='tight')
+        plt.close(fig)
+
+        fig = plt.figure()
+        ax = fig.add_subplot(111)
+        buckets = uniquify_list([int(2 ** np.round(np.log2(r['points_per_core']))) for r in sb_results])
+        for bucket in sorted(buckets):
+            rs = [r for r in sb_results if int(2 ** np.round(np.log2(r['points_per_core']))) == bucket]
+            if len(rs) < 2:
+                continue
+            rs.sort(key=lambda r: r['cores'])
+            ax.semilogx([r['cores'] for r in rs], [r['seconds_per_step'] for r in rs], 'o-',
+                        label='{} points/core'.format(bucket))
+        ax.set_xlabel('cores')
+        ax.set_ylabel('seconds per time step')
+        ax.set_title('weak scaling, {}'.format(stress_balance))
+        ax.legend(loc='upper left')
+        fig.savefig('{}_weak_{}.pdf'.format(prefix, stress_balance), bbox_inches='tight')
+        plt.close(fig)
+
+
+if __name__ == "__main__":
+
+    # set up the option parser
+    parser = ArgumentParser()
+    parser.description = "Generate and evaluate strong and weak scaling benchmarks."
+    subparsers = parser.add_subparsers(dest="command")
+
+    generate_parser = subparsers.add_parser("generate", help="write benchmark job scripts")
+    generate_parser.add_argument("-g", "--grids", dest="grids",
+                                 help="comma-separated grid resolutions. default: all accepted resolutions",
+                                 default=','.join([str(g) for g in accepted_resolutions]))
+    generate_parser.add_argument("-n", "--n_procs", dest="cores",
+                                 help="comma-separated core counts. default=1,2,4,...,1024",
+                                 default=','.join([str(2 ** k) for k in range(11)]))
+    generate_parser.add_argument("--stress_balance", dest="stress_balance",
+                                 help="comma-separated stress balances. default=sia,ssa+sia", default='sia,ssa+sia')
+    generate_parser.add_argument("--years", dest="years", type=int,
+                                 help="model years of each run. default=5", default=5)
+    generate_parser.add_argument("-b", "--bed_type", dest="bed_type",
+                                 choices=['ctrl', 'old_bed', 'ba01_bed', '970mW_hs', 'jak_1985', 'cresis'],
+                                 help="subglacial topograpy type", default='ctrl')
+    generate_parser.add_argument("-w", '--wall_time', dest="walltime",
+                                 help='''walltime. default: 2:00:00.''', default="2:00:00")
+    generate_parser.add_argument("-q", '--queue', dest="queue", choices=['standard_4', 'standard_16', 'standard', 'gpu', 'gpu_long', 'long', 'normal'],
+                                 help='''queue. default=standard_4.''', default='standard_4')
+    generate_parser.add_argument("-s", "--system", dest="system",
+                                 choices=['pleiades', 'fish', 'pacman', 'debug'],
+                                 help="computer system to use.", default='pacman')
+    generate_parser.add_argument("--min_points_per_core", dest="min_points", type=float,
+                                 help="skip runs with fewer grid points per core. default={}".format(MIN_POINTS_PER_CORE),
+                                 default=MIN_POINTS_PER_CORE)
+    generate_parser.add_argument("--max_points_per_core", dest="max_points", type=float,
+                                 help="skip runs with more grid points per core. default={}".format(MAX_POINTS_PER_CORE),
+                                 default=MAX_POINTS_PER_CORE)
+    generate_parser.add_argument("--run_local", dest="run_local", type=int,
+                                 help="run the benchmarks here on RUN_LOCAL cores (see local_executor.py) instead of writing a submit script only",
+                                 default=None)
+
+    collect_parser = subparsers.add_parser("collect", help="collect the results table")
+    collect_parser.add_argument("-o", "--output", dest="output",
+                                help="results table. default={}".format(RESULTS), default=RESULTS)
+    collect_parser.add_argument("--plot", dest="plot", action="store_true",
+                                help="plot strong and weak scaling", default=False)
+
+    options = parser.parse_args()
+
+    if options.command in ('generate',):
+        system = options.system
+        queue = options.queue
+        walltime = options.walltime
+
+        def header(cores):
+            if options.run_local is not None:
+                return '#!/bin/bash\n'
+            return make_pbs_header(system, cores, walltime, queue)
+
+        grids = [int(g) for g in options.grids.split(',')]
+        cores_choices = [int(n) for n in options.cores.split(',')]
+        submit = 'submit_{}.sh'.format(PREFIX)
+        benchmarks = generate_benchmarks(grids, cores_choices, options.stress_balance.split(','), options.years,
+                                         submit, header, min_points=options.min_points, max_points=options.max_points,
+                                         bed_type=options.bed_type)
+        print('wrote {} benchmark runs'.format(len(benchmarks)))
+        if options.run_local is not None:
+            from local_executor import parse_submit_script, make_tasks, run_tasks
+            tasks = make_tasks(parse_submit_script(submit))
+            failed = run_tasks(tasks, options.run_local)
+            print('{} of {} benchmark runs succeeded'.format(len(tasks) - failed, len(tasks)))
+        else:
+            print("\nRun {} to submit all jobs to the scheduler\n".format(submit))
+    elif options.command in ('collect',):
+        results = collect_results()
+        if not results:
+            print('no benchmark logs found')
+            sys.exit(1)
+        write_results(results, options.output)
+        print_best(results)
+        print('\nwrote {}'.format(options.output))
+        if options.plot:
+            plot_scaling(results)
+    else:
+        parser.print_help()
+        sys.exit(1)
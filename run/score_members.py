@@ -0,0 +1,440 @@
+#!/usr/bin/env python
+# Copyright (C) 2015 Andy Aschwanden
+
+# Score the members of a calibration ensemble against observations and
+# rank them. Members come from the run manifest (see manifest.py) or a
+# glob; their parameters are taken from the manifest or, for globs, from
+# the PISM command line in the history attribute. Metrics:
+#
+# speed_rmse        RMSE of velsurf_mag against the observed speeds (m/yr)
+# log_speed_rmse    RMSE of log10(velsurf_mag) against log10 of observations
+# thk_rmse          RMSE of thk against the boot file thickness (m)
+# discharge_rmse    RMSE of the flux-gate discharge of the last record
+#                   against observed discharge (Gt/yr), needs gates (see
+#                   flux_gates.py) and --obs_discharge
+#
+# Observations are masked where the boot thickness is below THK_MIN and
+# come from the observation cache (see obs_cache.py). Members are scored
+# in parallel. Every score is appended to SCORES (JSON lines) as soon as
+# it is done, and members already scored against the same observations
+# are skipped unless they changed or a metric is missing, so a rerun
+# after new members land only scores the new ones. The ranked table is
+# rewritten after each run.
+#
+# Example
+# -------
+# $ score_members.py --manifest manifest.sqlite -g 1500 --boot_file pism_Greenland_1500m_mcb_jpl_v2_ctrl.nc \
+#   --obs_file surf_vels_1500m.nc -n 16 -o ranking.csv
+# $ score_members.py --boot_file ... --obs_file ... -m speed_rmse,discharge_rmse \
+#   -s greenland-flux-gates-250m.shp --obs_discharge gates_observed.csv 'processed/g1500m_*.nc'
+
+import os
+import sys
+import csv
+import glob
+import json
+import hashlib
+import numpy as np
+from collections import OrderedDict
+from multiprocessing import Pool
+from argparse import ArgumentParser
+
+try:
+    from netCDF3 import Dataset as CDF
+except:
+    from netCDF4 import Dataset as CDF
+from obs_cache import CACHE_DIR, file_checksum, load_observation, read_field
+from job_sizing import parse_options
+
+SCORES = 'scores.jsonl'
+METRICS = ('speed_rmse', 'log_speed_rmse', 'thk_rmse', 'discharge_rmse')
+THK_MIN = 25.
+# cells where abs(model - observed speed) exceeds OUTLIER are not scored,
+# as in makehist_speed.py
+OUTLIER = 500.
+# output options that differ between members but are not parameters
+IGNORED_OPTIONS = ('o', 'o_size', 'o_format', 'extra_file', 'extra_times', 'extra_vars', 'ts_file', 'ts_times',
+                   'ts_vars')
+
+
+def get_file_params(filename):
+    '''
+    Return the options of the last PISM command in the history attribute
+    of filename
+    '''
+
+    nc = CDF(filename, 'r')
+    history = getattr(nc, 'history', '')
+    nc.close()
+    # post-processing tools add their own lines to the history
+    for line in history.splitlines():
+        if 'pism' in line and ' -' in line:
+            options = parse_options(line)
+            return dict([(name, value) for name, value in options.items()
+                         if name not in IGNORED_OPTIONS and not value.endswith('.nc')])
+
+    return {}
+
+
+def get_member_signature(filename):
+    '''
+    Return a string that changes when filename changes
+    '''
+
+    return '{}:{}'.format(os.path.getsize(filename), int(os.path.getmtime(filename)))
+
+
+def read_gate_discharge(filename):
+    '''
+    Return an OrderedDict gate -> observed discharge (Gt/yr) from a CSV
+    file with columns gate and discharge
+    '''
+
+    observed = OrderedDict()
+    with open(filename, 'r') as f:
+        for row in csv.DictReader(f):
+            observed[row['gate']] = float(row['discharge'])
+
+    return observed
+
+
+def rmse(model, observed):
+    '''
+    Return the RMSE and the number of cells where both are finite
+    '''
+
+    diff = np.asarray(model, dtype='float64') - np.asarray(observed, dtype='float64')
+    valid = np.isfinite(diff)
+    n = int(valid.sum())
+    if n == 0:
+        return np.nan, 0
+
+    return float(np.sqrt(np.mean(diff[valid] ** 2))), n
+
+
+# set by init_worker in every worker
+_context = {}
+
+
+def init_worker(context):
+    _context.update(context)
+
+
+def read_valid_cells(filename, variable, observation):
+    '''
+    Return the values of the last record of variable in filename at the
+    observed cells. Raises ValueError if filename is on another grid
+    than the observations.
+    '''
+
+    field = read_field(filename, variable)[0]
+    shape = tuple([int(n) for n in observation['shape']])
+    if field.shape != shape:
+        raise ValueError('grid {} does not match the observations {}'.format(field.shape, shape))
+
+    return field.ravel()[observation['valid_idx']]
+
+
+def get_grid_spacing(filename):
+    '''
+    Return the grid spacing (m) of filename, as used for the grid of the
+    members in the manifest
+    '''
+
+    nc = CDF(filename, 'r')
+    x = nc.variables['x'][:]
+    nc.close()
+
+    return int(round(abs(float(x[1]) - float(x[0]))))
+
+
+def score_member(filename):
+    '''
+    Return an OrderedDict metric -> value (and number of cells) of
+    filename, using the observations in _context
+    '''
+
+    metrics = _context['metrics']
+    observation = _context['observation']
+    obs = np.asarray(observation['obs'])
+    scores = OrderedDict()
+
+    if 'speed_rmse' in metrics or 'log_speed_rmse' in metrics:
+        speed = read_valid_cells(filename, 'velsurf_mag', observation)
+        with np.errstate(invalid='ignore'):
+            keep = np.abs(speed - obs) <= _context['outlier']
+        if 'speed_rmse' in metrics:
+            scores['speed_rmse'], scores['speed_cells'] = rmse(speed[keep], obs[keep])
+        if 'log_speed_rmse' in metrics:
+            with np.errstate(invalid='ignore'):
+                positive = keep & (speed > 0) & (obs > 0)
+            scores['log_speed_rmse'], scores['log_speed_cells'] = rmse(np.log10(speed[positive]),
+                                                                       np.log10(obs[positive]))
+    if 'thk_rmse' in metrics:
+        thk = read_valid_cells(filename, 'thk', observation)
+        scores['thk_rmse'], scores['thk_cells'] = rmse(thk, _context['boot_thk'])
+    if 'discharge_rmse' in metrics:
+        from flux_gates import compute_discharge
+        observed = _context['obs_discharge']
+        columns = compute_discharge(filename, _context['gates'])
+        # discharge of the last record of each gate
+        model = OrderedDict(zip(columns['gate'], columns['discharge']))
+        names = [name for name in observed.keys() if name in model]
+        scores['discharge_rmse'], scores['discharge_gates'] = rmse([model[n] for n in names],
+                                                                   [observed[n] for n in names])
+
+    return scores
+
+
+def _score(args):
+    filename, params = args
+    try:
+        return filename, params, score_member(filename)
+    except (IOError, RuntimeError, KeyError, ValueError) as e:
+        print('could not score {}: {}'.format(filename, e))
+        return filename, params, None
+
+
+def get_config_key(boot_file, obs_file, thk_min, outlier, gates=None, obs_discharge_file=None):
+    '''
+    Return a key of everything the scores depend on besides the member
+    and the metrics
+    '''
+
+    config = OrderedDict()
+    config['boot'] = file_checksum(boot_file)
+    config['obs'] = file_checksum(obs_file)
+    config['thk_min'] = float(thk_min)
+    config['outlier'] = float(outlier)
+    if gates is not None:
+        # gate files by checksum, --gate strings as they are
+        config['gates'] = [file_checksum(g) if os.path.isfile(g) else g for g in gates if g is not None]
+    if obs_discharge_file is not None:
+        config['obs_discharge'] = file_checksum(obs_discharge_file)
+
+    return hashlib.sha1(json.dumps(config).encode('utf-8')).hexdigest()
+
+
+def read_scores(filename, config_key):
+    '''
+    Return an OrderedDict (member, signature) -> record of the scores in
+    filename computed with config_key
+    '''
+
+    records = OrderedDict()
+    if not os.path.isfile(filename):
+        return records
+    with open(filename, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # a line cut short by an interrupted run
+                continue
+            if record.get('config') == config_key:
+                records[(record['member'], record['signature'])] = record
+
+    return records
+
+
+def score_members(members, scores_file, config_key, context, n_procs=1):
+    '''
+    Score members, a list of (filename, params), that have no record
+    with all metrics in scores_file yet, appending each new record as
+    soon as it is done. Returns all current records.
+    '''
+
+    records = read_scores(scores_file, config_key)
+    todo = []
+    for filename, params in members:
+        record = records.get((filename, get_member_signature(filename)))
+        if record is None or not all([m in record['scores'] for m in context['metrics']]):
+            todo.append((filename, params))
+    print('{} members, {} already scored, {} to score'.format(len(members), len(members) - len(todo), len(todo)))
+
+    if n_procs > 1 and len(todo) > 1:
+        pool = Pool(min(n_procs, len(todo)), initializer=init_worker, initargs=(context,))
+        results = pool.imap_unordered(_score, todo)
+    else:
+        init_worker(context)
+        pool = None
+        results = (_score(a) for a in todo)
+
+    with open(scores_file, 'a') as f:
+        for filename, params, scores in results:
+            if scores is None:
+                continue
+            signature = get_member_signature(filename)
+            # keep the scores of metrics not asked for this time
+            if (filename, signature) in records:
+                old = OrderedDict(records[(filename, signature)]['scores'])
+                old.update(scores)
+                scores = old
+            record = OrderedDict()
+            record['member'] = filename
+            record['signature'] = signature
+            record['config'] = config_key
+            record['params'] = params
+            record['scores'] = scores
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            records[(filename, record['signature'])] = record
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    # keep the records of the current members only
+    current = set([(filename, get_member_signature(filename)) for filename, params in members])
+
+    return [r for key, r in records.items() if key in current]
+
+
+def rank_records(records, rank_by):
+    '''
+    Return records sorted by the score rank_by, members without that
+    score last
+    '''
+
+    def key(record):
+        value = record['scores'].get(rank_by)
+        return (value is None or not np.isfinite(value), value if value is not None else 0.)
+
+    return sorted(records, key=key)
+
+
+def write_ranking(records, filename, metrics):
+    '''
+    Write ranked records as CSV: rank, parameters that vary across
+    members, scores and member
+    '''
+
+    names = []
+    for record in records:
+        for name in record['params'].keys():
+            if name not in names:
+                names.append(name)
+    varying = [name for name in names
+               if len(set([str(r['params'].get(name)) for r in records])) > 1] or names
+    score_names = []
+    for record in records:
+        for name in record['scores'].keys():
+            if name not in score_names:
+                score_names.append(name)
+    score_names.sort(key=lambda n: (n not in metrics, metrics.index(n) if n in metrics else 0))
+
+    with open(filename, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['rank'] + varying + score_names + ['member'])
+        for k, record in enumerate(records):
+            writer.writerow([k + 1] + [record['params'].get(name, '') for name in varying] +
+                            [record['scores'].get(name, '') for name in score_names] + [record['member']])
+
+    return varying
+
+
+if __name__ == "__main__":
+
+    # set up the option parser
+    parser = ArgumentParser()
+    parser.description = "Score ensemble members against observations and rank them."
+    parser.add_argument("FILE", nargs='*',
+                        help="member output files or globs")
+    parser.add_argument("--manifest", dest="manifest",
+                        help="score the processed outputs of the members in this manifest", default=None)
+    parser.add_argument("-g", "--grid", dest="grid", type=int,
+                        help="only manifest members of this grid. default: the grid of the boot file", default=None)
+    parser.add_argument("--status", dest="status",
+                        help="only manifest members with this status", default=None)
+    parser.add_argument("--boot_file", dest="boot_file",
+                        help="file containing the observed ice thickness (thk)", default="foo.nc")
+    parser.add_argument("--obs_file", dest="obs_file",
+                        help="file containing observed speeds (velsurf_mag)", default="bar.nc")
+    parser.add_argument("-m", "--metrics", dest="metrics",
+                        help="comma-separated list of metrics ({}). default=speed_rmse,log_speed_rmse,thk_rmse".format(
+                            ', '.join(METRICS)), default='speed_rmse,log_speed_rmse,thk_rmse')
+    parser.add_argument("--rank_by", dest="rank_by",
+                        help="metric the members are ranked by. default: the first metric", default=None)
+    parser.add_argument("-s", "--shape_file", dest="shape_file",
+                        help="flux gate shapefile for discharge_rmse", default=None)
+    parser.add_argument("--gate", dest="gates", action="append",
+                        help="flux gate 'name,x0,y0,x1,y1[,...]' in EPSG:3413 for discharge_rmse", default=[])
+    parser.add_argument("--obs_discharge", dest="obs_discharge",
+                        help="CSV file with columns gate,discharge (Gt/yr) for discharge_rmse", default=None)
+    parser.add_argument("--thk_min", dest="thk_min", type=float,
+                        help="score cells where boot thk > thk_min. default={}".format(THK_MIN), default=THK_MIN)
+    parser.add_argument("--outlier", dest="outlier", type=float,
+                        help="ignore cells where the speed misfit exceeds this (m/yr). default={}".format(OUTLIER),
+                        default=OUTLIER)
+    parser.add_argument("--cache_dir", dest="cache_dir",
+                        help="observation cache directory. default={}".format(CACHE_DIR), default=CACHE_DIR)
+    parser.add_argument("--field_store", dest="store_dir",
+                        help="take boot and observed fields from this shared field store (see field_store.py)",
+                        default=None)
+    parser.add_argument("--scores", dest="scores",
+                        help="file of the scores of each member. default={}".format(SCORES), default=SCORES)
+    parser.add_argument("-n", '--n_procs', dest="n", type=int,
+                        help='''number of processes. default=1.''', default=1)
+    parser.add_argument("-o", "--output", dest="output",
+                        help="ranked table. default=ranking.csv", default='ranking.csv')
+
+    options = parser.parse_args()
+
+    metrics = options.metrics.split(',')
+    for metric in metrics:
+        if metric not in METRICS:
+            print('unknown metric {}, choose from {}'.format(metric, ', '.join(METRICS)))
+            sys.exit(1)
+    rank_by = options.rank_by or metrics[0]
+
+    members = []
+    if options.manifest is not None:
+        from manifest import open_manifest, query_members, get_member_paths
+        conn = open_manifest(options.manifest)
+        # members on other grids cannot be compared with the observations
+        grid = options.grid if options.grid is not None else get_grid_spacing(options.boot_file)
+        for member in query_members(conn, grid=grid, status=options.status):
+            for path in get_member_paths(member, 'processed'):
+                if os.path.isfile(path):
+                    members.append((path, member['params']))
+        conn.close()
+    for pattern in options.FILE:
+        for filename in sorted(glob.glob(pattern)):
+            members.append((filename, get_file_params(filename)))
+    if not members:
+        print('no members found')
+        sys.exit(1)
+
+    observation = load_observation(options.boot_file, options.obs_file, thk_min=options.thk_min,
+                                   cache_dir=options.cache_dir, store_dir=options.store_dir)
+    context = {'metrics': metrics, 'outlier': options.outlier,
+               'observation': dict([(k, np.asarray(observation[k])) for k in ('obs', 'valid_idx', 'shape')])}
+    if 'thk_rmse' in metrics:
+        if options.store_dir is not None:
+            from field_store import attach_field
+            boot_thk = attach_field(options.boot_file, 'thk', store_dir=options.store_dir)[0]
+        else:
+            boot_thk = read_field(options.boot_file, 'thk')[0]
+        context['boot_thk'] = np.asarray(boot_thk).ravel()[context['observation']['valid_idx']]
+    if 'discharge_rmse' in metrics:
+        if (options.shape_file is None and not options.gates) or options.obs_discharge is None:
+            print('discharge_rmse needs gates (-s or --gate) and --obs_discharge')
+            sys.exit(1)
+        from flux_gates import parse_gate, read_gates
+        gates = OrderedDict()
+        if options.shape_file is not None:
+            gates.update(read_gates(options.shape_file))
+        gates.update([parse_gate(gate) for gate in options.gates])
+        context['gates'] = gates
+        context['obs_discharge'] = read_gate_discharge(options.obs_discharge)
+
+    config_key = get_config_key(options.boot_file, options.obs_file, options.thk_min, options.outlier,
+                                gates=[options.shape_file] + options.gates, obs_discharge_file=options.obs_discharge)
+    records = score_members(members, options.scores, config_key, context, n_procs=options.n)
+    records = rank_records(records, rank_by)
+    varying = write_ranking(records, options.output, metrics)
+
+    print('\nTop members by {}:'.format(rank_by))
+    for k, record in enumerate(records[:10]):
+        print('  {:3d} {:>12} {}'.format(k + 1, '{:.3f}'.format(record['scores'].get(rank_by, np.nan)),
+                                         ' '.join(['{}={}'.format(n, record['params'].get(n, '')) for n in varying])))
+    print('\nwrote {} members to {}'.format(len(records), options.output))
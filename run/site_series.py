@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# Copyright (C) 2015 Andy Aschwanden
+
+# Extract time series at named sites (e.g. glacier termini) from the
+# -extra_file outputs of an ensemble. The (x, y) -> grid index lookup of
+# the sites is computed once per grid and kept in SITE_INDEX, and every
+# series is read as a single hyperslab var[:, j, i], so no full map is
+# read. Results of all members go to one columnar table (.npz, one
+# array per column: member, site, time and one column per variable).
+#
+# Example
+# -------
+# $ site_series.py -v velsurf_mag,thk -o series.npz 'processed/ex_g1500m_*hindcast_1989-2011.nc'
+# $ site_series.py --manifest manifest.sqlite -g 1500 --site 'my_site,-180000,-2270000' -o series.npz
+
+import os
+import sys
+import glob
+import json
+import hashlib
+import numpy as np
+import multiprocessing
+from collections import OrderedDict
+from argparse import ArgumentParser
+
+try:
+    from netCDF3 import Dataset as CDF
+except:
+    from netCDF4 import Dataset as CDF
+
+SITE_INDEX = '.site_index.json'
+# approximate terminus positions in EPSG:3413 (m)
+SITES = OrderedDict()
+SITES['jakobshavn'] = (-182500., -2277500.)
+SITES['helheim'] = (310000., -2578000.)
+SITES['kangerdlugssuaq'] = (497000., -2296000.)
+SITES['petermann'] = (-276000., -955000.)
+SITES['79north'] = (488000., -1082000.)
+SITES['zachariae'] = (520000., -1130000.)
+
+
+def parse_site(site):
+    '''
+    Return (name, (x, y)) from a string 'name,x,y'
+    '''
+
+    name, x, y = site.split(',')
+
+    return name, (float(x), float(y))
+
+
+def get_grid_key(x, y):
+    '''
+    Return a key identifying the grid with coordinates x, y
+    '''
+
+    sha = hashlib.sha1()
+    sha.update(np.asarray(x, dtype='float64').tobytes())
+    sha.update(np.asarray(y, dtype='float64').tobytes())
+
+    return sha.hexdigest()
+
+
+def build_site_index(x, y, sites):
+    '''
+    Return an OrderedDict site name -> (i, j), the indices of the
+    nearest x and y coordinates. Sites outside the grid are skipped.
+    '''
+
+    index = OrderedDict()
+    dx = np.abs(np.diff(x)).max() if len(x) > 1 else 0.
+    dy = np.abs(np.diff(y)).max() if len(y) > 1 else 0.
+    for name, (site_x, site_y) in sites.items():
+        i = int(np.argmin(np.abs(x - site_x)))
+        j = int(np.argmin(np.abs(y - site_y)))
+        if abs(x[i] - site_x) > dx or abs(y[j] - site_y) > dy:
+            print('site {} ({}, {}) is outside the grid, skipping'.format(name, site_x, site_y))
+            continue
+        index[name] = (i, j)
+
+    return index
+
+
+def load_site_index(filename, nc, sites):
+    '''
+    Return the site index (see build_site_index) of the grid of the open
+    file nc, read from the index file filename or built and saved there
+    '''
+
+    x = nc.variables['x'][:]
+    y = nc.variables['y'][:]
+    key = get_grid_key(x, y)
+    indices = {}
+    if filename is not None and os.path.isfile(filename):
+        with open(filename, 'r') as f:
+            indices = json.load(f)
+    stored = indices.get(key, {})
+    if all([name in stored and stored[name]['xy'] == list(xy) for name, xy in sites.items()]):
+        return OrderedDict([(name, tuple(stored[name]['ij'])) for name in sites.keys()
+                            if stored[name]['ij'] is not None])
+
+    index = build_site_index(x, y, sites)
+    if filename is not None:
+        # sites outside the grid are stored without indices
+        for name, xy in sites.items():
+            stored[name] = {'xy': list(xy), 'ij': list(index[name]) if name in index else None}
+        indices[key] = stored
+        tmp = '{}.tmp{}'.format(filename, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(indices, f)
+        os.rename(tmp, filename)
+
+    return index
+
+
+def extract_series(filename, sites, variables, index_file=SITE_INDEX):
+    '''
+    Return an OrderedDict column -> array (site, time and one column per
+    variable) of the time series of variables at sites in filename.
+    Variables missing from the file are NaN.
+    '''
+
+    nc = CDF(filename, 'r')
+    index = load_site_index(index_file, nc, sites)
+    if 'time' in nc.variables:
+        t = nc.variables['time'][:]
+    else:
+        t = np.zeros(1)
+    nt = len(t)
+
+    columns = OrderedDict()
+    columns['site'] = np.repeat(np.array(list(index.keys()), dtype='U'), nt)
+    columns['time'] = np.tile(np.asarray(t, dtype='float64'), len(index))
+    for name in variables:
+        values = np.empty((len(index), nt))
+        values.fill(np.nan)
+        if name in nc.variables:
+            var = nc.variables[name]
+            for k, (i, j) in enumerate(index.values()):
+                # hyperslab of one grid point, all records
+                slab = []
+                for dim in var.dimensions:
+                    if dim in ('x',):
+                        slab.append(i)
+                    elif dim in ('y',):
+                        slab.append(j)
+                    elif dim in ('time',):
+                        slab.append(slice(None))
+                    else:
+                        slab.append(0)
+                data = np.ma.masked_invalid(var[tuple(slab)]).astype('float64')
+                values[k] = np.ma.filled(data, np.nan)
+        columns[name] = values.ravel()
+    nc.close()
+
+    return columns
+
+
+def _extract(args):
+    filename, sites, variables, index_file = args
+    try:
+        return filename, extract_series(filename, sites, variables, index_file=index_file)
+    except (IOError, RuntimeError, KeyError) as e:
+        print('could not read {}: {}'.format(filename, e))
+        return filename, None
+
+
+def extract_members(filenames, sites, variables, n_procs=1, index_file=SITE_INDEX):
+    '''
+    Return the columns (see extract_series) of all files, with an
+    additional column 'member' (the file name), in the order of
+    filenames. Files are read by n_procs processes.
+    '''
+
+    # build the index of the first file's grid once, before forking
+    if filenames and index_file is not None:
+        nc = CDF(filenames[0], 'r')
+        load_site_index(index_file, nc, sites)
+        nc.close()
+
+    args = [(filename, sites, variables, index_file) for filename in filenames]
+    if n_procs > 1 and len(filenames) > 1:
+        pool = multiprocessing.Pool(min(n_procs, len(filenames)))
+        results = pool.map(_extract, args)
+        pool.close()
+        pool.join()
+    else:
+        results = [_extract(a) for a in args]
+
+    table = OrderedDict([('member', [])])
+    for filename, columns in results:
+        if columns is None:
+            continue
+        table['member'].append(np.repeat(np.array([filename], dtype='U'), len(columns['time'])))
+        for name, values in columns.items():
+            table.setdefault(name, []).append(values)
+
+    return OrderedDict([(name, np.concatenate(values)) for name, values in table.items() if values])
+
+
+def write_table(table, filename):
+    '''
+    Write a table as .npz (one array per column) or, if filename ends in
+    .csv, as CSV
+    '''
+
+    if filename.endswith('.csv'):
+        with open(filename, 'w') as f:
+            f.write(','.join(table.keys()) + '\n')
+            for row in zip(*table.values()):
+                f.write(','.join([str(v) for v in row]) + '\n')
+    else:
+        np.savez_compressed(filename, **table)
+
+
+def read_table(filename):
+    '''
+    Return the columns of a table written by write_table (.npz) as an
+    OrderedDict
+    '''
+
+    data = np.load(filename)
+
+    return OrderedDict([(name, data[name]) for name in data.files])
+
+
+if __name__ == "__main__":
+
+    # set up the option parser
+    parser = ArgumentParser()
+    parser.description = "Extract time series at named sites from extra files of many runs."
+    parser.add_argument("FILE", nargs='*',
+                        help="extra files or globs")
+    parser.add_argument("--manifest", dest="manifest",
+                        help="take the processed extra files of members in this manifest", default=None)
+    parser.add_argument("-g", "--grid", dest="grid", type=int,
+                        help="only manifest members of this grid", default=None)
+    parser.add_argument("-v", "--variables", dest="variables",
+                        help="comma-separated list of variables. default=velsurf_mag,thk", default='velsurf_mag,thk')
+    parser.add_argument("-s", "--sites", dest="sites",
+                        help="comma-separated list of sites. default: all of {}".format(', '.join(SITES.keys())),
+                        default=None)
+    parser.add_argument("--site", dest="extra_sites", action="append",
+                        help="additional site 'name,x,y' in EPSG:3413 (m), may be repeated", default=[])
+    parser.add_argument("--index_file", dest="index_file",
+                        help="site index file. default={}".format(SITE_INDEX), default=SITE_INDEX)
+    parser.add_argument("-n", '--n_procs', dest="n", type=int,
+                        help='''number of processes. default=1.''', default=1)
+    parser.add_argument("-o", "--output", dest="output",
+                        help="output table (.npz or .csv). default=site_series.npz", default='site_series.npz')
+
+    options = parser.parse_args()
+
+    if options.sites is not None:
+        sites = OrderedDict([(name, SITES[name]) for name in options.sites.split(',')])
+    elif options.extra_sites:
+        sites = OrderedDict()
+    else:
+        sites = OrderedDict(SITES)
+    sites.update([parse_site(site) for site in options.extra_sites])
+
+    filenames = []
+    for pattern in options.FILE:
+        filenames.extend(sorted(glob.glob(pattern)))
+    if options.manifest is not None:
+        from manifest import open_manifest, query_members, get_member_paths
+        conn = open_manifest(options.manifest)
+        for member in query_members(conn, grid=options.grid):
+            for path in get_member_paths(member, 'processed'):
+                ex_file = os.path.join(os.path.dirname(path), 'ex_' + os.path.basename(path))
+                if os.path.isfile(ex_file):
+                    filenames.append(ex_file)
+        conn.close()
+    if not filenames:
+        print('no extra files found')
+        sys.exit(1)
+
+    table = extract_members(filenames, sites, options.variables.split(','), n_procs=options.n,
+                            index_file=options.index_file)
+    write_table(table, options.output)
+    print('wrote {} rows of {} sites from {} files to {}'.format(len(table.get('time', [])), len(sites),
+                                                                 len(filenames), options.output))
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# Copyright (C) 2015 Andy Aschwanden
+
+# Speed contours of many runs in one layer. Replaces gdal_contour and
+# ogr2ogr -t_srs EPSG:4326 in run-postpro-2.sh and run-postpro-fc.sh:
+# contours are traced by marching squares over the field in memory, the
+# vertices of all contours of a member are reprojected from EPSG:3413 to
+# EPSG:4326 in one call, and all members are written to a single GeoJSON
+# (or, with ogr, GeoPackage) layer with one MultiLineString feature per
+# member and level.
+#
+# Example
+# -------
+# $ speed_contours.py -n 8 -o speed_contours_epsg4326.geojson processed/g1500m_*.nc
+# $ speed_contours.py -l 100,200,1000 -o speed_contours_epsg4326.gpkg g1500m_out.nc
+
+import os
+import sys
+import glob
+import json
+import numpy as np
+from collections import OrderedDict
+from multiprocessing import Pool
+from argparse import ArgumentParser
+
+from add_epsg3413_mapping import PROJ4
+from render_maps import read_fields
+
+LEVELS = (100., 200., 1000.)
+LAYER = 'speed_contours'
+
+
+def trace_contours(x, y, data, level):
+    '''
+    Return the contour lines of data (y, x) at level as a list of (N, 2)
+    arrays of (x, y) vertices. Masked and NaN cells are not contoured.
+    '''
+
+    f = np.ma.filled(np.ma.masked_invalid(data).astype('float64'), np.nan)
+    ny, nx = f.shape
+    above = f >= level
+    valid = np.isfinite(f)
+
+    # crossings on horizontal edges (j, i)-(j, i + 1) and vertical edges (j, i)-(j + 1, i)
+    h_cross = valid[:, :-1] & valid[:, 1:] & (above[:, :-1] != above[:, 1:])
+    v_cross = valid[:-1, :] & valid[1:, :] & (above[:-1, :] != above[1:, :])
+    n_h = ny * (nx - 1)
+    h_id = np.arange(n_h).reshape(ny, nx - 1)
+    v_id = n_h + np.arange((ny - 1) * nx).reshape(ny - 1, nx)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = (level - f[:, :-1]) / (f[:, 1:] - f[:, :-1])
+        h_x = x[:-1][np.newaxis, :] + t * np.diff(x)[np.newaxis, :]
+        h_y = np.repeat(y[:, np.newaxis], nx - 1, axis=1)
+        t = (level - f[:-1, :]) / (f[1:, :] - f[:-1, :])
+        v_x = np.repeat(x[np.newaxis, :], ny - 1, axis=0)
+        v_y = y[:-1][:, np.newaxis] + t * np.diff(y)[:, np.newaxis]
+    points = np.zeros((n_h + (ny - 1) * nx, 2))
+    points[:n_h, 0], points[:n_h, 1] = h_x.ravel(), h_y.ravel()
+    points[n_h:, 0], points[n_h:, 1] = v_x.ravel(), v_y.ravel()
+
+    # edges of cell (j, i): bottom, right, top, left
+    edges = [(h_cross[:-1, :], h_id[:-1, :]), (v_cross[:, 1:], v_id[:, 1:]),
+             (h_cross[1:, :], h_id[1:, :]), (v_cross[:, :-1], v_id[:, :-1])]
+    crossed = np.array([e[0] for e in edges])
+    n_crossed = crossed.sum(axis=0)
+    segments = []
+    for k0 in range(4):
+        for k1 in range(k0 + 1, 4):
+            mask = (n_crossed == 2) & crossed[k0] & crossed[k1]
+            segments.append(np.column_stack([edges[k0][1][mask], edges[k1][1][mask]]))
+    # saddles: the center value decides which corners are connected
+    saddle = n_crossed == 4
+    if saddle.any():
+        center = 0.25 * (f[:-1, :-1] + f[:-1, 1:] + f[1:, :-1] + f[1:, 1:])
+        joined = (center >= level) == above[:-1, :-1]
+        for pairs, mask in ((((0, 1), (2, 3)), saddle & joined), (((0, 3), (1, 2)), saddle & ~joined)):
+            for k0, k1 in pairs:
+                segments.append(np.column_stack([edges[k0][1][mask], edges[k1][1][mask]]))
+    segments = np.vstack(segments)
+
+    # join segments sharing an edge into lines
+    neighbors = {}
+    for a, b in segments:
+        neighbors.setdefault(a, []).append(b)
+        neighbors.setdefault(b, []).append(a)
+    lines = []
+    visited = set()
+
+    def walk(start):
+        line = [start]
+        visited.add(start)
+        current = start
+        while True:
+            following = [n for n in neighbors[current] if n not in visited]
+            if not following:
+                if len(line) > 2 and start in neighbors[current]:
+                    line.append(start)
+                break
+            current = following[0]
+            visited.add(current)
+            line.append(current)
+        return line
+
+    # open lines start at an end, the rest are closed rings
+    for node in [n for n, ns in neighbors.items() if len(ns) == 1] + list(neighbors.keys()):
+        if node not in visited:
+            lines.append(points[walk(node)])
+
+    return lines
+
+
+def get_member_contours(filename, variable='velsurf_mag', levels=LEVELS):
+    '''
+    Return an OrderedDict level -> list of (N, 2) (lon, lat) arrays of
+    the contours of the last record of variable in filename
+    '''
+
+    from pyproj import Proj
+
+    x, y, fields = read_fields(filename, [variable])
+    contours = OrderedDict()
+    for level in levels:
+        contours[level] = trace_contours(x, y, fields[variable], level)
+
+    # reproject all vertices at once
+    lines = [line for level_lines in contours.values() for line in level_lines]
+    if lines:
+        vertices = np.vstack(lines)
+        lon, lat = Proj(PROJ4)(vertices[:, 0], vertices[:, 1], inverse=True)
+        lonlat = np.column_stack([lon, lat])
+        k = 0
+        for level_lines in contours.values():
+            for n, line in enumerate(level_lines):
+                level_lines[n] = lonlat[k:k + len(line)]
+                k += len(line)
+
+    return contours
+
+
+def _contours(args):
+    filename, variable, levels = args
+    try:
+        return filename, get_member_contours(filename, variable=variable, levels=levels)
+    except (IOError, RuntimeError, KeyError) as e:
+        print('could not contour {}: {}'.format(filename, e))
+        return filename, None
+
+
+def write_geojson(results, filename, variable='velsurf_mag'):
+    '''
+    Write one MultiLineString feature per member and level to a GeoJSON
+    file
+    '''
+
+    features = []
+    for member, contours in results:
+        for level, lines in contours.items():
+            feature = OrderedDict()
+            feature['type'] = 'Feature'
+            feature['properties'] = OrderedDict([('member', os.path.basename(member)), (variable, level)])
+            feature['geometry'] = {'type': 'MultiLineString',
+                                   'coordinates': [np.round(line, 6).tolist() for line in lines]}
+            features.append(feature)
+    with open(filename, 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': features}, f)
+
+
+def write_ogr(results, filename, variable='velsurf_mag', driver='GPKG', layer_name=LAYER):
+    '''
+    Write one MultiLineString feature per member and level to a layer of
+    an OGR data source (GeoPackage by default)
+    '''
+
+    from osgeo import ogr, osr
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    if os.path.isfile(filename):
+        os.remove(filename)
+    ds = ogr.GetDriverByName(driver).CreateDataSource(filename)
+    layer = ds.CreateLayer(layer_name, srs, ogr.wkbMultiLineString)
+    layer.CreateField(ogr.FieldDefn('member', ogr.OFTString))
+    layer.CreateField(ogr.FieldDefn(variable, ogr.OFTReal))
+    layer.StartTransaction()
+    for member, contours in results:
+        for level, lines in contours.items():
+            geometry = ogr.Geometry(ogr.wkbMultiLineString)
+            for line in lines:
+                part = ogr.Geometry(ogr.wkbLineString)
+                for lon, lat in line:
+                    part.AddPoint_2D(float(lon), float(lat))
+                geometry.AddGeometry(part)
+            feature = ogr.Feature(layer.GetLayerDefn())
+            feature.SetField('member', os.path.basename(member))
+            feature.SetField(variable, float(level))
+            feature.SetGeometry(geometry)
+            layer.CreateFeature(feature)
+    layer.CommitTransaction()
+    ds = None
+
+
+if __name__ == "__main__":
+
+    # set up the option parser
+    parser = ArgumentParser()
+    parser.description = "Write speed contours of many runs in EPSG:4326 to one layer."
+    parser.add_argument("FILE", nargs='+',
+                        help="post-processed PISM files or globs")
+    parser.add_argument("-v", "--variable", dest="variable",
+                        help="contoured variable. default=velsurf_mag", default='velsurf_mag')
+    parser.add_argument("-l", "--levels", dest="levels",
+                        help="comma-separated list of contour levels. default={}".format(
+                            ','.join(['{:g}'.format(l) for l in LEVELS])),
+                        default=','.join(['{:g}'.format(l) for l in LEVELS]))
+    parser.add_argument("-n", '--n_procs', dest="n", type=int,
+                        help='''number of processes. default=1.''', default=1)
+    parser.add_argument("-o", "--output", dest="output",
+                        help="output .geojson or .gpkg. default=speed_contours_epsg4326.geojson",
+                        default='speed_contours_epsg4326.geojson')
+
+    options = parser.parse_args()
+
+    levels = [float(l) for l in options.levels.split(',')]
+    filenames = []
+    for pattern in options.FILE:
+        filenames.extend(sorted(glob.glob(pattern)))
+    if not filenames:
+        print('no input files found')
+        sys.exit(1)
+
+    args = [(filename, options.variable, levels) for filename in filenames]
+    if options.n > 1 and len(filenames) > 1:
+        pool = Pool(min(options.n, len(filenames)))
+        results = pool.map(_contours, args)
+        pool.close()
+        pool.join()
+    else:
+        results = [_contours(a) for a in args]
+    results = [(member, contours) for member, contours in results if contours is not None]
+
+    if options.output.endswith('.gpkg'):
+        write_ogr(results, options.output, variable=options.variable)
+    else:
+        write_geojson(results, options.output, variable=options.variable)
+    print('wrote contours of {} members to {}'.format(len(results), options.output))
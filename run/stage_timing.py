@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# Copyright (C) 2015 Andy Aschwanden
+
+'''
+Collect the stage timing records of job and post scripts.
+
+Scripts written with timing enabled (see resources.make_timing_functions)
+append one tab-separated record per timed command to
+timing/SCRIPT.JOBID.tsv: job ID, stage, target (the output file), start,
+end and exit status. PISM runs are recorded as stage 'pism' and their
+output is time stamped to timing/OUTFILE.JOBID.log; the collector splits
+a run into
+
+init         start of run_main.sh/run.sh until regridding or the first step
+regrid       regridding from REGRIDFILE until the first time step
+stepping     time stepping, excluding extra_write
+extra_write  time spent writing -extra_file records (-extra_times from
+             PISM_PARAMS or the EXTIMES line of run.sh, else included
+             in stepping)
+write        after the last time step, i.e. writing the output file
+
+Post-processing steps are recorded under their tool name (ncks,
+ncpdq, ncap2, ncatted, postprocess, ...). The summary gives the mean
+seconds per job of each stage and the I/O share for each grid.
+
+Example
+-------
+$ stage_timing.py -o stages.csv
+$ stage_timing.py 'timing/do_greenland_g1500m_*.tsv'
+'''
+
+import os
+import re
+import sys
+import csv
+import glob
+import numpy as np
+from collections import OrderedDict
+from argparse import ArgumentParser
+from resources import *
+from job_sizing import parse_options, PARAMS_PATTERN
+
+STEP_PATTERN = re.compile(r'^S\s+(-?[\d.]+):')
+REGRID_PATTERN = re.compile(r'regrid', re.I)
+RUN_STAGES = ('init', 'regrid', 'stepping', 'extra_write', 'write')
+IO_STAGES = ('init', 'regrid', 'extra_write', 'write')
+GRID_PATTERN = re.compile(r'_g(\d+)m_')
+# -extra_times as printed by run.sh
+EXTIMES_PATTERN = re.compile(r'EXTIMES = (\S+)')
+# tolerance in years when matching step times to extra times
+TIME_TOL = 1e-3
+# days per month of the 365 day year monthly and daily records are matched in
+MONTH_DAYS = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+
+def read_timing_file(filename):
+    '''
+    Return the records of a timing file as a list of dicts
+    '''
+
+    records = []
+    with open(filename, 'r') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 6:
+                continue
+            record = OrderedDict()
+            record['job_id'] = fields[0]
+            record['stage'] = fields[1]
+            record['target'] = fields[2]
+            try:
+                record['start'] = float(fields[3])
+                record['end'] = float(fields[4])
+            except ValueError:
+                continue
+            record['status'] = fields[5]
+            records.append(record)
+
+    return records
+
+
+def get_extra_times(options, model_times):
+    '''
+    Return the times (years) of the -extra_times of PISM options and the
+    tolerance (years) to match step times with, or (None, None).
+    -extra_times is start:step:end or, on a -time_file, only the step;
+    the step is a number of years or yearly, monthly or daily. Step
+    times are printed in years, so monthly and daily records are matched
+    to the month and day boundaries of a 365 day year within a day. A
+    step matched by mistake costs nothing, as only time in excess of the
+    typical step counts as extra_write.
+    '''
+
+    times = options.get('extra_times', '').split(':')
+    if len(times) == 3:
+        step = times[1]
+        try:
+            start, end = float(times[0]), float(times[2])
+        except ValueError:
+            return None, None
+    elif len(times) == 1 and times[0]:
+        step = times[0]
+        start, end = min(model_times), max(model_times)
+    else:
+        return None, None
+
+    if step in ('monthly', 'daily'):
+        if step in ('monthly',):
+            days = np.cumsum((0,) + MONTH_DAYS[:-1])
+        else:
+            days = np.arange(365)
+        years = np.arange(np.floor(start), np.ceil(end) + 1)
+        extra_times = (years[:, np.newaxis] + days[np.newaxis, :] / 365.).ravel()
+        extra_times = extra_times[(extra_times >= start - TIME_TOL) & (extra_times <= end + TIME_TOL)]
+        return extra_times, 1. / 365
+
+    if step in ('yearly',):
+        step = 1
+    try:
+        step = float(step)
+    except ValueError:
+        return None, None
+    if len(times) != 3 or step <= 0:
+        return None, None
+
+    return np.arange(start, end + step / 2., step), TIME_TOL
+
+
+def split_run_log(filename):
+    '''
+    Return an OrderedDict stage -> seconds (see RUN_STAGES) of the time
+    stamped output of a PISM run, or None if it has no time steps
+    '''
+
+    first = regrid = None
+    stamps = []
+    model_times = []
+    last = None
+    options = {}
+    with open(filename, 'r', errors='replace') as f:
+        for line in f:
+            fields = line.rstrip('\n').split(' ', 1)
+            try:
+                t = float(fields[0])
+            except ValueError:
+                continue
+            text = fields[1] if len(fields) > 1 else ''
+            if first is None:
+                first = t
+            last = t
+            m = STEP_PATTERN.match(text)
+            if m is not None:
+                stamps.append(t)
+                model_times.append(float(m.group(1)))
+                continue
+            if not stamps:
+                if regrid is None and REGRID_PATTERN.search(text):
+                    regrid = t
+                m = PARAMS_PATTERN.search(text)
+                if m is not None:
+                    options.update(parse_options(m.group(1)))
+                m = EXTIMES_PATTERN.search(text)
+                if m is not None:
+                    options['extra_times'] = m.group(1)
+    if not stamps:
+        return None
+
+    stages = OrderedDict([(stage, 0.) for stage in RUN_STAGES])
+    if regrid is not None:
+        stages['init'] = regrid - first
+        stages['regrid'] = stamps[0] - regrid
+    else:
+        stages['init'] = stamps[0] - first
+    stages['stepping'] = stamps[-1] - stamps[0]
+    stages['write'] = last - stamps[-1]
+
+    # a record is written after the step reaching an extra time, before
+    # the next step is printed
+    extra_times, tol = get_extra_times(options, model_times)
+    if extra_times is not None and len(extra_times) > 0 and len(stamps) > 2:
+        durations = np.diff(stamps)
+        typical = np.median(durations)
+        for k, duration in enumerate(durations):
+            if np.min(np.abs(extra_times - model_times[k])) < tol:
+                stages['extra_write'] += max(duration - typical, 0.)
+        stages['stepping'] -= stages['extra_write']
+
+    return stages
+
+
+def collect_stages(filenames):
+    '''
+    Return a list of stage records (script, job_id, grid, target, stage,
+    seconds, status) from timing files
+    '''
+
+    stages = []
+    for filename in filenames:
+        for record in read_timing_file(filename):
+            script = os.path.basename(filename)[:-len('.{}.tsv'.format(record['job_id']))]
+            m = GRID_PATTERN.search(record['target']) or GRID_PATTERN.search(script)
+            grid = int(m.group(1)) if m is not None else None
+            common = OrderedDict([('script', script), ('job_id', record['job_id']), ('grid', grid),
+                                  ('target', record['target'])])
+            split = None
+            if record['stage'] in ('pism',):
+                log = os.path.join(os.path.dirname(filename), '{}.{}.log'.format(
+                    os.path.splitext(record['target'])[0], record['job_id']))
+                if os.path.isfile(log):
+                    split = split_run_log(log)
+            if split is None:
+                split = OrderedDict([(record['stage'], record['end'] - record['start'])])
+            for stage, seconds in split.items():
+                row = OrderedDict(common)
+                row['stage'] = stage
+                row['seconds'] = seconds
+                row['status'] = record['status']
+                stages.append(row)
+
+    return stages
+
+
+def summarize_stages(stages):
+    '''
+    Return an OrderedDict grid -> (number of jobs, OrderedDict stage ->
+    mean seconds per job running that stage, I/O share of the total)
+    '''
+
+    summary = OrderedDict()
+    grids = sorted(uniquify_list([s['grid'] for s in stages]), key=lambda g: -(g or 0))
+    for grid in grids:
+        rows = [s for s in stages if s['grid'] == grid]
+        n_jobs = len(uniquify_list([(s['script'], s['job_id']) for s in rows]))
+        means = OrderedDict()
+        for stage in uniquify_list([s['stage'] for s in rows]):
+            stage_rows = [s for s in rows if s['stage'] == stage]
+            jobs = len(uniquify_list([(s['script'], s['job_id']) for s in stage_rows]))
+            means[stage] = sum([s['seconds'] for s in stage_rows]) / jobs
+        total = sum(means.values())
+        io = sum([v for k, v in means.items() if k in IO_STAGES or k not in RUN_STAGES])
+        summary[grid] = (n_jobs, means, io / total if total > 0 else np.nan)
+
+    return summary
+
+
+def write_stages(stages, filename):
+    '''
+    Write stage records as a CSV table
+    '''
+
+    with open(filename, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(list(stages[0].keys()))
+        for s in stages:
+            writer.writerow(list(s.values()))
+
+
+if __name__ == "__main__":
+
+    # set up the option parser
+    parser = ArgumentParser()
+    parser.description = "Aggregate the stage timing records of an ensemble."
+    parser.add_argument("FILE", nargs='*',
+                        help="timing files or globs. default={}/*.tsv".format(TIMING_DIR))
+    parser.add_argument("-o", "--output", dest="output",
+                        help="write all stage records to this CSV file", default=None)
+
+    options = parser.parse_args()
+
+    patterns = options.FILE or ['{}/*.tsv'.format(TIMING_DIR)]
+    filenames = []
+    for pattern in patterns:
+        filenames.extend(sorted(glob.glob(pattern)))
+    stages = collect_stages(filenames)
+    if not stages:
+        print('no timing records found')
+        sys.exit(1)
+
+    for grid, (n_jobs, means, io_share) in summarize_stages(stages).items():
+        print('g{}m, {} jobs, {:.0f}% I/O, mean seconds per job:'.format(grid, n_jobs, 100 * io_share))
+        for stage, seconds in means.items():
+            print('  {:22} {:10.1f}'.format(stage, seconds))
+    if options.output is not None:
+        write_stages(stages, options.output)
+        print('\nwrote {}'.format(options.output))
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# Copyright (C) 2015 Andy Aschwanden
+
+'''
+Submission backends for ensembles written by ensemble.py.
+
+The default (serial) backend submits one job and one dependent post job
+per member. The array backend instead writes
+
+- one PBS job array running all members,
+- packed jobs running several small-grid members side by side in one
+  multi-node allocation, each on its own slice of $PBS_NODEFILE,
+- one post-processing job array that runs once all of the above
+  finished, each task post-processing its member only if the member's
+  runs completed (see post_batch.is_finished), or one batched post job
+  running all post scripts on one node,
+
+so a sweep needs a handful of qsub calls instead of two per member.
+
+Example
+-------
+>>> backend = make_array_backend('pleiades', 64, '12:00:00', 'long')
+>>> generate_ensemble(space, build_member, submit, header, backend=backend)
+'''
+
+import os
+from collections import OrderedDict
+from resources import *
+from post_batch import IO_LIMIT
+
+# members on these grids are packed into shared allocations
+PACK_GRIDS = (9000, 18000)
+ARRAY_INDEX = '${PBS_ARRAYID:-$PBS_ARRAY_INDEX}'
+
+
+def chunk_list(seq, size):
+    '''
+    Split seq into lists of at most size items
+    '''
+
+    return [seq[k:k + size] for k in range(0, len(seq), size)]
+
+
+def write_list_file(list_file, scripts):
+    '''
+    Write one script name per line
+    '''
+
+    with open(list_file, 'w') as f:
+        for script in scripts:
+            f.write(script + '\n')
+
+
+def write_array_job(filename, header, list_file, command='bash $SCRIPT'):
+    '''
+    Write a job array script that runs command with $SCRIPT set to the
+    script on line (array index + 1) of list_file
+    '''
+
+    with open(filename, 'w') as f:
+        f.write(header)
+        f.write('SCRIPT=$(sed -n "$((' + ARRAY_INDEX + ' + 1))p" ' + list_file + ')\n')
+        f.write(command + '\n')
+
+
+def write_packed_job(filename, header, scripts, cores):
+    '''
+    Write a job that runs scripts side by side in one allocation. The
+    node file is split into slices of cores entries, one per script, and
+    each script gets its own PISM_MPIDO machine file and log suffix.
+    '''
+
+    with open(filename, 'w') as f:
+        f.write(header)
+        f.write('split -a 3 -d -l {cores} $PBS_NODEFILE hosts_${{PBS_JOBID}}_\n'.format(cores=cores))
+        f.write('PIDS=""\n')
+        for k, script in enumerate(scripts):
+            f.write('PBS_JOBID=${{PBS_JOBID}}.{k} PISM_MPIDO="mpiexec -machinefile hosts_${{PBS_JOBID}}_{k:03d} -n " bash {script} &\n'.format(k=k, script=script))
+            f.write('PIDS="$PIDS $!"\n')
+        f.write('STATUS=0\n')
+        f.write('for PID in $PIDS; do\n')
+        f.write('  wait $PID || STATUS=1\n')
+        f.write('done\n')
+        f.write('rm -f hosts_${PBS_JOBID}_*\n')
+        f.write('exit $STATUS\n')
+
+
+def make_dependency(system, array_jobs, jobs, condition='ok'):
+    '''
+    Return the qsub -W depend option waiting for shell variables
+    array_jobs (job arrays) and jobs (plain jobs) to succeed, or with
+    condition='any' to finish, or '' if there is nothing to wait for
+    '''
+
+    if not array_jobs and not jobs:
+        return ''
+    if system in ('pleiades',):
+        # PBS Pro: array job IDs end in [] and use plain afterok
+        return '-W depend=after{}:'.format(condition) + ':'.join(['${{{}}}'.format(j) for j in array_jobs + jobs])
+    else:
+        deps = []
+        if array_jobs:
+            deps.append('after{}array:'.format(condition) + ':'.join(['${{{}}}'.format(j) for j in array_jobs]))
+        if jobs:
+            deps.append('after{}:'.format(condition) + ':'.join(['${{{}}}'.format(j) for j in jobs]))
+        return '-W depend=' + ','.join(deps)
+
+
+def make_qsub_line(script, depend=''):
+    '''
+    Return the qsub command of script with the optional -W depend
+    option depend (see make_dependency)
+    '''
+
+    if depend:
+        return 'qsub {} {}'.format(depend, script)
+
+    return 'qsub {}'.format(script)
+
+
+def write_batch_post(name, posts, system=None, cores=16, io_limit=IO_LIMIT, walltime='12:00:00'):
+    '''
+    Write a post job running the post scripts posts of finished members
+    in parallel on cores cores of one transfer node (see post_batch.py),
+    and return its name
+    '''
+
+    list_file = '{}_posts.txt'.format(name)
+    write_list_file(list_file, posts)
+    batch = '{}_post_batch.sh'.format(name)
+    with open(batch, 'w') as f:
+        f.write(make_post_header(system, cores=cores, walltime=walltime))
+        f.write('python post_batch.py -n {cores} --io_limit {io_limit} --list {list_file}\n'.format(
+            cores=cores, io_limit=io_limit, list_file=list_file))
+
+    return batch
+
+
+def write_array_submit(submit, members, system, cores, walltime, queue, name='ensemble',
+                       pack_grids=PACK_GRIDS, members_per_job=4, post=True, post_batch=None):
+    '''
+    Write the job array, packed jobs and the post job array of members,
+    and a submit script that queues them with qsub. If post_batch
+    (number of cores) is given, one batched post job (see
+    write_batch_post) replaces the post job array. cores and walltime
+    apply to members without their own (see ensemble.size_member).
+    '''
+
+    # members sized by a sizing model (see ensemble.size_member) go into
+    # one job array and set of packed jobs per job size
+    sizes = OrderedDict()
+    for member in members:
+        size = (member.get('cores', cores), member.get('walltime', walltime))
+        array_scripts, pack_scripts = sizes.setdefault(size, ([], []))
+        if member['grid'] in pack_grids and members_per_job > 1:
+            pack_scripts.append(member['script'])
+        else:
+            array_scripts.append(member['script'])
+
+    array_jobs = []
+    jobs = []
+    lines = ['#!/bin/bash']
+
+    n_pack = 0
+    for n, (size, (array_scripts, pack_scripts)) in enumerate(sizes.items()):
+        size_cores, size_walltime = size
+        suffix = '_{}'.format(n) if n > 0 else ''
+        if array_scripts:
+            list_file = '{}_runs{}.txt'.format(name, suffix)
+            write_list_file(list_file, array_scripts)
+            run_array = '{}_run_array{}.sh'.format(name, suffix)
+            header = make_pbs_header(system, size_cores, size_walltime, queue,
+                                     array='0-{}'.format(len(array_scripts) - 1))
+            write_array_job(run_array, header, list_file)
+            lines.append('RUNARRAY{}=$(qsub {})'.format(suffix, run_array))
+            array_jobs.append('RUNARRAY{}'.format(suffix))
+
+        for scripts in chunk_list(pack_scripts, members_per_job):
+            packed = '{}_pack_{}.sh'.format(name, n_pack)
+            header = make_pbs_header(system, size_cores * len(scripts), size_walltime, queue)
+            write_packed_job(packed, header, scripts, size_cores)
+            lines.append('PACK{}=$(qsub {})'.format(n_pack, packed))
+            jobs.append('PACK{}'.format(n_pack))
+            n_pack += 1
+
+    # with no members there is nothing to post-process
+    if post and members and post_batch:
+        batch = write_batch_post(name, [member['post'] for member in members], system=system, cores=post_batch)
+        lines.append(make_qsub_line(batch, make_dependency(system, array_jobs, jobs, condition='any')))
+    elif post and members:
+        posts = [member['post'] for member in members]
+        list_file = '{}_posts.txt'.format(name)
+        write_list_file(list_file, posts)
+        post_array = '{}_post_array.sh'.format(name)
+        # afterok on a job array waits for every task to succeed, so one
+        # failed member would cancel the post jobs of all others
+        write_array_job(post_array, make_post_header(system, array='0-{}'.format(len(posts) - 1)), list_file,
+                        command='python post_batch.py -n 1 $SCRIPT')
+        lines.append(make_qsub_line(post_array, make_dependency(system, array_jobs, jobs, condition='any')))
+
+    with open(submit, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def make_array_backend(system, cores, walltime, queue, name=None, pack_grids=PACK_GRIDS, members_per_job=4,
+                       post_batch=None):
+    '''
+    Return a backend for generate_ensemble that writes job arrays and
+    packed jobs (see write_array_submit)
+    '''
+
+    def backend(submit, members, post=True):
+        if name is None:
+            prefix = os.path.splitext(submit)[0]
+        else:
+            prefix = name
+        write_array_submit(submit, members, system, cores, walltime, queue, name=prefix,
+                           pack_grids=pack_grids, members_per_job=members_per_job, post=post,
+                           post_batch=post_batch)
+
+    return backend
@@ -1,10 +1,10 @@
 #!/usr/bin/env python
 # Copyright (C) 2014-2015 Andy Aschwanden
 
-import itertools
-import os
+from collections import OrderedDict
 from argparse import ArgumentParser
 from resources import *
+from ensemble import *
 
 # Set up the option parser
 parser = ArgumentParser()
@@ -40,6 +40,8 @@ parser.add_argument("-t", "--etype", dest="etype",
 parser.add_argument("--dataset_version", dest="version",
                     choices=['1.1', '1.2', '2'],
                     help="Input data set version", default='2')
+parser.add_argument("--sizing_model", dest="sizing_model",
+                    help="sizing model (see job_sizing.py) choosing the number of cores and walltime of each member instead of -n and -w", default=None)
 
 options = parser.parse_args()
 args = options.regridfile
@@ -87,139 +89,89 @@ phi_min_values = [5.0]
 phi_max_values = [40.]
 topg_min_values = [-700]
 topg_max_values = [700]
-combinations = list(itertools.product(omega_values, alpha_values, k_values, phi_min_values, phi_max_values, topg_min_values, topg_max_values))
 
 tsstep = 'daily'
 exstep = 'yearly'
 regridvars = 'litho_temp,enthalpy,tillwat,bmelt,Href'
 
-scripts = []
-posts = []
-for n, combination in enumerate(combinations):
-
-    dist_omega, dist_alpha, dist_k, phi_min, phi_max, topg_min, topg_max = combination
-
+space = OrderedDict()
+space['omega'] = omega_values
+space['alpha'] = alpha_values
+space['k'] = k_values
+space['phi_min'] = phi_min_values
+space['phi_max'] = phi_max_values
+space['topg_min'] = topg_min_values
+space['topg_max'] = topg_max_values
+
+bed_data_set = get_bed_data_set(version, options.etype)
+tl_dir = '{}m_{}_{}'.format(grid, climate, etype)
+nc_dir = 'processed'
+rc_dir = domain.lower()
+out_dir = '/'.join([tl_dir, nc_dir, rc_dir])
+pbs_header = make_pbs_header(system, nn, walltime, queue)
+
+
+def build_member(combination):
+
+    dist_omega = combination['omega']
+    dist_alpha = combination['alpha']
+    dist_k = combination['k']
+    phi_min = combination['phi_min']
+    phi_max = combination['phi_max']
+    topg_min = combination['topg_min']
+    topg_max = combination['topg_max']
     ttphi = '{},{},{},{}'.format(phi_min, phi_max, topg_min, topg_max)
 
-    experiment='{}_{}_sia_e_{}_ppq_{}_tefo_{}_ssa_n_{}_ssa_e_{}_phi_min_{}_phi_max_{}_topg_min_{}_topg_max_{}_hydro_{}_omega_{}_alpha_{}_k_{}'.format(climate, etype, sia_e, ppq, tefo, ssa_n, ssa_e, phi_min, phi_max, topg_min, topg_max, hydro, dist_omega, dist_alpha, dist_k)
-    script = 'do_{}_g{}m_{}.sh'.format(domain.lower(), grid, experiment)
-    scripts.append(script)
-    post = 'do_{}_g{}m_{}_post.sh'.format(domain.lower(), grid, experiment)
-    posts.append(post)
-    
-    for filename in (script, post):
-        try:
-            os.remove(filename)
-        except OSError:
-            pass
-
-    pbs_header = make_pbs_header(system, nn, walltime, queue)
-        
-    
-    os.environ['PISM_EXPERIMENT'] = experiment
-    os.environ['PISM_TITLE'] = 'Greenland Paramter Study'
-    
-    with open(script, 'w') as f:
-
-        f.write(pbs_header)
-
-
-        outfile = '{domain}_g{grid}m_{experiment}_{dura}a.nc'.format(domain=domain.lower(),grid=grid, experiment=experiment, dura=dura)
-            
-        params_dict = dict()
-        params_dict['PISM_DO'] = ''
-        params_dict['PISM_OFORMAT'] = oformat
-        params_dict['PISM_OSIZE'] = osize
-        params_dict['PISM_EXEC'] = pism_exec
-        params_dict['PISM_DATANAME'] = pism_dataname
-        params_dict['PISM_SURFACE_BCFILE'] = pism_surface_bcfile
-        params_dict['REGRIDFILE'] = regridfile
-        params_dict['TSSTEP'] = tsstep
-        params_dict['EXSTEP'] = exstep
-        params_dict['REGRIDVARS'] = regridvars
-        params_dict['SIA_E'] = sia_e
-        params_dict['SSA_E'] = ssa_e
-        params_dict['SSA_N'] = ssa_n
-        params_dict['PARAM_NOAGE'] = 'foo'
-        params_dict['PARAM_PPQ'] = ppq
-        params_dict['PARAM_TEFO'] = tefo
-        params_dict['PARAM_TTPHI'] = ttphi
-        params_dict['PARAM_FTT'] = 'foo'
-        params_dict['PARAM_ALPHA'] = dist_alpha
-        params_dict['PARAM_K'] = dist_k
-        params_dict['PARAM_OMEGA'] = dist_omega
-        
-        
-        params = ' '.join(['='.join([k, str(v)]) for k, v in params_dict.items()])
-        cmd = ' '.join([params, './run.sh', str(nn), climate, str(dura), str(grid), 'hybrid', hydro, outfile, infile, '2>&1 | tee job.${PBS_JOBID}'])
-
-        f.write(cmd)
-        f.write('\n')
-
-        if etype in 'ctrl_v2':
-            mytype = "MO14 2015-04-27"
-        elif etype in 'cresis_v2':
-            mytype = "MO14+CReSIS 2015-04-27"
-        elif etype in 'ctrl_v1.2':
-            mytype = "MO14 2014-11-19"
-        elif etype in ('ctrl', 'ctrl_v1.1'):
-            mytype = "MO14 2014-06-26"
-        elif etype in ('old_bed', 'old_bed_v1.1', 'old_bed_v1.2', 'old_bed_v2'):
-            mytype = "BA01"
-        elif etype in 'searise':
-            mytype = "SR13"
-        else:
-            import sys
-            print('etype {} not recognized, exiting'.format(etype))
-            sys.exit(0)
-
-    tl_dir = '{}m_{}_{}'.format(grid, climate, etype)
-    nc_dir = 'processed'
-    rc_dir = domain.lower()
-    fill = '-2e9'
-        
-    with open(post, 'w') as f:
-
-        f.write('#!/bin/bash\n')
-        f.write('#PBS -q transfer\n')
-        f.write('#PBS -l walltime=4:00:00\n')
-        f.write('#PBS -l nodes=1:ppn=1\n')
-        f.write('#PBS -j oe\n')
-        f.write('\n')
-        f.write('source ~/python/bin/activate\n')
-        f.write('\n')
-        f.write('cd $PBS_O_WORKDIR\n')
-        f.write('\n')
-
-        f.write(' if [ ! -d {tl_dir}/{nc_dir}/{rc_dir} ]; then mkdir -p {tl_dir}/{nc_dir}/{rc_dir}; fi\n'.format(tl_dir=tl_dir, nc_dir=nc_dir, rc_dir=rc_dir))
-        f.write('\n')
-        f.write('if [ -f {} ]; then\n'.format(outfile))
-        f.write('  rm -f tmp_{outfile} {tl_dir}/{nc_dir}/{rc_dir}/{outfile}\n'.format(outfile=outfile, tl_dir=tl_dir, nc_dir=nc_dir, rc_dir=rc_dir))
-        f.write('  ncks -v enthalpy,litho_temp -x {outfile} tmp_{outfile}\n'.format(outfile=outfile))
-        f.write('  sh add_epsg3413_mapping.sh tmp_{}\n'.format(outfile))
-        f.write('  ncpdq -O --64 -a time,y,x tmp_{outfile} {tl_dir}/{nc_dir}/{rc_dir}/{outfile}\n'.format(outfile=outfile, tl_dir=tl_dir, nc_dir=nc_dir, rc_dir=rc_dir))
-        f.write(  '''  ncap2 -O -s "uflux=ubar*thk; vflux=vbar*thk; velshear_mag=velsurf_mag-velbase_mag; where(thk<50) {{velshear_mag={fill}; velbase_mag={fill}; velsurf_mag={fill}; flux_mag={fill};}}; sliding_r = velbase_mag/velsurf_mag; tau_r = tauc/(taud_mag+1); tau_rel=(tauc-taud_mag)/(1+taud_mag);" {tl_dir}/{nc_dir}/{rc_dir}/{outfile} {tl_dir}/{nc_dir}/{rc_dir}/{outfile}\n'''.format(outfile=outfile, fill=fill, tl_dir=tl_dir, nc_dir=nc_dir, rc_dir=rc_dir))
-        f.write('  ncatted -a bed_data_set,run_stats,o,c,"{mytype}" -a grid_dx_meters,run_stats,o,f,{grid} -a grid_dy_meters,run_stats,o,f,{grid} -a long_name,uflux,o,c,"vertically-integrated horizontal flux of ice in the x direction" -a long_name,vflux,o,c,"vertically-integrated horizontal flux of ice in the y direction" -a units,uflux,o,c,"m2 year-1" -a units,vflux,o,c,"m2 year-1" -a units,sliding_r,o,c,"1" -a units,tau_r,o,c,"1" -a units,tau_rel,o,c,"1" {tl_dir}/{nc_dir}/{rc_dir}/{outfile}\n'.format(mytype=mytype, grid=grid, tl_dir=tl_dir, nc_dir=nc_dir, rc_dir=rc_dir, outfile=outfile))
-        f.write('fi\n')
-        f.write('\n')
-
-        
-scripts = uniquify_list(scripts)
-posts = uniquify_list(posts)
-
-submit = 'submit_{domain}_g{grid}m_{climate}_{etype}_tillphi.sh'.format(domain=domain.lower(), grid=grid, climate=climate, etype=etype)
-try:
-    os.remove(submit)
-except OSError:
-    pass
+    name_options = OrderedDict()
+    name_options['sia_e'] = sia_e
+    name_options['ppq'] = ppq
+    name_options['tefo'] = tefo
+    name_options['ssa_n'] = ssa_n
+    name_options['ssa_e'] = ssa_e
+    name_options['phi_min'] = phi_min
+    name_options['phi_max'] = phi_max
+    name_options['topg_min'] = topg_min
+    name_options['topg_max'] = topg_max
+    name_options['hydro'] = hydro
+    name_options['omega'] = dist_omega
+    name_options['alpha'] = dist_alpha
+    name_options['k'] = dist_k
+
+    experiment = generate_experiment_name([climate, etype], name_options)
+
+    outfile = '{domain}_g{grid}m_{experiment}_{dura}a.nc'.format(domain=domain.lower(),grid=grid, experiment=experiment, dura=dura)
+
+    params_dict = OrderedDict()
+    params_dict['PISM_DO'] = ''
+    params_dict['PISM_OFORMAT'] = oformat
+    params_dict['PISM_OSIZE'] = osize
+    params_dict['PISM_EXEC'] = pism_exec
+    params_dict['PISM_DATANAME'] = pism_dataname
+    params_dict['PISM_SURFACE_BCFILE'] = pism_surface_bcfile
+    params_dict['REGRIDFILE'] = regridfile
+    params_dict['TSSTEP'] = tsstep
+    params_dict['EXSTEP'] = exstep
+    params_dict['REGRIDVARS'] = regridvars
+    params_dict['SIA_E'] = sia_e
+    params_dict['SSA_E'] = ssa_e
+    params_dict['SSA_N'] = ssa_n
+    params_dict['PARAM_NOAGE'] = 'foo'
+    params_dict['PARAM_PPQ'] = ppq
+    params_dict['PARAM_TEFO'] = tefo
+    params_dict['PARAM_TTPHI'] = ttphi
+    params_dict['PARAM_FTT'] = 'foo'
+    params_dict['PARAM_ALPHA'] = dist_alpha
+    params_dict['PARAM_K'] = dist_k
+    params_dict['PARAM_OMEGA'] = dist_omega
+
+    args = [nn, climate, dura, grid, 'hybrid', hydro, outfile, infile]
+    runs = [make_run(params_dict, args, outfile, run_script='./run.sh')]
+
+    return make_member(domain, grid, experiment, runs, out_dir, bed_data_set, params=name_options)
 
-with open(submit, 'w') as f:
 
-    f.write('#!/bin/bash\n')
-
-    for k in range(len(scripts)):
-        f.write('JOBID=$(qsub {script})\n'.format(script=scripts[k]))
-        f.write('qsub -W depend=afterok:${{JOBID}} {post}\n'.format(post=posts[k]))
+submit = 'submit_{domain}_g{grid}m_{climate}_{etype}_tillphi.sh'.format(domain=domain.lower(), grid=grid, climate=climate, etype=etype)
+generate_ensemble(space, build_member, submit, pbs_header, sizing_model=options.sizing_model,
+                  system=system, queue=queue)
 
 print("\nRun {} to submit all jobs to the scheduler\n".format(submit))
-